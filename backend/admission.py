@@ -0,0 +1,330 @@
+# 杏铃酱 xingling-chat 上游准入控制
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+调用模型接口和搜索服务商之前的准入控制，避免一阵突发请求原样压到上游、换回一串 429。
+
+- 每个上游一个 Limiter（模型接口按 (base_url, api_key)，搜索按 (服务商, api_key)）：并发上限，
+  外加可选的 token 速率上限（令牌桶，按每分钟 token 数补充）。开始前按估算的输入 token + max_tokens 预扣，
+  结束后按接口返回的实际用量退还多扣的部分
+- 排队公平：同一优先级内按会话轮转，一个会话的大量请求（例如长文档分段分析）不会挤占其他会话
+- 两个优先级：交互（对话、文档分析、搜索）和后台（长期摘要）；有交互请求在排队时后台请求拿不到名额
+- 过载保护：交互请求预计或实际排队超过 ADMISSION_MAX_WAIT 秒时直接拒绝（Overloaded，接口返回
+  503 + Retry-After）；后台请求不急，最多等 ADMISSION_BACKGROUND_MAX_WAIT 秒
+- 指标：各上游的占用数、排队数、排队时间、拒绝次数（/metrics），/status 里的 admission
+- Limiter 按 (上游, 密钥) 懒创建，键来自请求方，所以和 client_pool 一样做 LRU：空闲（没有占用和排队）
+  超过 ADMISSION_IDLE_TTL 秒或总数超过 ADMISSION_MAX_LIMITERS 时回收最久没用的；忙着的不回收。
+  回收后再来的请求重新创建，令牌桶从满的开始
+
+只作用于异步路径（接口层），同步的库函数不经过准入控制。限额按进程计，多 worker 部署时
+每个 worker 各自限流，配置时按 worker 数折算。XINGLING_UPSTREAM_LIMITS 可以按 base_url（或搜索服务商名）
+单独配置，例如 {"http://localhost:11434/v1": {"concurrency": 2}, "https://api.deepseek.com": {"tokens_per_minute": 600000}}
+"""
+import asyncio
+import hashlib
+import json
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+import metrics
+
+# ---------- 准入配置（从环境变量读取）----------
+ADMISSION_ENABLED = os.getenv("XINGLING_ADMISSION", "1") != "0"
+UPSTREAM_CONCURRENCY = int(os.getenv("XINGLING_UPSTREAM_CONCURRENCY", "8"))
+UPSTREAM_TOKENS_PER_MINUTE = int(os.getenv("XINGLING_UPSTREAM_TPM", "0"))  # 0 表示不限
+SEARCH_CONCURRENCY = int(os.getenv("XINGLING_SEARCH_CONCURRENCY", "4"))
+ADMISSION_MAX_WAIT = float(os.getenv("XINGLING_ADMISSION_MAX_WAIT", "10"))
+ADMISSION_BACKGROUND_MAX_WAIT = float(os.getenv("XINGLING_ADMISSION_BACKGROUND_MAX_WAIT", "300"))
+UPSTREAM_LIMITS: Dict[str, Dict] = json.loads(os.getenv("XINGLING_UPSTREAM_LIMITS", "") or "{}")
+ADMISSION_MAX_LIMITERS = int(os.getenv("XINGLING_ADMISSION_MAX_LIMITERS", "256"))
+ADMISSION_IDLE_TTL = float(os.getenv("XINGLING_ADMISSION_IDLE_TTL", "600"))
+
+INTERACTIVE = 0
+BACKGROUND = 1
+PRIORITY_NAMES = ("interactive", "background")
+
+HOLD_EWMA_ALPHA = 0.2  # 估算排队时间用的平均占用时长的平滑系数
+
+
+class Overloaded(Exception):
+    def __init__(self, upstream: str, retry_after: float):
+        self.retry_after = max(int(math.ceil(retry_after)), 1)
+        super().__init__(f"上游繁忙（{upstream}），请 {self.retry_after} 秒后重试")
+
+
+class Grant:
+    """拿到的一个名额；settle() 报告实际用掉的 token 数，退还多预扣的部分"""
+    __slots__ = ("cost", "used", "started")
+
+    def __init__(self, cost: int):
+        self.cost = cost
+        self.used: Optional[int] = None
+        self.started = time.monotonic()
+
+    def settle(self, usage: Optional[Dict]):
+        if usage is not None:
+            self.used = usage.get("prompt", 0) + usage.get("completion", 0)
+
+
+class _Waiter:
+    __slots__ = ("future", "session_id", "priority", "cost", "enqueued")
+
+    def __init__(self, future: asyncio.Future, session_id: str, priority: int, cost: int):
+        self.future = future
+        self.session_id = session_id
+        self.priority = priority
+        self.cost = cost
+        self.enqueued = time.monotonic()
+
+
+class Limiter:
+    def __init__(self, name: str, concurrency: int, tokens_per_minute: int = 0):
+        self.name = name
+        self.concurrency = max(concurrency, 1)
+        self.tokens_per_minute = tokens_per_minute
+        self.active = 0
+        # 每个优先级一张 会话 -> 等待队列 的有序表，轮到的会话取一个后移到表尾
+        self._queues: List["OrderedDict[str, Deque[_Waiter]]"] = [OrderedDict(), OrderedDict()]
+        self._queued = [0, 0]
+        self._queued_cost = 0
+        self._tokens = float(tokens_per_minute)
+        self._refilled = time.monotonic()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.hold = 0.0  # 平均占用时长（秒），估算排队时间用；还没有数据时不按估算拒绝
+        self.last_used = time.monotonic()
+        self.admitted = 0
+        self.shed = 0
+        self.wait_total = 0.0
+
+    # ---------- 令牌桶 ----------
+
+    def _refill(self):
+        if not self.tokens_per_minute:
+            return
+        now = time.monotonic()
+        rate = self.tokens_per_minute / 60
+        self._tokens = min(float(self.tokens_per_minute), self._tokens + (now - self._refilled) * rate)
+        self._refilled = now
+
+    def _clamp(self, cost: int) -> int:
+        # 超过桶容量的请求按桶容量计，否则永远等不到
+        return min(max(cost, 0), self.tokens_per_minute) if self.tokens_per_minute else 0
+
+    # ---------- 排队 ----------
+
+    def estimate_wait(self, priority: int = INTERACTIVE, cost: int = 0) -> float:
+        """新来一个请求预计要排多久（秒）"""
+        ahead = self._queued[INTERACTIVE] + (self._queued[BACKGROUND] if priority == BACKGROUND else 0)
+        wait = 0.0
+        if ahead or self.active >= self.concurrency:
+            wait = (ahead + 1) / self.concurrency * self.hold
+        if self.tokens_per_minute:
+            self._refill()
+            deficit = self._queued_cost + self._clamp(cost) - self._tokens
+            wait = max(wait, deficit / (self.tokens_per_minute / 60))
+        return wait
+
+    def check(self, priority: int = INTERACTIVE, cost: int = 0):
+        """交互请求预计排队超过 ADMISSION_MAX_WAIT 时抛出 Overloaded"""
+        if priority != INTERACTIVE:
+            return
+        wait = self.estimate_wait(priority, cost)
+        if wait > ADMISSION_MAX_WAIT:
+            self._shed()
+            raise Overloaded(self.name, wait)
+
+    def _shed(self):
+        self.shed += 1
+        metrics.ADMISSION_SHED.labels(upstream=self.name).inc()
+
+    def _peek(self) -> Optional[_Waiter]:
+        for queue in self._queues:
+            if queue:
+                return next(iter(queue.values()))[0]
+        return None
+
+    def _remove(self, waiter: _Waiter, served: bool):
+        queue = self._queues[waiter.priority]
+        waiters = queue.get(waiter.session_id)
+        if waiters is None or waiter not in waiters:
+            return
+        waiters.remove(waiter)
+        if not waiters:
+            del queue[waiter.session_id]
+        elif served:
+            queue.move_to_end(waiter.session_id)
+        self._queued[waiter.priority] -= 1
+        self._queued_cost -= waiter.cost
+        metrics.ADMISSION_QUEUE.labels(upstream=self.name, priority=PRIORITY_NAMES[waiter.priority]).dec()
+
+    def _start(self, cost: int) -> Grant:
+        self.active += 1
+        self.admitted += 1
+        if self.tokens_per_minute:
+            self._tokens -= cost
+        metrics.ADMISSION_ACTIVE.labels(upstream=self.name).inc()
+        return Grant(cost)
+
+    def _dispatch(self):
+        self._refill()
+        while self.active < self.concurrency:
+            waiter = self._peek()
+            if waiter is None:
+                return
+            if waiter.future.done():
+                # 排队的请求刚被取消（future 已经取消，acquire 里的清理要到下一轮事件循环才执行）：直接移出队列
+                self._remove(waiter, served=False)
+                continue
+            if self.tokens_per_minute and self._tokens < waiter.cost:
+                # 等令牌补够了再叫号
+                if self._timer is None:
+                    delay = (waiter.cost - self._tokens) / (self.tokens_per_minute / 60)
+                    self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+                return
+            self._remove(waiter, served=True)
+            waiter.future.set_result(self._start(waiter.cost))
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+    def _expire(self, waiter: _Waiter):
+        if not waiter.future.done():
+            self._remove(waiter, served=False)
+            if waiter.priority == INTERACTIVE:
+                self._shed()
+            waiter.future.set_exception(Overloaded(self.name, self.estimate_wait(waiter.priority)))
+            self._dispatch()
+
+    async def acquire(self, session_id: str, priority: int = INTERACTIVE, cost: int = 0) -> Grant:
+        cost = self._clamp(cost)
+        self.check(priority, cost)
+        self._refill()
+        nobody_ahead = not any(self._queued[:priority + 1])
+        if nobody_ahead and self.active < self.concurrency and (not self.tokens_per_minute or self._tokens >= cost):
+            self._record_wait(priority, 0.0)
+            return self._start(cost)
+
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(loop.create_future(), session_id, priority, cost)
+        self._queues[priority].setdefault(session_id, deque()).append(waiter)
+        self._queued[priority] += 1
+        self._queued_cost += cost
+        metrics.ADMISSION_QUEUE.labels(upstream=self.name, priority=PRIORITY_NAMES[priority]).inc()
+        max_wait = ADMISSION_MAX_WAIT if priority == INTERACTIVE else ADMISSION_BACKGROUND_MAX_WAIT
+        expiry = loop.call_later(max_wait, self._expire, waiter)
+        self._dispatch()  # 只差令牌时排上补充令牌的定时器
+        try:
+            grant = await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+                self.release(waiter.future.result())  # 叫到号的同时被取消
+            else:
+                self._remove(waiter, served=False)
+                self._dispatch()
+            raise
+        finally:
+            expiry.cancel()
+        self._record_wait(priority, time.monotonic() - waiter.enqueued)
+        return grant
+
+    @property
+    def idle(self) -> bool:
+        """没有占用、排队和补充令牌的定时器，可以回收"""
+        return not self.active and not any(self._queued) and self._timer is None
+
+    def _record_wait(self, priority: int, waited: float):
+        self.wait_total += waited
+        metrics.ADMISSION_WAIT_SECONDS.labels(upstream=self.name, priority=PRIORITY_NAMES[priority]).observe(waited)
+
+    def release(self, grant: Grant):
+        self.active -= 1
+        self.last_used = time.monotonic()
+        metrics.ADMISSION_ACTIVE.labels(upstream=self.name).dec()
+        held = time.monotonic() - grant.started
+        self.hold = held if not self.hold else self.hold + HOLD_EWMA_ALPHA * (held - self.hold)
+        if self.tokens_per_minute and grant.used is not None and grant.used < grant.cost:
+            self._refill()
+            self._tokens = min(float(self.tokens_per_minute), self._tokens + grant.cost - grant.used)
+        self._dispatch()
+
+    def stats(self) -> Dict:
+        return {
+            "concurrency": self.concurrency,
+            "tokens_per_minute": self.tokens_per_minute,
+            "active": self.active,
+            "queued": {name: self._queued[i] for i, name in enumerate(PRIORITY_NAMES)},
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "avg_wait_ms": round(self.wait_total / self.admitted * 1000, 1) if self.admitted else 0.0,
+            "avg_hold_ms": round(self.hold * 1000, 1),
+        }
+
+
+class AdmissionController:
+    """按上游懒创建 Limiter（LRU，回收空闲的）；名称里只带 API 密钥的短哈希"""
+
+    def __init__(self, max_size: int = ADMISSION_MAX_LIMITERS, idle_ttl: float = ADMISSION_IDLE_TTL):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self._limiters: "OrderedDict[Tuple[str, str, str], Limiter]" = OrderedDict()
+        self.evicted = 0
+
+    def limiter(self, kind: str, endpoint: str, api_key: str) -> Limiter:
+        digest = hashlib.sha1((api_key or "").encode("utf-8")).hexdigest()[:6]
+        key = (kind, endpoint, digest)
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            override = UPSTREAM_LIMITS.get(endpoint, {})
+            default_concurrency = SEARCH_CONCURRENCY if kind == "search" else UPSTREAM_CONCURRENCY
+            limiter = self._limiters[key] = Limiter(
+                f"{kind}:{endpoint}#{digest}",
+                int(override.get("concurrency", default_concurrency)),
+                int(override.get("tokens_per_minute", 0 if kind == "search" else UPSTREAM_TOKENS_PER_MINUTE)),
+            )
+            self._evict(key)
+        else:
+            self._limiters.move_to_end(key)
+        limiter.last_used = time.monotonic()
+        return limiter
+
+    def _evict(self, keep: Tuple[str, str, str]):
+        # 只在创建新 Limiter 时整理；都在事件循环线程里调用，不需要加锁
+        now = time.monotonic()
+        excess = len(self._limiters) - self.max_size
+        for key, limiter in list(self._limiters.items()):  # 从最久没用的开始
+            if key == keep or not limiter.idle:
+                continue
+            if excess > 0 or now - limiter.last_used > self.idle_ttl:
+                del self._limiters[key]
+                self.evicted += 1
+                excess -= 1
+
+    def check(self, kind: str, endpoint: str, api_key: str, priority: int = INTERACTIVE):
+        """开始一轮对话之前快速判断：上游已经排不过来时抛出 Overloaded"""
+        if ADMISSION_ENABLED:
+            self.limiter(kind, endpoint, api_key).check(priority)
+
+    @asynccontextmanager
+    async def slot(self, kind: str, endpoint: str, api_key: str, session_id: Optional[str] = None,
+                   priority: int = INTERACTIVE, cost: int = 0) -> AsyncIterator[Grant]:
+        """占用一个上游名额直到退出；排队超时抛出 Overloaded"""
+        if not ADMISSION_ENABLED:
+            yield Grant(0)
+            return
+        limiter = self.limiter(kind, endpoint, api_key)
+        grant = await limiter.acquire(session_id or "", priority, cost)
+        try:
+            yield grant
+        finally:
+            limiter.release(grant)
+
+    def stats(self) -> Dict:
+        return {limiter.name: limiter.stats() for limiter in self._limiters.values()}
+
+
+controller = AdmissionController()
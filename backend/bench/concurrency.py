@@ -0,0 +1,98 @@
+# 杏铃酱 xingling-chat 基准测试：卡死的上游会不会拖慢其他用户
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+先发一个会让上游卡住 N 秒的请求，再让其他会话并发发送普通请求，统计它们的延迟。
+
+- async：当前的 /chat（AsyncOpenAI + 连接池），其他用户不受影响
+- blocking：在 async 接口里直接调用同步 chat_with_memory（改造前的写法），整个事件循环被卡住
+
+运行：python bench/concurrency.py --users 20 --stall 5
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import httpx
+from fastapi import FastAPI
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+import memory_core  # noqa: E402
+from bench.mock_upstream import STALL_MARKER, MockConfig, create_app, serve_in_thread  # noqa: E402
+
+UPSTREAM_PORT = 9101
+BACKEND_PORT = 9102
+
+
+def blocking_app() -> FastAPI:
+    """改造前的写法：async 接口里调用同步函数"""
+    app = FastAPI()
+
+    @app.post("/chat")
+    async def chat(request: main.ChatRequest):
+        reply = memory_core.chat_with_memory(
+            session_id=request.session_id,
+            user_message=request.message,
+            api_key=request.api_key,
+            base_url=request.base_url,
+        )
+        return {"reply": reply}
+
+    return app
+
+
+async def one_request(client: httpx.AsyncClient, session_id: str, message: str) -> float:
+    start = time.perf_counter()
+    resp = await client.post(f"http://127.0.0.1:{BACKEND_PORT}/chat", json={
+        "session_id": session_id,
+        "message": message,
+        "api_key": "mock",
+        "base_url": f"http://127.0.0.1:{UPSTREAM_PORT}/v1",
+    })
+    resp.raise_for_status()
+    return time.perf_counter() - start
+
+
+async def run(users: int) -> list:
+    async with httpx.AsyncClient(timeout=120) as client:
+        stalled = asyncio.create_task(one_request(client, "bench-stalled", f"{STALL_MARKER} 你好"))
+        await asyncio.sleep(0.2)
+        latencies = await asyncio.gather(*[
+            one_request(client, f"bench-user-{i}", "你好") for i in range(users)
+        ])
+        await stalled
+    return list(latencies)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="卡死上游下的并发延迟基准")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--stall", type=float, default=5.0)
+    parser.add_argument("--mode", choices=["async", "blocking", "both"], default="both")
+    args = parser.parse_args()
+
+    memory_core.set_memory_dir(tempfile.mkdtemp(prefix="xingling-bench-"))
+    upstream = serve_in_thread(create_app(MockConfig(stall_seconds=args.stall)), UPSTREAM_PORT)
+
+    modes = ["async", "blocking"] if args.mode == "both" else [args.mode]
+    for mode in modes:
+        app = main.app if mode == "async" else blocking_app()
+        backend = serve_in_thread(app, BACKEND_PORT)
+        latencies = asyncio.run(run(args.users))
+        backend.should_exit = True
+        time.sleep(0.3)
+        latencies.sort()
+        print(f"[{mode}] {args.users} 个用户，上游卡住 {args.stall}s："
+              f"p50={statistics.median(latencies):.3f}s max={latencies[-1]:.3f}s")
+
+    upstream.should_exit = True
+
+
+if __name__ == "__main__":
+    main_cli()
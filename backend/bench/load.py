@@ -0,0 +1,312 @@
+# 杏铃酱 xingling-chat 基准测试：并发负载
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+完全离线的负载测试：本进程里启动模拟上游（bench/mock_upstream.py），另起一个子进程运行后端
+（数据目录在临时目录里，搜索地址指向模拟服务），N 个会话并发地对 /chat、/chat_stream、/upload
+各发若干轮请求。
+
+报告每个接口的 p50/p95/p99 延迟、首 token 时间（流式接口，收到第一帧 content 的时间）、
+错误数、吞吐量，以及后端进程的 RSS（启动后 / 峰值 / 结束时，读 /proc，仅 Linux）。
+
+--json 把结果写成文件；--baseline 与之前保存的结果比较，p95 延迟、p95 首 token 时间或峰值 RSS
+变差超过 --tolerance 时以退出码 1 结束，可以放进发布前的检查里。
+
+运行：python bench/load.py --sessions 20 --turns 5 --endpoints chat,chat_stream,upload
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from bench.mock_upstream import MockConfig, create_app, serve_in_thread  # noqa: E402
+
+UPSTREAM_PORT = 9103
+BACKEND_PORT = 9104
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(int(round(q * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def read_rss(pid: int) -> Optional[int]:
+    """进程常驻内存（字节），读不到时返回 None"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid: int, interval: float = 0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.is_set():
+            rss = read_rss(self.pid)
+            if rss:
+                self.peak = max(self.peak, rss)
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def start_backend(memory_dir: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "XINGLING_MEMORY_DIR": memory_dir,
+        "XINGLING_TAVILY_URL": f"http://127.0.0.1:{UPSTREAM_PORT}/tavily/search",
+        "XINGLING_SERPER_URL": f"http://127.0.0.1:{UPSTREAM_PORT}/serper/search",
+    })
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(BACKEND_PORT),
+         "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{BACKEND_PORT}/status", timeout=1).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            pass
+        if proc.poll() is not None:
+            raise RuntimeError("后端启动失败")
+        time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError("后端启动超时")
+
+
+class Recorder:
+    def __init__(self):
+        self.latency: Dict[str, List[float]] = {}
+        self.ttft: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.chars: Dict[str, int] = {}
+
+    def add(self, endpoint: str, latency: float, ttft: Optional[float], chars: int, ok: bool):
+        self.latency.setdefault(endpoint, []).append(latency)
+        if ttft is not None:
+            self.ttft.setdefault(endpoint, []).append(ttft)
+        self.chars[endpoint] = self.chars.get(endpoint, 0) + chars
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+
+async def read_stream(resp: httpx.Response, start: float):
+    """返回 (首个 content 帧的时间, 内容字数, 是否收到 error 帧)"""
+    ttft = None
+    chars = 0
+    failed = False
+    buffer = ""
+    async for text in resp.aiter_text():
+        buffer += text
+        *events, buffer = buffer.split("\n\n")
+        for event in events:
+            for line in event.split("\n"):
+                if not line.startswith("data: "):
+                    continue
+                frame = json.loads(line[6:])
+                if frame["type"] == "content":
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    chars += len(frame["content"])
+                elif frame["type"] == "error":
+                    failed = True
+    return ttft, chars, failed
+
+
+async def one_turn(client: httpx.AsyncClient, endpoint: str, session_id: str, turn: int,
+                   args, recorder: Recorder):
+    base = f"http://127.0.0.1:{BACKEND_PORT}"
+    common = {
+        "session_id": session_id,
+        "api_key": "mock",
+        "base_url": f"http://127.0.0.1:{UPSTREAM_PORT}/v1",
+        "model": "mock",
+    }
+    message = f"第 {turn} 轮：今天天气怎么样？顺便讲讲会话 {session_id} 的事"
+    if args.search:
+        common.update({"search_enabled": True, "search_provider": "tavily", "search_api_key": "mock"})
+    start = time.perf_counter()
+    ttft, chars, ok = None, 0, False
+    try:
+        if endpoint == "chat":
+            resp = await client.post(f"{base}/chat", json={**common, "message": message})
+            ok = resp.status_code == 200
+            chars = len(resp.json().get("reply", "")) if ok else 0
+        elif endpoint == "chat_stream":
+            async with client.stream("POST", f"{base}/chat_stream", json={**common, "message": message}) as resp:
+                ttft, chars, failed = await read_stream(resp, start)
+                ok = resp.status_code == 200 and not failed
+        else:
+            body = (f"会话 {session_id} 第 {turn} 次上传。" + "这是一段用于测试上传和分析的文本。" * 64 + "\n")
+            content = (body * max(args.upload_kb * 1024 // len(body.encode()), 1)).encode()
+            form = {k: str(v) for k, v in common.items()}
+            async with client.stream("POST", f"{base}/upload", data=form,
+                                     files={"file": (f"{session_id}-{turn}.txt", content, "text/plain")}) as resp:
+                ttft, chars, failed = await read_stream(resp, start)
+                ok = resp.status_code == 200 and not failed
+    except httpx.HTTPError:
+        ok = False
+    recorder.add(endpoint, time.perf_counter() - start, ttft, chars, ok)
+
+
+async def drive(args, recorder: Recorder) -> float:
+    endpoints = [e for e in args.endpoints.split(",") if e]
+    limits = httpx.Limits(max_connections=args.sessions * 2, max_keepalive_connections=args.sessions * 2)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        async def session(i: int):
+            for turn in range(args.turns):
+                await one_turn(client, endpoints[(i + turn) % len(endpoints)], f"load-{i}", turn, args, recorder)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[session(i) for i in range(args.sessions)])
+        return time.perf_counter() - start
+
+
+def fmt(seconds: Optional[float]) -> str:
+    return "-" if seconds is None else f"{seconds * 1000:.0f}ms"
+
+
+def build_report(recorder: Recorder, wall: float, rss: Dict[str, Optional[int]], upstream: MockConfig,
+                 args) -> Dict:
+    endpoints = {}
+    for endpoint, latencies in recorder.latency.items():
+        ttft = recorder.ttft.get(endpoint, [])
+        endpoints[endpoint] = {
+            "requests": len(latencies),
+            "errors": recorder.errors.get(endpoint, 0),
+            "latency_p50": percentile(latencies, 0.50),
+            "latency_p95": percentile(latencies, 0.95),
+            "latency_p99": percentile(latencies, 0.99),
+            "ttft_p50": percentile(ttft, 0.50),
+            "ttft_p95": percentile(ttft, 0.95),
+            "ttft_p99": percentile(ttft, 0.99),
+            "chars_per_second": recorder.chars.get(endpoint, 0) / wall if wall else 0.0,
+        }
+    total = sum(len(v) for v in recorder.latency.values())
+    return {
+        "config": {"sessions": args.sessions, "turns": args.turns, "endpoints": args.endpoints,
+                   "ttft": args.ttft, "tps": args.tps, "error_rate": args.error_rate},
+        "wall_seconds": wall,
+        "requests_per_second": total / wall if wall else 0.0,
+        "endpoints": endpoints,
+        "rss_bytes": rss,
+        "upstream": {"chat_requests": upstream.chat_requests, "errors_injected": upstream.errors_injected,
+                     "prompt_tokens": upstream.prompt_tokens, "cached_tokens": upstream.cached_tokens},
+    }
+
+
+def print_report(report: Dict):
+    cfg = report["config"]
+    print(f"{cfg['sessions']} 个会话 × {cfg['turns']} 轮，耗时 {report['wall_seconds']:.2f}s，"
+          f"吞吐 {report['requests_per_second']:.1f} 请求/秒")
+    print(f"{'接口':<12}{'请求':>6}{'错误':>6}{'p50':>9}{'p95':>9}{'p99':>9}"
+          f"{'首token p50':>13}{'p95':>9}{'p99':>9}{'字/秒':>10}")
+    for name, e in sorted(report["endpoints"].items()):
+        print(f"{name:<12}{e['requests']:>6}{e['errors']:>6}{fmt(e['latency_p50']):>9}{fmt(e['latency_p95']):>9}"
+              f"{fmt(e['latency_p99']):>9}{fmt(e['ttft_p50']):>13}{fmt(e['ttft_p95']):>9}{fmt(e['ttft_p99']):>9}"
+              f"{e['chars_per_second']:>10.0f}")
+    rss = report["rss_bytes"]
+    if rss.get("peak"):
+        mb = lambda v: f"{v / 1024 / 1024:.1f}MB" if v else "-"  # noqa: E731
+        print(f"后端 RSS：启动后 {mb(rss['start'])}，峰值 {mb(rss['peak'])}，结束时 {mb(rss['end'])}")
+    upstream = report["upstream"]
+    # 上游错误会先被客户端重试吸收，这里的注入次数可能多于上面的错误数
+    print(f"上游：收到 {upstream['chat_requests']} 次模型请求，注入错误 {upstream['errors_injected']} 次，"
+          f"前缀缓存命中 {upstream['cached_tokens'] / max(upstream['prompt_tokens'], 1):.0%} 的输入 token")
+
+
+def compare(report: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """返回超出容忍度的退化项"""
+    problems = []
+    for name, current in report["endpoints"].items():
+        before = baseline.get("endpoints", {}).get(name)
+        if not before:
+            continue
+        for key in ("latency_p95", "ttft_p95"):
+            if current.get(key) and before.get(key) and current[key] > before[key] * (1 + tolerance):
+                problems.append(f"{name} {key}: {fmt(before[key])} -> {fmt(current[key])}")
+    peak, old_peak = report["rss_bytes"].get("peak"), baseline.get("rss_bytes", {}).get("peak")
+    if peak and old_peak and peak > old_peak * (1 + tolerance):
+        problems.append(f"峰值 RSS: {old_peak / 1048576:.1f}MB -> {peak / 1048576:.1f}MB")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线并发负载测试")
+    parser.add_argument("--sessions", type=int, default=20, help="并发会话数")
+    parser.add_argument("--turns", type=int, default=5, help="每个会话的请求轮数")
+    parser.add_argument("--endpoints", default="chat,chat_stream,upload", help="轮流使用的接口，逗号分隔")
+    parser.add_argument("--search", action="store_true", help="开启联网搜索（走模拟搜索接口）")
+    parser.add_argument("--upload-kb", type=int, default=32, help="上传文件大小（KB）")
+    parser.add_argument("--ttft", type=float, default=0.1, help="模拟上游的首 token 延迟（秒）")
+    parser.add_argument("--tps", type=float, default=100.0, help="模拟上游每秒输出 token 数")
+    parser.add_argument("--reply-tokens", type=int, default=60)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟上游返回错误的比例")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--json", help="把结果写入这个文件")
+    parser.add_argument("--baseline", help="与之前 --json 保存的结果比较")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="允许的退化比例")
+    args = parser.parse_args()
+
+    mock = MockConfig(ttft=args.ttft, tokens_per_second=args.tps, reply_tokens=args.reply_tokens,
+                      error_rate=args.error_rate, seed=1)
+    upstream = serve_in_thread(create_app(mock), UPSTREAM_PORT)
+    memory_dir = tempfile.mkdtemp(prefix="xingling-load-")
+    backend = start_backend(memory_dir)
+    try:
+        rss = {"start": read_rss(backend.pid)}
+        sampler = RssSampler(backend.pid)
+        sampler.start()
+        recorder = Recorder()
+        wall = asyncio.run(drive(args, recorder))
+        sampler.stop()
+        rss.update(peak=sampler.peak or None, end=read_rss(backend.pid))
+    finally:
+        backend.terminate()
+        backend.wait(10)
+        upstream.should_exit = True
+
+    report = build_report(recorder, wall, rss, mock, args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            problems = compare(report, json.load(f), args.tolerance)
+        for problem in problems:
+            print(f"退化：{problem}")
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+# 杏铃酱 xingling-chat 基准测试：本地模拟 OpenAI 兼容服务
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+本地模拟的 OpenAI 兼容接口（/v1/chat/completions）和搜索接口（/tavily/search、/serper/search），
+完全离线，用于基准测试。搜索接口可通过 XINGLING_TAVILY_URL / XINGLING_SERPER_URL 指向这里。
+
+用户消息里包含 STALL_MARKER 时，该请求会卡住 stall_seconds 秒，用来模拟卡死的上游。
+可按比例注入错误：error_rate 的请求直接返回 error_status（默认 500），
+abort_rate 的流式请求输出一半后断开连接。
+
+返回的 usage 模拟 DeepSeek 的前缀缓存：与之前某个请求开头相同的若干条消息记为
+prompt_cache_hit_tokens（同时填 OpenAI 的 prompt_tokens_details.cached_tokens），
+流式请求带 stream_options.include_usage 时在最后一个 chunk 返回。
+
+单独运行：python bench/mock_upstream.py --port 9100 --ttft 0.3 --tps 50 --error-rate 0.05
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+STALL_MARKER = "[[stall]]"
+
+
+class MockConfig:
+    def __init__(self, ttft: float = 0.05, tokens_per_second: float = 200.0,
+                 reply_tokens: int = 40, stall_seconds: float = 10.0, search_latency: float = 0.2,
+                 error_rate: float = 0.0, error_status: int = 500, abort_rate: float = 0.0, seed: int = None):
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.stall_seconds = stall_seconds
+        self.search_latency = search_latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.abort_rate = abort_rate
+        self.random = random.Random(seed)
+        self.chat_requests = 0
+        self.errors_injected = 0
+        self.search_requests = 0
+        self.tokens_streamed = 0
+        self.streams_aborted = 0  # 客户端（也就是后端）中途断开的流
+        self.prefixes = set()  # 见过的消息前缀（按条累积的哈希）
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def usage(self, messages, completion_tokens: int) -> dict:
+        """按整条消息比较前缀：开头连续若干条与之前的请求相同就算命中缓存（token 数粗略按字数计）"""
+        digest = hashlib.sha256()
+        prompt = cached = 0
+        hit = True
+        for msg in messages:
+            digest.update(json.dumps(msg, ensure_ascii=False, sort_keys=True).encode())
+            key = digest.hexdigest()
+            tokens = len(str(msg.get("content", ""))) + 4
+            prompt += tokens
+            if hit and key in self.prefixes:
+                cached += tokens
+            else:
+                hit = False
+                self.prefixes.add(key)
+        self.prompt_tokens += prompt
+        self.cached_tokens += cached
+        return {
+            "prompt_tokens": prompt,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt + completion_tokens,
+            "prompt_cache_hit_tokens": cached,
+            "prompt_cache_miss_tokens": prompt - cached,
+            "prompt_tokens_details": {"cached_tokens": cached},
+        }
+
+
+def create_app(config: MockConfig = None) -> FastAPI:
+    config = config or MockConfig()
+    app = FastAPI(title="mock upstream")
+    app.state.config = config
+
+    @app.post("/v1/chat/completions")
+    @app.post("/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body.get("model", "mock")
+        last = body["messages"][-1]["content"] if body.get("messages") else ""
+        tokens = [f"杏{i} " for i in range(config.reply_tokens)]
+
+        config.chat_requests += 1
+        if STALL_MARKER in last:
+            await asyncio.sleep(config.stall_seconds)
+        await asyncio.sleep(config.ttft)
+        if config.error_rate and config.random.random() < config.error_rate:
+            config.errors_injected += 1
+            return JSONResponse({"error": {"message": "injected error", "type": "server_error"}},
+                                status_code=config.error_status)
+        abort_at = len(tokens) // 2 if config.abort_rate and config.random.random() < config.abort_rate else None
+        usage = config.usage(body.get("messages") or [], len(tokens))
+
+        if not body.get("stream"):
+            await asyncio.sleep(len(tokens) / config.tokens_per_second)
+            return JSONResponse({
+                "id": "mock-1",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+
+        async def stream():
+            sent = 0
+            try:
+                for i, tok in enumerate(tokens):
+                    if i == abort_at:
+                        config.errors_injected += 1
+                        raise ConnectionResetError("injected abort")
+                    chunk = {
+                        "id": "mock-1",
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": model,
+                        "choices": [{"index": 0, "delta": {"content": tok}, "finish_reason": None}],
+                    }
+                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                    sent += 1
+                    config.tokens_streamed += 1
+                    await asyncio.sleep(1 / config.tokens_per_second)
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    chunk = {"id": "mock-1", "object": "chat.completion.chunk", "created": int(time.time()),
+                             "model": model, "choices": [], "usage": usage}
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                yield "data: [DONE]\n\n"
+            finally:
+                if sent < len(tokens):
+                    config.streams_aborted += 1
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    def fake_results(query: str, count: int):
+        return [
+            {"title": f"关于「{query}」的结果 {i}", "content": f"{query} 的相关内容片段 {i}。", "url": f"https://example.com/{i}"}
+            for i in range(count)
+        ]
+
+    @app.post("/tavily/search")
+    async def tavily_search(request: Request):
+        body = await request.json()
+        config.search_requests += 1
+        await asyncio.sleep(config.search_latency)
+        return {"results": fake_results(body.get("query", ""), body.get("max_results", 3))}
+
+    @app.post("/serper/search")
+    async def serper_search(request: Request):
+        body = await request.json()
+        config.search_requests += 1
+        await asyncio.sleep(config.search_latency)
+        items = fake_results(body.get("q", ""), body.get("num", 3))
+        return {"organic": [{"title": r["title"], "snippet": r["content"], "link": r["url"]} for r in items]}
+
+    return app
+
+
+def serve_in_thread(app, port: int) -> uvicorn.Server:
+    """在后台线程里启动 uvicorn，返回 server（设置 server.should_exit = True 即可停止）"""
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.02)
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地模拟 OpenAI 兼容服务")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--ttft", type=float, default=0.05, help="首 token 延迟（秒）")
+    parser.add_argument("--tps", type=float, default=200.0, help="每秒输出 token 数")
+    parser.add_argument("--reply-tokens", type=int, default=40)
+    parser.add_argument("--stall", type=float, default=10.0, help="卡住请求的时长（秒）")
+    parser.add_argument("--search-latency", type=float, default=0.2, help="搜索接口延迟（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="直接返回错误的请求比例")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--abort-rate", type=float, default=0.0, help="流式输出中途断开的请求比例")
+    args = parser.parse_args()
+    uvicorn.run(create_app(MockConfig(args.ttft, args.tps, args.reply_tokens, args.stall, args.search_latency,
+                                      args.error_rate, args.error_status, args.abort_rate)),
+                host="127.0.0.1", port=args.port)
@@ -0,0 +1,74 @@
+# 杏铃酱 xingling-chat 基准测试：流式输出的写入次数和字节数
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+模拟上游按固定速率逐字输出（每个片段 1~2 个汉字），对比两种输出方式每条回复的写入次数
+（每次 yield 对应一次 ASGI send，基本就是一次 send 系统调用）、字节数和编码耗时：
+
+- 原来：每个片段一帧，json.dumps 且中文转成 \\uXXXX
+- 现在：sse.event_stream 按时间窗/字节数合并，带 id，UTF-8 原样输出
+
+运行：python bench/sse_framing.py --tps 60 --tokens 400
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sse  # noqa: E402
+
+SAMPLE = "杏铃酱今天也在认真地回答你的问题，这里是一段用来测试流式输出的中文文本。"
+
+
+async def fake_events(tokens: int, tps: float, seed: int = 1):
+    rng = random.Random(seed)
+    yield ("context", {"budget": 12000, "total": 345})
+    for i in range(tokens):
+        start = rng.randrange(len(SAMPLE) - 2)
+        yield ("content", SAMPLE[start:start + rng.choice((1, 2))])
+        await asyncio.sleep(1 / tps)
+
+
+async def legacy_stream(events):
+    async for frame_type, content in events:
+        yield f"data: {json.dumps({'type': frame_type, 'content': content})}\n\n"
+
+
+async def measure(stream):
+    writes = nbytes = 0
+    encode_start = time.process_time()
+    async for frame in stream:
+        writes += 1
+        nbytes += len(frame.encode("utf-8"))
+    return writes, nbytes, time.process_time() - encode_start
+
+
+async def main(args):
+    replies = []
+    for name, make in (
+        ("逐片段", lambda: legacy_stream(fake_events(args.tokens, args.tps))),
+        ("合并后", lambda: sse.event_stream(fake_events(args.tokens, args.tps), args.window_ms, args.max_bytes,
+                                           stats=sse.StreamStats())),
+    ):
+        writes, nbytes, cpu = await measure(make())
+        replies.append((name, writes, nbytes, cpu))
+
+    print(f"每条回复 {args.tokens} 个片段，{args.tps:g} 片段/秒，时间窗 {args.window_ms:g}ms / {args.max_bytes}B")
+    for name, writes, nbytes, cpu in replies:
+        print(f"  {name}: 写入 {writes} 次，{nbytes} 字节，CPU {cpu * 1000:.1f}ms")
+    (_, w0, b0, _), (_, w1, b1, _) = replies
+    print(f"  写入次数减少 {1 - w1 / w0:.0%}，字节数减少 {1 - b1 / b0:.0%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="流式输出合并效果")
+    parser.add_argument("--tokens", type=int, default=400)
+    parser.add_argument("--tps", type=float, default=60.0, help="上游每秒输出的片段数")
+    parser.add_argument("--window-ms", type=float, default=sse.SSE_WINDOW_MS)
+    parser.add_argument("--max-bytes", type=int, default=sse.SSE_MAX_BYTES)
+    asyncio.run(main(parser.parse_args()))
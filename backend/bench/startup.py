@@ -0,0 +1,141 @@
+# 杏铃酱 xingling-chat 基准测试：冷启动
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+测量后端的冷启动开销，每项都在新的子进程里跑 --runs 次，报告最小值和中位数：
+
+- 导入耗时：python -X importtime -c "import main"，同时列出累计耗时最多的几个模块
+- 首个 /status：从启动 uvicorn 子进程到 /status 第一次返回 200
+- 首个 /chat：/status 可用后立刻发一轮对话（上游是本进程里的模拟服务），
+  看懒加载的客户端有没有把开销挪到第一次对话上
+
+数据目录放在临时目录里，不碰真实会话。--json 保存结果，方便和之前的版本比较。
+
+运行：python bench/startup.py --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from bench.mock_upstream import MockConfig, create_app, serve_in_thread  # noqa: E402
+
+UPSTREAM_PORT = 9105
+BACKEND_PORT = 9106
+
+
+def _env() -> Dict[str, str]:
+    env = dict(os.environ)
+    env["XINGLING_MEMORY_DIR"] = tempfile.mkdtemp(prefix="xingling-startup-")
+    return env
+
+
+def measure_import() -> Tuple[float, List[Tuple[str, float]]]:
+    """返回 (import main 的秒数, [(模块, 累计秒数)])；模块只统计 main 直接或间接导入的顶层包"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                            cwd=BACKEND_DIR, env=_env(), capture_output=True, text=True, check=True)
+    total = 0.0
+    packages: Dict[str, float] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        seconds = int(cumulative) / 1e6
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        if name == "main" and depth == 0:
+            total = seconds
+        elif "." not in name:
+            packages[name] = max(packages.get(name, 0.0), seconds)
+    heaviest = sorted(packages.items(), key=lambda item: item[1], reverse=True)
+    return total, heaviest
+
+
+def measure_server() -> Tuple[float, float]:
+    """返回 (启动到首个 /status 的秒数, 随后第一轮 /chat 的秒数)"""
+    base = f"http://127.0.0.1:{BACKEND_PORT}"
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(BACKEND_PORT),
+         "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=_env(),
+    )
+    try:
+        with httpx.Client(timeout=30) as client:
+            while True:
+                if proc.poll() is not None:
+                    raise RuntimeError("后端启动失败")
+                try:
+                    if client.get(f"{base}/status").status_code == 200:
+                        break
+                except httpx.HTTPError:
+                    time.sleep(0.005)
+            first_status = time.perf_counter() - start
+            chat_start = time.perf_counter()
+            client.post(f"{base}/chat", json={
+                "session_id": "startup", "message": "你好", "api_key": "mock",
+                "base_url": f"http://127.0.0.1:{UPSTREAM_PORT}/v1", "model": "mock",
+            }).raise_for_status()
+            return first_status, time.perf_counter() - chat_start
+    finally:
+        proc.terminate()
+        proc.wait(10)
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {"min": min(values), "median": statistics.median(values)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="冷启动开销")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=8, help="列出累计导入耗时最多的模块数")
+    parser.add_argument("--json", help="把结果写入这个文件")
+    args = parser.parse_args()
+
+    upstream = serve_in_thread(create_app(MockConfig(ttft=0.0, tokens_per_second=10000)), UPSTREAM_PORT)
+    imports, statuses, chats = [], [], []
+    heaviest: List[Tuple[str, float]] = []
+    try:
+        for _ in range(args.runs):
+            total, heaviest = measure_import()
+            imports.append(total)
+            first_status, first_chat = measure_server()
+            statuses.append(first_status)
+            chats.append(first_chat)
+    finally:
+        upstream.should_exit = True
+
+    report = {
+        "runs": args.runs,
+        "import_main_seconds": summarize(imports),
+        "first_status_seconds": summarize(statuses),
+        "first_chat_seconds": summarize(chats),
+        "heaviest_imports": [{"module": name, "seconds": seconds} for name, seconds in heaviest[:args.top]],
+    }
+    print(f"{args.runs} 次，取最小值 / 中位数：")
+    for label, key in (("import main", "import_main_seconds"), ("首个 /status", "first_status_seconds"),
+                       ("首个 /chat", "first_chat_seconds")):
+        print(f"  {label:<12}{report[key]['min'] * 1000:>8.0f}ms {report[key]['median'] * 1000:>8.0f}ms")
+    print("累计导入耗时最多的模块（最后一次）：")
+    for item in report["heaviest_imports"]:
+        print(f"  {item['module']:<24}{item['seconds'] * 1000:>8.0f}ms")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+# 杏铃酱 xingling-chat 连接池
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+按 (api_key, base_url) 复用 OpenAI 客户端，避免每次请求都新建 HTTP 连接池。
+
+- 异步客户端（AsyncOpenAI）供 FastAPI 接口使用，同步客户端（OpenAI）只留给库调用
+- 每个客户端的 keep-alive 连接数有上限，客户端总数按 LRU 淘汰，长时间空闲的也会被淘汰
+- 被淘汰的客户端不会立刻关闭（可能还有流式响应在读），等过了宽限期再关闭
+- openai 包导入要大半秒，等第一次创建客户端时才导入，不拖慢启动
+"""
+import asyncio
+import importlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+import httpx
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI, OpenAI
+
+# ---------- 连接池配置（从环境变量读取）----------
+CLIENT_POOL_SIZE = int(os.getenv("XINGLING_CLIENT_POOL_SIZE", "16"))
+CLIENT_IDLE_TTL = float(os.getenv("XINGLING_CLIENT_IDLE_TTL", "600"))
+CLIENT_CLOSE_GRACE = float(os.getenv("XINGLING_CLIENT_CLOSE_GRACE", "120"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("XINGLING_HTTP_MAX_CONNECTIONS", "64"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("XINGLING_HTTP_MAX_KEEPALIVE", "16"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("XINGLING_HTTP_KEEPALIVE_EXPIRY", "30"))
+
+HTTP_LIMITS = httpx.Limits(
+    max_connections=HTTP_MAX_CONNECTIONS,
+    max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+)
+
+
+def preload():
+    """
+    在后台线程里提前导入 openai：服务启动不用等它，第一次对话也不用在事件循环里等导入。
+    XINGLING_PRELOAD=0 时不预加载（例如只跑一次性脚本）
+    """
+    if os.getenv("XINGLING_PRELOAD", "1") == "1":
+        threading.Thread(target=importlib.import_module, args=("openai",), daemon=True).start()
+
+
+class _ClientEntry:
+    __slots__ = ("client", "loop", "last_used")
+
+    def __init__(self, client: Any, loop: Optional[asyncio.AbstractEventLoop]):
+        self.client = client
+        self.loop = loop
+        self.last_used = time.monotonic()
+
+
+class ClientRegistry:
+    """
+    LRU 客户端注册表。键为 (api_key, base_url)；异步客户端还会绑定到创建它的事件循环，
+    换了事件循环（例如库调用里多次 asyncio.run）会重新创建。
+    """
+
+    def __init__(self, max_size: int = CLIENT_POOL_SIZE, idle_ttl: float = CLIENT_IDLE_TTL,
+                 close_grace: float = CLIENT_CLOSE_GRACE):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.close_grace = close_grace
+        self._lock = threading.Lock()
+        self._async: "OrderedDict[Tuple[str, str], _ClientEntry]" = OrderedDict()
+        self._sync: "OrderedDict[Tuple[str, str], _ClientEntry]" = OrderedDict()
+        self._retired: List[Tuple[float, _ClientEntry]] = []
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+
+    def get_async(self, api_key: str, base_url: str) -> "AsyncOpenAI":
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+        loop = asyncio.get_running_loop()
+        key = (api_key, base_url)
+        with self._lock:
+            entry = self._async.get(key)
+            if entry is not None and entry.loop is not loop:
+                self._retire(self._async.pop(key))
+                entry = None
+            if entry is None:
+                client = AsyncOpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    max_retries=0,  # 重试和故障转移由 upstream 负责
+                    http_client=DefaultAsyncHttpxClient(limits=HTTP_LIMITS),
+                )
+                entry = _ClientEntry(client, loop)
+                self._async[key] = entry
+                self.created += 1
+            else:
+                self._async.move_to_end(key)
+                self.reused += 1
+            entry.last_used = time.monotonic()
+            self._evict(self._async)
+            to_close = self._collect_retired()
+        for old in to_close:
+            self._close(old)
+        return entry.client
+
+    def get_sync(self, api_key: str, base_url: str) -> "OpenAI":
+        from openai import DefaultHttpxClient, OpenAI
+        key = (api_key, base_url)
+        with self._lock:
+            entry = self._sync.get(key)
+            if entry is None:
+                client = OpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    max_retries=0,  # 重试和故障转移由 upstream 负责
+                    http_client=DefaultHttpxClient(limits=HTTP_LIMITS),
+                )
+                entry = _ClientEntry(client, None)
+                self._sync[key] = entry
+                self.created += 1
+            else:
+                self._sync.move_to_end(key)
+                self.reused += 1
+            entry.last_used = time.monotonic()
+            self._evict(self._sync)
+            to_close = self._collect_retired()
+        for old in to_close:
+            self._close(old)
+        return entry.client
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "async_clients": len(self._async),
+                "sync_clients": len(self._sync),
+                "retired": len(self._retired),
+                "created": self.created,
+                "reused": self.reused,
+                "evicted": self.evicted,
+            }
+
+    async def aclose(self):
+        """关闭全部客户端（应用退出时调用）"""
+        with self._lock:
+            entries = list(self._async.values()) + list(self._sync.values())
+            entries += [entry for _, entry in self._retired]
+            self._async.clear()
+            self._sync.clear()
+            self._retired.clear()
+        for entry in entries:
+            try:
+                if entry.loop is None:
+                    entry.client.close()
+                elif entry.loop is asyncio.get_running_loop():
+                    await entry.client.close()
+            except Exception as e:
+                print(f"关闭客户端失败: {e}")
+
+    # 以下方法都在持有 self._lock 时调用
+    def _evict(self, pool: "OrderedDict[Tuple[str, str], _ClientEntry]"):
+        now = time.monotonic()
+        for key in [k for k, e in pool.items() if now - e.last_used > self.idle_ttl]:
+            self._retire(pool.pop(key))
+        while len(pool) > self.max_size:
+            _, entry = pool.popitem(last=False)
+            self._retire(entry)
+
+    def _retire(self, entry: _ClientEntry):
+        self.evicted += 1
+        self._retired.append((time.monotonic(), entry))
+
+    def _collect_retired(self) -> List[_ClientEntry]:
+        now = time.monotonic()
+        ready = [e for t, e in self._retired if now - t >= self.close_grace]
+        self._retired = [(t, e) for t, e in self._retired if now - t < self.close_grace]
+        return ready
+
+    @staticmethod
+    def _close(entry: _ClientEntry):
+        try:
+            if entry.loop is None:
+                entry.client.close()
+            elif not entry.loop.is_closed():
+                entry.loop.call_soon_threadsafe(lambda: entry.loop.create_task(entry.client.close()))
+        except Exception as e:
+            print(f"关闭客户端失败: {e}")
+
+
+registry = ClientRegistry()
+
+async def aclose_all():
+    """关闭所有池化的客户端（应用退出时调用）"""
+    await registry.aclose()
@@ -0,0 +1,221 @@
+# 杏铃酱 xingling-chat 上下文组装
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+按 token 预算组装请求上下文（chat_with_memory 和 chat_with_memory_stream 共用）。
+
+优先级：系统提示词 > 本轮用户消息 > 历史摘要 > 联网搜索结果 > 召回的旧对话（固定预算）
+> 历史消息（从新到旧装入，装不下为止）。
+每条消息的 token 数只计算一次，存在消息的 "tokens" 字段里随历史一起保存。
+
+token 数是本地估算（不依赖 tokenizer）：中日韩字符按 1 个 token、其他字符按 4 个字符 1 个 token 计，
+对 DeepSeek / OpenAI 的中文分词来说略偏保守。
+
+布局（XINGLING_PROMPT_LAYOUT）：
+- stable（默认）：让请求的开头在多轮之间保持不变，命中 DeepSeek / OpenAI 的前缀缓存。
+  系统提示词单独一条（所有会话共用），摘要单独一条（只在摘要滚动时变化），历史只在末尾追加；
+  历史装不下时按 HISTORY_DROP_STEP 条对齐地丢弃最旧的消息，而不是每轮往前滑一条；
+  召回和搜索结果这类每轮都变的内容放在最后，紧挨本轮用户消息
+- classic：原来的布局，摘要拼在系统提示词里，历史逐条滑动
+每轮实际命中缓存的 token 数由 cache_stats 统计（见 usage_from_response）。
+"""
+import json
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+
+# ---------- 预算配置（从环境变量读取）----------
+# 默认的上下文预算（不含回复）；XINGLING_CONTEXT_BUDGETS 可按模型覆盖，例如 {"deepseek-chat": 24000}
+DEFAULT_CONTEXT_BUDGET = int(os.getenv("XINGLING_CONTEXT_BUDGET", "12000"))
+MODEL_CONTEXT_BUDGETS: Dict[str, int] = {
+    "deepseek-chat": 24000,
+    "deepseek-reasoner": 24000,
+    "gpt-4o": 32000,
+    "gpt-4o-mini": 32000,
+}
+MODEL_CONTEXT_BUDGETS.update(json.loads(os.getenv("XINGLING_CONTEXT_BUDGETS", "{}")))
+
+RECALL_BUDGET_TOKENS = int(os.getenv("XINGLING_RECALL_BUDGET", "600"))
+
+PROMPT_LAYOUT = os.getenv("XINGLING_PROMPT_LAYOUT", "stable")
+HISTORY_DROP_STEP = int(os.getenv("XINGLING_HISTORY_DROP_STEP", "8"))  # 取偶数，整轮丢弃
+
+MESSAGE_OVERHEAD_TOKENS = 4  # 每条消息的角色、分隔符开销
+
+_CJK_RE = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef\u3000-\u303f]")
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def message_tokens(msg: Dict) -> int:
+    """返回消息的 token 数，没有缓存时计算并写回 msg["tokens"]"""
+    tokens = msg.get("tokens")
+    if tokens is None:
+        tokens = msg["tokens"] = estimate_tokens(msg["content"]) + MESSAGE_OVERHEAD_TOKENS
+    return tokens
+
+
+def make_message(role: str, content: str) -> Dict:
+    """构造要写入历史的消息，同时算好 token 数"""
+    msg = {"role": role, "content": content}
+    message_tokens(msg)
+    return msg
+
+
+def budget_for_model(model: str) -> int:
+    return MODEL_CONTEXT_BUDGETS.get(model, DEFAULT_CONTEXT_BUDGET)
+
+
+def build_context(
+    history: List[Dict],
+    summary: str,
+    search_result: Optional[str],
+    user_message: str,
+    system_prompt: str,
+    budget: int,
+    recall: Optional[List[str]] = None,
+    layout: str = PROMPT_LAYOUT,
+) -> Tuple[List[Dict], Dict]:
+    """
+    返回 (messages, report)。messages 的结构：
+    stable：system → 摘要(system) → 历史 → 召回的旧对话(system) → 搜索结果(system) → 本轮用户消息；
+    classic：system(+摘要) → 历史 → 召回的旧对话(system) → 搜索结果(system) → 本轮用户消息。
+    report 记录预算和各部分实际占用的 token 数，prefix 为多轮之间保持不变、可以命中前缀缓存的部分。
+    """
+    stable = layout == "stable"
+    summary_content = f"历史摘要：{summary}" if summary else None
+    system_content = f"{system_prompt}\n\n{summary_content}" if summary and not stable else system_prompt
+    search_content = f"联网搜索结果（供参考）：\n{search_result}" if search_result is not None else None
+
+    system_tokens = estimate_tokens(system_prompt) + MESSAGE_OVERHEAD_TOKENS
+    user_tokens = estimate_tokens(user_message) + MESSAGE_OVERHEAD_TOKENS
+    if not summary:
+        summary_tokens = 0
+    elif stable:
+        summary_tokens = estimate_tokens(summary_content) + MESSAGE_OVERHEAD_TOKENS
+    else:
+        summary_tokens = estimate_tokens(system_content) + MESSAGE_OVERHEAD_TOKENS - system_tokens
+    search_tokens = estimate_tokens(search_content) + MESSAGE_OVERHEAD_TOKENS if search_content else 0
+
+    remaining = budget - system_tokens - user_tokens
+    if summary_tokens > remaining:
+        # 连摘要都放不下时（例如用户消息本身就很长），只保留系统提示词
+        system_content, summary_content, summary_tokens = system_prompt, None, 0
+    remaining -= summary_tokens
+    if search_tokens > remaining:
+        search_content, search_tokens = None, 0
+    remaining -= search_tokens
+
+    recall_lines: List[str] = []
+    recall_tokens = 0
+    if recall:
+        recall_budget = min(RECALL_BUDGET_TOKENS, remaining)
+        used = estimate_tokens("相关的早期对话（供参考）：") + MESSAGE_OVERHEAD_TOKENS
+        for line in recall:
+            tokens = estimate_tokens(line) + 1
+            if used + tokens > recall_budget:
+                break
+            recall_lines.append(line)
+            used += tokens
+        if recall_lines:
+            recall_tokens = used
+    remaining -= recall_tokens
+
+    start = len(history)
+    history_tokens = 0
+    while start > 0 and message_tokens(history[start - 1]) <= remaining - history_tokens:
+        start -= 1
+        history_tokens += message_tokens(history[start])
+    if stable and 0 < start < len(history) and HISTORY_DROP_STEP > 1:
+        # 对齐到 HISTORY_DROP_STEP：接下来几轮历史的起点不变，前缀缓存仍然有效
+        aligned = min(-(-start // HISTORY_DROP_STEP) * HISTORY_DROP_STEP, len(history))
+        history_tokens -= sum(message_tokens(msg) for msg in history[start:aligned])
+        start = aligned
+    selected = [{"role": msg["role"], "content": msg["content"]} for msg in history[start:]]
+
+    messages = [{"role": "system", "content": system_content}]
+    if stable and summary_content is not None:
+        messages.append({"role": "system", "content": summary_content})
+    messages.extend(selected)
+    if recall_lines:
+        messages.append({"role": "system", "content": "相关的早期对话（供参考）：\n" + "\n".join(recall_lines)})
+    if search_content is not None:
+        messages.append({"role": "system", "content": search_content})
+    messages.append({"role": "user", "content": user_message})
+
+    report = {
+        "budget": budget,
+        "system": system_tokens,
+        "summary": summary_tokens,
+        "search": search_tokens,
+        "recall": recall_tokens,
+        "history": history_tokens,
+        "user": user_tokens,
+        "total": system_tokens + summary_tokens + search_tokens + recall_tokens + history_tokens + user_tokens,
+        "layout": "stable" if stable else "classic",
+        "prefix": system_tokens + summary_tokens + history_tokens,
+        "history_messages": len(selected),
+        "dropped_messages": len(history) - len(selected),
+        "search_dropped": search_result is not None and search_content is None,
+        "recall_snippets": len(recall_lines),
+    }
+    return messages, report
+
+
+def usage_from_response(usage) -> Optional[Dict]:
+    """
+    从接口返回的 usage 里取出本轮用量：prompt / completion / cached（命中前缀缓存的输入 token）/ reasoning。
+    DeepSeek 用 prompt_cache_hit_tokens，OpenAI 用 prompt_tokens_details.cached_tokens；没有 usage 时返回 None
+    """
+    if usage is None:
+        return None
+
+    def field(obj, name):
+        if obj is None:
+            return None
+        return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+
+    cached = field(usage, "prompt_cache_hit_tokens")
+    if cached is None:
+        cached = field(field(usage, "prompt_tokens_details"), "cached_tokens")
+    return {
+        "prompt": field(usage, "prompt_tokens") or 0,
+        "completion": field(usage, "completion_tokens") or 0,
+        "cached": cached or 0,
+        "reasoning": field(field(usage, "completion_tokens_details"), "reasoning_tokens") or 0,
+    }
+
+
+class CacheStats:
+    """按模型累计输入 token 和命中前缀缓存的 token，用来核对布局的实际命中率"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.models: Dict[str, List[int]] = {}  # model -> [轮数, prompt, cached]
+
+    def record(self, model: str, usage: Dict):
+        with self._lock:
+            entry = self.models.setdefault(model, [0, 0, 0])
+            entry[0] += 1
+            entry[1] += usage["prompt"]
+            entry[2] += usage["cached"]
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "layout": PROMPT_LAYOUT,
+                "models": {
+                    model: {"turns": turns, "prompt_tokens": prompt, "cached_tokens": cached,
+                            "hit_rate": round(cached / prompt, 3) if prompt else 0.0}
+                    for model, (turns, prompt, cached) in self.models.items()
+                },
+            }
+
+
+cache_stats = CacheStats()
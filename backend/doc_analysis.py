@@ -0,0 +1,165 @@
+# 杏铃酱 xingling-chat 长文档分析
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+长文档的 map-reduce 分析，取代原来截取前 10000 字的做法。
+
+- 全文不超过 DOC_DIRECT_TOKENS 时原样交给对话
+- 否则按 token 数切块（map），每块并发地围绕用户的要求提取要点（受 DOC_CONCURRENCY 限制），
+  要点总量仍然太大时再分组合并一层，最后把各段要点交给流式对话生成最终回答（reduce）
+- 分段要点按 (文档 SHA-256, 要求) 缓存，同一文件带同样的要求再问时跳过 map
+"""
+import asyncio
+import os
+import threading
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from context_builder import estimate_tokens
+
+# ---------- 文档分析配置（从环境变量读取）----------
+DOC_CHUNK_TOKENS = int(os.getenv("XINGLING_DOC_CHUNK_TOKENS", "3000"))
+DOC_DIRECT_TOKENS = int(os.getenv("XINGLING_DOC_DIRECT_TOKENS", "6000"))
+DOC_NOTES_TOKENS = int(os.getenv("XINGLING_DOC_NOTES_TOKENS", "6000"))
+DOC_CONCURRENCY = int(os.getenv("XINGLING_DOC_CONCURRENCY", "4"))
+DOC_CACHE_SIZE = int(os.getenv("XINGLING_DOC_CACHE_SIZE", "64"))
+
+DEFAULT_INSTRUCTION = "请分析以下文件内容"
+DOC_SYSTEM_PROMPT = "你是一个细致的文档分析助手。"
+
+AsyncComplete = Callable[[List[Dict]], Awaitable[str]]
+
+
+def chunk_by_tokens(text: str, max_tokens: int = DOC_CHUNK_TOKENS) -> List[str]:
+    """按行累积到 max_tokens 切块；单行过长时按字数拆开（一个字最多算一个 token）"""
+    chunks: List[str] = []
+    current: List[str] = []
+    size = 0
+    for line in text.splitlines():
+        pieces = [line[i:i + max_tokens] for i in range(0, len(line), max_tokens)] or [""]
+        for piece in pieces:
+            tokens = estimate_tokens(piece) + 1
+            if current and size + tokens > max_tokens:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            current.append(piece)
+            size += tokens
+    if current:
+        chunks.append("\n".join(current))
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def build_map_request(instruction: str, filename: str, index: int, total: int, text: str) -> List[Dict]:
+    prompt = (
+        f"用户上传了文件《{filename}》，要求是：{instruction}\n"
+        f"文件较长，下面是第 {index + 1}/{total} 段。请围绕用户的要求提取这一段中的要点，"
+        f"保留关键事实、数字、条款和结论，不要编造，与要求无关的内容可以略过：\n\n{text}"
+    )
+    return [
+        {"role": "system", "content": DOC_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def build_combine_request(instruction: str, notes: str) -> List[Dict]:
+    prompt = (
+        f"下面是同一份文件相邻几段的要点，用户的要求是：{instruction}\n"
+        f"请把它们合并成一份更精炼的要点，保留关键事实、数字和结论：\n\n{notes}"
+    )
+    return [
+        {"role": "system", "content": DOC_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def direct_message(filename: str, instruction: str, text: str) -> str:
+    return f"{instruction}（文件名：{filename}）：\n\n{text}"
+
+
+def notes_message(filename: str, instruction: str, notes: List[str]) -> str:
+    """reduce 阶段的用户消息：各段要点 + 原始要求"""
+    sections = "\n\n".join(f"【第 {i + 1} 段要点】\n{note}" for i, note in enumerate(notes))
+    return (
+        f"{instruction}（文件名：{filename}）\n\n"
+        f"文件较长，已分段提取要点如下：\n\n{sections}\n\n"
+        "请基于以上要点完成上面的要求。"
+    )
+
+
+async def amap_chunks(chunks: List[str], instruction: str, filename: str, complete: AsyncComplete,
+                      concurrency: int = DOC_CONCURRENCY) -> AsyncIterator[Tuple[int, Optional[str]]]:
+    """并发提取各段要点，按完成顺序产出 (段号, 要点)；失败的段要点为 None"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def map_one(index: int) -> Tuple[int, Optional[str]]:
+        async with semaphore:
+            try:
+                return index, await complete(build_map_request(instruction, filename, index, len(chunks), chunks[index]))
+            except Exception as e:
+                print(f"文档分段分析失败（第 {index + 1} 段）: {e}")
+                return index, None
+
+    tasks = [asyncio.ensure_future(map_one(i)) for i in range(len(chunks))]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def areduce_notes(notes: List[str], instruction: str, complete: AsyncComplete,
+                        max_tokens: int = DOC_NOTES_TOKENS, concurrency: int = DOC_CONCURRENCY) -> List[str]:
+    """要点总量超过 max_tokens 时分组合并，直到放得进最终的对话"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def combine(text: str) -> str:
+        async with semaphore:
+            return await complete(build_combine_request(instruction, text))
+
+    while len(notes) > 1 and sum(estimate_tokens(note) for note in notes) > max_tokens:
+        groups = chunk_by_tokens("\n\n".join(notes), max(max_tokens // 2, DOC_CHUNK_TOKENS))
+        if len(groups) >= len(notes):
+            break
+        notes = list(await asyncio.gather(*[combine(group) for group in groups]))
+    return notes
+
+
+class NotesCache:
+    """(文档 SHA-256, 要求) -> 分段要点 的 LRU 缓存（线程安全）"""
+
+    def __init__(self, max_size: int = DOC_CACHE_SIZE):
+        self.max_size = max_size
+        self._data: "OrderedDict[Tuple[str, str], List[str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(digest: str, instruction: str) -> Tuple[str, str]:
+        return digest, " ".join(instruction.split())
+
+    def get(self, digest: str, instruction: str) -> Optional[List[str]]:
+        with self._lock:
+            notes = self._data.get(self.key(digest, instruction))
+            if notes is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(self.key(digest, instruction))
+            self.hits += 1
+            return notes
+
+    def put(self, digest: str, instruction: str, notes: List[str]):
+        with self._lock:
+            key = self.key(digest, instruction)
+            self._data[key] = notes
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"documents": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+notes_cache = NotesCache()
@@ -0,0 +1,502 @@
+# 杏铃酱 xingling-chat 上传文件处理
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+上传文件的落盘和文本提取。
+
+- 上传的 multipart 表单直接从请求体流式解析（receive_upload），文件按块写入临时文件，边写边算 SHA-256，
+  超过 UPLOAD_MAX_BYTES 立即中止（UploadTooLarge），不会先把整个请求体落盘
+- PDF 按页分段，交给进程池并行提取（PyPDF2 是纯 Python，线程池受 GIL 限制）；
+  页数少的 PDF、.docx 和 .txt 在线程里处理，都不占用事件循环
+- 提取结果按 (内容的 SHA-256, 扩展名, 提取函数, EXTRACT_CACHE_VERSION) 缓存：内存里一个按字符数限额的 LRU，
+  磁盘上每个文档一个 .txt，同一份文件重复上传（哪怕换了文件名）直接跳过提取；换了提取函数或提取逻辑
+  （升 EXTRACT_CACHE_VERSION）后旧结果自然失效。磁盘缓存超过 EXTRACT_DISK_MAX_MB 或文件超过
+  EXTRACT_DISK_MAX_DAYS 天没用过时按最久未用淘汰；清空会话时删除该会话上传过的文档的缓存（forget）
+- 支持的格式是一张按扩展名登记的插件表（register_format）：解析库在第一次用到时才导入，
+  不拖慢启动。提取函数可以直接给函数，也可以给 "模块:函数" 字符串（连模块本身都等到用时再导入），
+  XINGLING_EXTRACTORS 可以用 JSON 追加，例如 {".md": "file_ingest:_extract_txt"}。
+  内置格式用函数登记，PyInstaller 才能分析到依赖
+"""
+import asyncio
+import hashlib
+import importlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Dict, List, Optional, Union
+
+import metrics
+
+# ---------- 上传与提取配置（从环境变量读取）----------
+UPLOAD_MAX_BYTES = int(float(os.getenv("XINGLING_UPLOAD_MAX_MB", "50")) * 1024 * 1024)
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+FORM_FIELDS_MAX_BYTES = 256 * 1024  # 上传表单里文件以外的字段（提示词、要求等）的总长度上限
+EXTRACT_WORKERS = int(os.getenv("XINGLING_EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+EXTRACT_PAGES_PER_TASK = int(os.getenv("XINGLING_EXTRACT_PAGES_PER_TASK", "16"))
+EXTRACT_CACHE_CHARS = int(os.getenv("XINGLING_EXTRACT_CACHE_CHARS", str(8 * 1024 * 1024)))
+EXTRACT_DISK_MAX_BYTES = int(float(os.getenv("XINGLING_EXTRACT_DISK_MAX_MB", "200")) * 1024 * 1024)
+EXTRACT_DISK_MAX_DAYS = float(os.getenv("XINGLING_EXTRACT_DISK_MAX_DAYS", "30"))
+EXTRACT_CACHE_VERSION = 1  # 内置提取逻辑有变化时加一，让旧的缓存失效
+
+UNSUPPORTED_FORMAT = "（不支持的文件格式）"
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, limit: int):
+        super().__init__(f"文件超过大小上限（{limit / (1024 * 1024):g} MB）")
+        self.limit = limit
+
+
+class UploadFormError(ValueError):
+    """上传请求不是合法的 multipart 表单，或缺少文件"""
+
+
+class ReceivedUpload:
+    """receive_upload 的结果：表单里的普通字段，和写到临时文件里的那个文件"""
+    __slots__ = ("fields", "filename", "path", "digest", "size")
+
+    def __init__(self, fields: Dict[str, str], filename: str, path: str, digest: str, size: int):
+        self.fields = fields
+        self.filename = filename
+        self.path = path
+        self.digest = digest
+        self.size = size
+
+
+def _multipart():
+    # FastAPI 的表单依赖 python-multipart；新版本的模块名是 python_multipart，旧版本是 multipart
+    try:
+        from python_multipart.multipart import MultipartParser, parse_options_header
+    except ImportError:
+        from multipart.multipart import MultipartParser, parse_options_header
+    return MultipartParser, parse_options_header
+
+
+async def receive_upload(content_type: str, body: AsyncIterator[bytes], file_field: str = "file",
+                         max_bytes: int = UPLOAD_MAX_BYTES) -> ReceivedUpload:
+    """
+    直接从请求体（request.stream()）解析 multipart 表单：file_field 这个文件按块写入临时文件，边写边算 SHA-256，
+    超过 max_bytes 立即中止（UploadTooLarge），不会先把整个请求体落盘再检查；其他字段收在内存里
+    （总共不超过 FORM_FIELDS_MAX_BYTES）。表单不合法或没有文件时抛出 UploadFormError
+    """
+    MultipartParser, parse_options_header = _multipart()
+    kind, options = parse_options_header(content_type)
+    if kind != b"multipart/form-data" or b"boundary" not in options:
+        raise UploadFormError("请求需要是 multipart/form-data 表单")
+
+    fields: Dict[str, str] = {}
+    state = {"header_field": b"", "header_value": b"", "name": None, "filename": None, "buffer": None,
+             "field_bytes": 0, "size": 0, "tmp": None, "upload_name": None}
+    digest = hashlib.sha256()
+
+    def on_part_begin():
+        state.update(header_field=b"", header_value=b"", name=None, filename=None, buffer=None)
+
+    def on_header_field(data, start, end):
+        state["header_field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        state["header_value"] += data[start:end]
+
+    def on_header_end():
+        if state["header_field"].lower() == b"content-disposition":
+            _, params = parse_options_header(state["header_value"])
+            state["name"] = params.get(b"name", b"").decode("utf-8", "replace")
+            if b"filename" in params:
+                state["filename"] = params[b"filename"].decode("utf-8", "replace")
+        state["header_field"], state["header_value"] = b"", b""
+
+    def on_headers_finished():
+        if state["name"] == file_field and state["filename"] is not None:
+            if state["tmp"] is not None:
+                raise UploadFormError(f"表单里只能有一个 {file_field}")
+            state["tmp"] = tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(state["filename"])[1])
+            state["upload_name"] = state["filename"]
+        elif state["filename"] is None:
+            state["buffer"] = bytearray()
+        # 其他文件字段直接丢弃
+
+    def on_part_data(data, start, end):
+        chunk = data[start:end]
+        if state["name"] == file_field and state["filename"] is not None:
+            state["size"] += len(chunk)
+            if state["size"] > max_bytes:
+                raise UploadTooLarge(max_bytes)
+            digest.update(chunk)
+            state["tmp"].write(chunk)
+        elif state["buffer"] is not None:
+            state["field_bytes"] += len(chunk)
+            if state["field_bytes"] > FORM_FIELDS_MAX_BYTES:
+                raise UploadFormError("表单字段过长")
+            state["buffer"] += chunk
+
+    def on_part_end():
+        if state["buffer"] is not None and state["name"]:
+            fields[state["name"]] = state["buffer"].decode("utf-8", "replace")
+
+    parser = MultipartParser(options[b"boundary"], {
+        "on_part_begin": on_part_begin, "on_part_data": on_part_data, "on_part_end": on_part_end,
+        "on_header_field": on_header_field, "on_header_value": on_header_value,
+        "on_header_end": on_header_end, "on_headers_finished": on_headers_finished,
+    })
+    try:
+        async for chunk in body:
+            # 解析和写文件都在线程里做，不占用事件循环
+            await asyncio.to_thread(parser.write, chunk)
+        parser.finalize()
+        if state["tmp"] is None:
+            raise UploadFormError(f"缺少上传文件（表单字段 {file_field}）")
+        state["tmp"].close()
+    except BaseException as e:
+        if state["tmp"] is not None:
+            state["tmp"].close()
+            os.unlink(state["tmp"].name)
+        if isinstance(e, (UploadTooLarge, UploadFormError)) or not isinstance(e, Exception):
+            raise
+        raise UploadFormError(f"表单解析失败: {e}") from e
+    return ReceivedUpload(fields, state["upload_name"], state["tmp"].name, digest.hexdigest(), state["size"])
+
+
+def file_digest(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _pdf_page_count(file_path: str) -> int:
+    import PyPDF2
+    with open(file_path, "rb") as f:
+        return len(PyPDF2.PdfReader(f).pages)
+
+
+def _extract_pdf_pages(file_path: str, start: int, end: int) -> str:
+    """提取 [start, end) 页的文本；在子进程里运行，所以自己打开文件"""
+    import PyPDF2
+    with open(file_path, "rb") as f:
+        reader = PyPDF2.PdfReader(f)
+        return "".join((reader.pages[i].extract_text() or "") + "\n" for i in range(start, end))
+
+
+def _extract_docx(file_path: str) -> str:
+    import docx
+    doc = docx.Document(file_path)
+    return "\n".join([para.text for para in doc.paragraphs])
+
+
+def _extract_txt(file_path: str) -> str:
+    with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
+        return f.read()
+
+
+Target = Union[Callable, str]
+
+
+def _target_name(target: Optional[Target]) -> str:
+    if target is None or isinstance(target, str):
+        return target or ""
+    return f"{getattr(target, '__module__', '')}:{getattr(target, '__qualname__', repr(target))}"
+
+
+def _resolve(target: Target) -> Callable:
+    if callable(target):
+        return target
+    module, _, attr = target.partition(":")
+    return getattr(importlib.import_module(module), attr)
+
+
+class FileFormat:
+    """
+    一种文件格式的提取方式。extract(path) 返回全文；支持分页的格式（PDF）另外给出
+    page_count(path) 和 extract_pages(path, start, end)，长文档会按页分段并行提取
+    """
+
+    def __init__(self, extract: Optional[Target] = None, page_count: Optional[Target] = None,
+                 extract_pages: Optional[Target] = None):
+        if extract is None and (page_count is None or extract_pages is None):
+            raise ValueError("需要 extract，或者 page_count 加 extract_pages")
+        self._targets = {"extract": extract, "page_count": page_count, "extract_pages": extract_pages}
+        self._resolved: Dict[str, Callable] = {}
+
+    def _get(self, name: str) -> Optional[Callable]:
+        func = self._resolved.get(name)
+        if func is None and self._targets[name] is not None:
+            func = self._resolved[name] = _resolve(self._targets[name])
+        return func
+
+    @property
+    def signature(self) -> str:
+        """提取方式的标识，作为缓存键的一部分：换了提取函数后旧的缓存不再命中"""
+        return ",".join(_target_name(self._targets[name]) for name in ("extract", "page_count", "extract_pages"))
+
+    @property
+    def paged(self) -> bool:
+        return self._targets["page_count"] is not None and self._targets["extract_pages"] is not None
+
+    def page_count(self, file_path: str) -> int:
+        return self._get("page_count")(file_path)
+
+    def extract_pages(self, file_path: str, start: int, end: int) -> str:
+        return self._get("extract_pages")(file_path, start, end)
+
+    def extract(self, file_path: str) -> str:
+        func = self._get("extract")
+        if func is not None:
+            return func(file_path)
+        return self.extract_pages(file_path, 0, self.page_count(file_path))
+
+
+_formats: Dict[str, FileFormat] = {}
+_formats_lock = threading.Lock()
+_env_loaded = False
+
+
+def register_format(ext: str, extract: Optional[Target] = None, *, page_count: Optional[Target] = None,
+                    extract_pages: Optional[Target] = None):
+    """登记（或替换）一种扩展名的提取方式，ext 形如 ".md"；之后上传的该类文件都会用它提取"""
+    file_format = FileFormat(extract, page_count, extract_pages)
+    with _formats_lock:
+        _formats[ext.lower()] = file_format
+
+
+def _load_env_formats():
+    global _env_loaded
+    with _formats_lock:
+        if _env_loaded:
+            return
+        _env_loaded = True
+    for ext, target in json.loads(os.getenv("XINGLING_EXTRACTORS", "{}")).items():
+        register_format(ext, target)
+
+
+def get_format(file_path: str) -> Optional[FileFormat]:
+    _load_env_formats()
+    return _formats.get(os.path.splitext(file_path)[1].lower())
+
+
+def supported_formats() -> List[str]:
+    _load_env_formats()
+    return sorted(_formats)
+
+
+register_format(".txt", _extract_txt)
+register_format(".pdf", page_count=_pdf_page_count, extract_pages=_extract_pdf_pages)
+register_format(".docx", _extract_docx)
+
+
+def extract_text(file_path: str) -> str:
+    """根据文件扩展名提取文本内容（同步，不用缓存和进程池）"""
+    file_format = get_format(file_path)
+    if file_format is None:
+        return UNSUPPORTED_FORMAT
+    return file_format.extract(file_path)
+
+
+def cache_key(digest: str, ext: str, file_format: FileFormat) -> str:
+    """提取结果的缓存键：内容哈希 + 扩展名 + 提取方式 + 版本"""
+    raw = f"{EXTRACT_CACHE_VERSION}|{ext}|{file_format.signature}|{digest}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class Extractor:
+    """
+    带缓存的异步提取器；cache_dir 为 None 时只用内存缓存。
+    磁盘缓存的 owners/ 子目录按会话（文件名是会话 ID 的哈希）记录上传过的文档的缓存键，供 forget 删除
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, workers: int = EXTRACT_WORKERS,
+                 cache_chars: int = EXTRACT_CACHE_CHARS, disk_max_bytes: int = EXTRACT_DISK_MAX_BYTES,
+                 disk_max_days: float = EXTRACT_DISK_MAX_DAYS):
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.cache_chars = cache_chars
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_max_age = disk_max_days * 86400
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        self._cached_chars = 0
+        self._lock = threading.Lock()
+        self._pool: Optional[Executor] = None
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    # ---------- 缓存 ----------
+    def _cache_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.txt")
+
+    def _owner_path(self, owner: str) -> str:
+        return os.path.join(self.cache_dir, "owners", hashlib.sha1(owner.encode("utf-8")).hexdigest())
+
+    def _remember(self, digest: str, text: str):
+        with self._lock:
+            if digest in self._cache:
+                return
+            self._cache[digest] = text
+            self._cached_chars += len(text)
+            while self._cached_chars > self.cache_chars and len(self._cache) > 1:
+                _, old = self._cache.popitem(last=False)
+                self._cached_chars -= len(old)
+
+    def cached(self, key: str) -> Optional[str]:
+        with self._lock:
+            text = self._cache.get(key)
+            if text is not None:
+                self._cache.move_to_end(key)
+                return text
+        if self.cache_dir is None:
+            return None
+        path = self._cache_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+            os.utime(path)  # 修改时间当作最近使用时间，淘汰时按它排序
+        except FileNotFoundError:
+            return None
+        self._remember(key, text)
+        return text
+
+    def _store(self, key: str, text: str):
+        self._remember(key, text)
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._cache_path(key)
+        tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+        self._prune()
+
+    def _prune(self):
+        """删除超过 disk_max_age 没用过的缓存，总量仍超过 disk_max_bytes 时从最久未用的开始删"""
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(".txt"):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.name))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        cutoff = time.time() - self.disk_max_age
+        for mtime, size, name in entries:
+            if mtime >= cutoff and total <= self.disk_max_bytes:
+                break
+            self._drop(name[:-len(".txt")])
+            total -= size
+            self.evicted += 1
+
+    def _drop(self, key: str):
+        with self._lock:
+            text = self._cache.pop(key, None)
+            if text is not None:
+                self._cached_chars -= len(text)
+        if self.cache_dir is not None:
+            try:
+                os.unlink(self._cache_path(key))
+            except FileNotFoundError:
+                pass
+
+    def _note_owner(self, owner: str, key: str):
+        if self.cache_dir is None:
+            return
+        path = self._owner_path(owner)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(key + "\n")
+
+    def forget(self, owner: str) -> int:
+        """删除 owner（会话）上传过的文档的提取缓存，返回删除的条数。别的会话上传过同一文档时，下次重新提取"""
+        if self.cache_dir is None:
+            return 0
+        path = self._owner_path(owner)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                keys = set(f.read().split())
+        except FileNotFoundError:
+            return 0
+        for key in keys:
+            self._drop(key)
+        os.unlink(path)
+        return len(keys)
+
+    # ---------- 提取 ----------
+    def _executor(self) -> Executor:
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    # 打包后的 exe 里不方便再起子进程，退回线程池
+                    pool_cls = ThreadPoolExecutor if getattr(sys, "frozen", False) else ProcessPoolExecutor
+                    self._pool = pool_cls(max_workers=self.workers)
+        return self._pool
+
+    async def _extract_paged(self, file_format: FileFormat, file_path: str) -> str:
+        pages = await asyncio.to_thread(file_format.page_count, file_path)
+        if pages <= EXTRACT_PAGES_PER_TASK or self.workers <= 1:
+            return await asyncio.to_thread(file_format.extract_pages, file_path, 0, pages)
+        loop = asyncio.get_running_loop()
+        pool = self._executor()
+        # 交给进程池的是解析出来的模块级函数本身（可以 pickle），不是 FileFormat 对象
+        extract_pages = file_format._get("extract_pages")
+        parts: List[str] = await asyncio.gather(*[
+            loop.run_in_executor(pool, extract_pages, file_path, start, min(start + EXTRACT_PAGES_PER_TASK, pages))
+            for start in range(0, pages, EXTRACT_PAGES_PER_TASK)
+        ])
+        return "".join(parts)
+
+    async def aextract(self, file_path: str, digest: Optional[str] = None, owner: Optional[str] = None) -> str:
+        """
+        提取文本；digest 为文件内容的 SHA-256（不传则现算），命中缓存时不再解析文件。
+        owner（会话 ID）用来在清空会话时删除对应的缓存
+        """
+        ext = os.path.splitext(file_path)[1].lower()
+        file_format = get_format(file_path)
+        if file_format is None:
+            return UNSUPPORTED_FORMAT
+        start = time.perf_counter()
+        if digest is None:
+            digest = await asyncio.to_thread(file_digest, file_path)
+        key = cache_key(digest, ext, file_format)
+        if owner is not None:
+            await asyncio.to_thread(self._note_owner, owner, key)
+        text = await asyncio.to_thread(self.cached, key)
+        if text is not None:
+            self.hits += 1
+            metrics.EXTRACT_SECONDS.labels(format=ext, cached="true").observe(time.perf_counter() - start)
+            return text
+        self.misses += 1
+
+        if file_format.paged:
+            text = await self._extract_paged(file_format, file_path)
+        else:
+            text = await asyncio.to_thread(file_format.extract, file_path)
+        await asyncio.to_thread(self._store, key, text)
+        elapsed = time.perf_counter() - start
+        metrics.EXTRACT_SECONDS.labels(format=ext, cached="false").observe(elapsed)
+        metrics.log_span("extract", elapsed, format=ext, chars=len(text))
+        return text
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "cached_documents": len(self._cache),
+                "cached_chars": self._cached_chars,
+                "disk_evicted": self.evicted,
+                "formats": supported_formats(),
+            }
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,256 @@
+# 杏铃酱 xingling-chat 幂等请求
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+幂等键：客户端重试（手机网络抖动）或重复点击发送时，同一个键只调用一次模型、只写一轮历史。
+
+- 键的作用域是 (接口, 会话, 键)；同一个键带着不同的请求内容再来时拒绝（IdempotencyMismatch）
+- 正在生成时来的重复请求直接挂到同一次生成上：流式接口把已产出的事件先回放、之后的事件
+  同时分发给所有订阅者；非流式接口等待同一个结果
+- 生成完成后结果在 LRU 里保留 IDEMPOTENCY_TTL 秒（最多 IDEMPOTENCY_CACHE_SIZE 个），
+  期间的重复请求直接返回缓存，不再调用模型。以 error 事件结束的生成、以及非流式接口里 cacheable 判定为失败的结果
+  不缓存，重试会重新生成
+- 流式生成不依赖某一个连接：所有订阅者都断开 IDEMPOTENCY_GRACE 秒后仍没有人重连才取消
+  （取消时照常关闭上游并保存部分回复），给断线重试留出时间
+
+限制：进行中的生成和缓存的结果都只在本进程里。多 worker 部署（XINGLING_MULTI_WORKER=1）时，
+同一个键的重试落到另一个 worker 上会再生成一次（会话锁保证两轮依次写入，不会交错）；
+需要跨 worker 去重时让负载均衡按会话 ID 固定转发到同一个 worker
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+# ---------- 幂等配置（从环境变量读取）----------
+IDEMPOTENCY_TTL = float(os.getenv("XINGLING_IDEMPOTENCY_TTL", "600"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("XINGLING_IDEMPOTENCY_CACHE_SIZE", "256"))
+IDEMPOTENCY_GRACE = float(os.getenv("XINGLING_IDEMPOTENCY_GRACE", "5"))
+
+TEXT_TYPES = ("reasoning", "content")
+
+Event = Tuple[str, object]
+Key = Tuple[str, str, str]
+
+
+class IdempotencyMismatch(ValueError):
+    def __init__(self, key: str):
+        super().__init__(f"幂等键 {key} 已用于另一个不同的请求")
+
+
+def fingerprint(payload: Dict) -> str:
+    """请求内容的指纹，用来发现同一个键被用在了不同的请求上"""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str).encode()).hexdigest()
+
+
+def _compact(events: List[Event]) -> List[Event]:
+    """合并相邻的同类文本片段，缓存的回放不需要原来的粒度"""
+    merged: List[Event] = []
+    for frame_type, content in events:
+        if (frame_type in TEXT_TYPES and isinstance(content, str) and merged
+                and merged[-1][0] == frame_type and isinstance(merged[-1][1], str)):
+            merged[-1] = (frame_type, merged[-1][1] + content)
+        else:
+            merged.append((frame_type, content))
+    return merged
+
+
+class _Flight:
+    """一次生成：流式时记录全部事件并通知订阅者，非流式时保存结果"""
+
+    def __init__(self, digest: str):
+        self.digest = digest
+        self.events: List[Event] = []
+        self.done = False
+        self.failed = False
+        self.result = None
+        self.task: Optional[asyncio.Task] = None
+        self.subscribers = 0
+        self.expires_at = 0.0
+        self._changed: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def _notify(self):
+        if not self._changed.done():
+            self._changed.set_result(None)
+        self._changed = asyncio.get_running_loop().create_future()
+
+    def push(self, event: Event):
+        self.events.append(event)
+        if event[0] == "error":
+            self.failed = True
+        self._notify()
+
+    def finish(self):
+        self.done = True
+        self.events = _compact(self.events)
+        self._notify()
+
+    async def replay(self) -> AsyncIterator[Event]:
+        # 完成时 self.events 会换成合并后的新列表；正在回放的订阅者继续读原来的列表（已经完整）
+        events = self.events
+        index = 0
+        while True:
+            if index < len(events):
+                index += 1
+                yield events[index - 1]
+                continue
+            if self.done:
+                return
+            # shield：某个订阅者被取消时不能把共享的 future 一起取消
+            await asyncio.shield(self._changed)
+
+
+class IdempotencyCache:
+    """进行中的生成和已完成结果共用一张表：进行中的不会被淘汰，完成后按 TTL 和容量淘汰"""
+
+    def __init__(self, ttl: float = IDEMPOTENCY_TTL, max_size: int = IDEMPOTENCY_CACHE_SIZE,
+                 grace: float = IDEMPOTENCY_GRACE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.grace = grace
+        self._flights: "OrderedDict[Key, _Flight]" = OrderedDict()
+        self.started = 0
+        self.joined = 0
+        self.replayed = 0
+        self.mismatched = 0
+        self.abandoned = 0
+
+    def _lookup(self, key: Key, digest: str) -> Optional[_Flight]:
+        flight = self._flights.get(key)
+        if flight is None:
+            return None
+        if flight.done and flight.expires_at <= time.monotonic():
+            del self._flights[key]
+            return None
+        if flight.digest != digest:
+            self.mismatched += 1
+            raise IdempotencyMismatch(key[2])
+        self._flights.move_to_end(key)
+        return flight
+
+    def known(self, key: Key, digest: str) -> bool:
+        """这个键是否有进行中的生成或未过期的结果（接下来的 stream / call 会加入或回放，不会重新生成）"""
+        return self._lookup(key, digest) is not None
+
+    def _state(self, flight: _Flight) -> str:
+        if flight.done:
+            self.replayed += 1
+            return "replayed"
+        self.joined += 1
+        return "joined"
+
+    def _start(self, key: Key, digest: str) -> _Flight:
+        flight = self._flights[key] = _Flight(digest)
+        self.started += 1
+        return flight
+
+    def _settle(self, key: Key, flight: _Flight, keep: bool):
+        """生成结束：成功的结果保留 TTL 秒，失败或被取消的移除，让重试重新生成"""
+        if self._flights.get(key) is not flight:
+            return
+        if not keep:
+            del self._flights[key]
+            return
+        flight.expires_at = time.monotonic() + self.ttl
+        self._evict()
+
+    def _evict(self):
+        now = time.monotonic()
+        for key in [k for k, f in self._flights.items() if f.done and f.expires_at <= now]:
+            del self._flights[key]
+        finished = [k for k, f in self._flights.items() if f.done]
+        for key in finished[:max(len(self._flights) - self.max_size, 0)]:
+            del self._flights[key]
+
+    def stream(self, key: Key, digest: str,
+               factory: Callable[[], AsyncIterator[Event]]) -> Tuple[AsyncIterator[Event], str]:
+        """
+        返回 (事件流, 状态)，状态为 started / joined / replayed。
+        生成在独立的任务里进行，每个调用方拿到的事件流都从头回放
+        """
+        flight = self._lookup(key, digest)
+        if flight is not None:
+            state = self._state(flight)
+        else:
+            flight = self._start(key, digest)
+            flight.task = asyncio.get_running_loop().create_task(self._produce(key, flight, factory))
+            state = "started"
+        return self._subscribe(key, flight), state
+
+    async def _produce(self, key: Key, flight: _Flight, factory: Callable[[], AsyncIterator[Event]]):
+        events = factory()
+        try:
+            async for event in events:
+                flight.push(event)
+        except asyncio.CancelledError:
+            # 告诉还连着的订阅者生成中断了，关闭上游生成器（保存部分回复）后照常向外抛出取消
+            flight.push(("error", "生成已取消"))
+            await events.aclose()
+            raise
+        except Exception as e:
+            flight.push(("error", str(e)))
+        finally:
+            flight.finish()
+            self._settle(key, flight, keep=not flight.failed)
+
+    async def _subscribe(self, key: Key, flight: _Flight) -> AsyncIterator[Event]:
+        flight.subscribers += 1
+        try:
+            async for event in flight.replay():
+                yield event
+        finally:
+            flight.subscribers -= 1
+            if not flight.subscribers and not flight.done:
+                asyncio.get_running_loop().call_later(self.grace, self._abandon, flight)
+
+    def _abandon(self, flight: _Flight):
+        if not flight.subscribers and not flight.done and flight.task is not None:
+            self.abandoned += 1
+            flight.task.cancel()
+
+    async def call(self, key: Key, digest: str, factory: Callable[[], Awaitable],
+                   cacheable: Optional[Callable[[object], bool]] = None) -> Tuple[object, str]:
+        """
+        非流式：返回 (结果, 状态)。生成期间调用方断开不影响结果，其他等待者照样拿到；
+        cacheable(结果) 为假时结果只交给当前的等待者，不缓存
+        """
+        flight = self._lookup(key, digest)
+        if flight is not None:
+            state = self._state(flight)
+        else:
+            flight = self._start(key, digest)
+            flight.task = asyncio.get_running_loop().create_task(self._run(key, flight, factory, cacheable))
+            state = "started"
+        return await asyncio.shield(flight.task), state
+
+    async def _run(self, key: Key, flight: _Flight, factory: Callable[[], Awaitable],
+                   cacheable: Optional[Callable[[object], bool]]):
+        try:
+            flight.result = await factory()
+            if cacheable is not None and not cacheable(flight.result):
+                flight.failed = True
+            return flight.result
+        except BaseException:
+            flight.failed = True
+            raise
+        finally:
+            flight.finish()
+            self._settle(key, flight, keep=not flight.failed)
+
+    def stats(self) -> Dict:
+        in_flight = sum(1 for f in self._flights.values() if not f.done)
+        return {
+            "in_flight": in_flight,
+            "cached": len(self._flights) - in_flight,
+            "started": self.started,
+            "joined": self.joined,
+            "replayed": self.replayed,
+            "mismatched": self.mismatched,
+            "abandoned": self.abandoned,
+        }
+
+
+idempotency_cache = IdempotencyCache()
@@ -2,14 +2,46 @@
 # Copyright (c) 2026 zhyuuka
 # 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Request, Response
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
-from typing import Optional
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError
+from contextlib import asynccontextmanager
+from typing import Optional, Tuple
+import os
+import time
+import admission
+import client_pool
+import context_builder
+import doc_analysis
+import file_ingest
+import idempotency
 import memory_core
+import metrics
+import model_routing
+import search_passages
+import session_transfer
+import sse
+import summarizer
+import upstream
+import usage_ledger
+import web_search
+from session_locks import session_locks
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    summarizer.summary_worker.start()
+    client_pool.preload()
+    yield
+    # 退出时停止后台摘要并关闭池化的 HTTP 连接
+    await summarizer.summary_worker.stop()
+    await client_pool.aclose_all()
+    await web_search.web_search.aclose()
+    memory_core.close()
 
-app = FastAPI(title="杏铃酱 API")
+app = FastAPI(title="杏铃酱 API", lifespan=lifespan)
+app.add_middleware(metrics.TraceMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -17,6 +49,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Trace-Id", "Idempotency-Status"],
 )
 
 class ChatRequest(BaseModel):
@@ -30,76 +63,64 @@ class ChatRequest(BaseModel):
     search_provider: Optional[str] = "tavily"
     search_api_key: Optional[str] = None
     search_result_count: Optional[int] = 3
+    search_deadline: Optional[float] = None  # 搜索最多等待的秒数，默认 XINGLING_SEARCH_DEADLINE
+    search_hedge_api_key: Optional[str] = None  # 另一家搜索服务商的密钥，用于对冲请求
+    idempotency_key: Optional[str] = None  # 也可以放在请求头 Idempotency-Key 里
 
 class ChatResponse(BaseModel):
     reply: str
+    context: Optional[dict] = None
 
 class ClearSessionRequest(BaseModel):
     session_id: str
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
-    try:
-        reply = memory_core.chat_with_memory(
-            session_id=request.session_id,
-            user_message=request.message,
-            api_key=request.api_key,
-            base_url=request.base_url,
-            model=request.model,
-            system_prompt=request.system_prompt,
-            search_enabled=request.search_enabled,
-            search_provider=request.search_provider,
-            search_api_key=request.search_api_key,
-            search_result_count=request.search_result_count,
-        )
-        return ChatResponse(reply=reply)
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=str(e))
-
-@app.post("/chat_stream")
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
-from typing import Optional
-import os
-import tempfile
-import memory_core
-
-app = FastAPI(title="杏铃酱 API")
+def _idempotency_scope(kind: str, request: ChatRequest, header_key: Optional[str]) -> Optional[Tuple[Tuple[str, str, str], str]]:
+    """返回 ((接口, 会话, 幂等键), 请求指纹)；请求没带幂等键时返回 None"""
+    key = header_key or request.idempotency_key
+    if not key:
+        return None
+    payload = request.model_dump(exclude={"idempotency_key"})
+    return (kind, request.session_id, key), idempotency.fingerprint(payload)
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:3000"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+def _chat_events(request: ChatRequest):
+    return memory_core.achat_with_memory_events(
+        session_id=request.session_id,
+        user_message=request.message,
+        api_key=request.api_key,
+        base_url=request.base_url,
+        model=request.model,
+        system_prompt=request.system_prompt,
+        search_enabled=request.search_enabled,
+        search_provider=request.search_provider,
+        search_api_key=request.search_api_key,
+        search_result_count=request.search_result_count,
+        search_deadline=request.search_deadline,
+        search_hedge_api_key=request.search_hedge_api_key,
+    )
 
-class ChatRequest(BaseModel):
-    message: str
-    session_id: str
-    api_key: Optional[str] = None
-    base_url: Optional[str] = None
-    model: Optional[str] = None
-    system_prompt: Optional[str] = None
-    search_enabled: Optional[bool] = False
-    search_provider: Optional[str] = "tavily"
-    search_api_key: Optional[str] = None
-    search_result_count: Optional[int] = 3
+def _overloaded(e: admission.Overloaded) -> HTTPException:
+    """上游排不过来：503 + Retry-After，客户端按提示的秒数后重试"""
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
 
-class ChatResponse(BaseModel):
-    reply: str
+def _over_budget(e: usage_ledger.BudgetExceeded) -> HTTPException:
+    """超出当天的 token 预算：429 + Retry-After（到明天零点的秒数）"""
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
 
-class ClearSessionRequest(BaseModel):
-    session_id: str
+async def _admit(request: ChatRequest, scope):
+    """
+    开始一轮新的对话前检查预算和上游准入；幂等键已有进行中的生成或缓存的结果时跳过，
+    让已经完成的请求重试时直接拿到结果，而不是 429 / 503
+    """
+    if scope is not None and idempotency.idempotency_cache.known(*scope):
+        return
+    await memory_core.acheck_budget(request.session_id, request.api_key, request.base_url)
+    memory_core.admission_check(request.api_key, request.base_url)
 
 @app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
-    try:
-        reply = memory_core.chat_with_memory(
+async def chat(request: ChatRequest, response: Response, idempotency_key: Optional[str] = Header(None)):
+    async def run():
+        context = {}
+        reply = await memory_core.achat_with_memory(
             session_id=request.session_id,
             user_message=request.message,
             api_key=request.api_key,
@@ -110,29 +131,53 @@ async def chat(request: ChatRequest):
             search_provider=request.search_provider,
             search_api_key=request.search_api_key,
             search_result_count=request.search_result_count,
+            search_deadline=request.search_deadline,
+            search_hedge_api_key=request.search_hedge_api_key,
+            context_report=context,
         )
-        return ChatResponse(reply=reply)
+        return reply, context
+
+    try:
+        scope = _idempotency_scope("chat", request, idempotency_key)
+        await _admit(request, scope)
+        if scope is None:
+            reply, context = await run()
+        else:
+            # 同一个幂等键：正在生成时等待同一个结果，已完成时直接返回缓存（调用模型失败的道歉回复不缓存）
+            (reply, context), state = await idempotency.idempotency_cache.call(
+                *scope, run, cacheable=lambda result: result[0] != memory_core.FAILED_REPLY)
+            response.headers["Idempotency-Status"] = state
+        return ChatResponse(reply=reply, context=context)
+    except idempotency.IdempotencyMismatch as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except admission.Overloaded as e:
+        raise _overloaded(e)
+    except usage_ledger.BudgetExceeded as e:
+        raise _over_budget(e)
     except Exception as e:
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/chat_stream")
-async def chat_stream(request: ChatRequest):
+async def chat_stream(request: ChatRequest, idempotency_key: Optional[str] = Header(None)):
     try:
-        generator = memory_core.chat_with_memory_stream(
-            session_id=request.session_id,
-            user_message=request.message,
-            api_key=request.api_key,
-            base_url=request.base_url,
-            model=request.model,
-            system_prompt=request.system_prompt,
-            search_enabled=request.search_enabled,
-            search_provider=request.search_provider,
-            search_api_key=request.search_api_key,
-            search_result_count=request.search_result_count,
-        )
-        return StreamingResponse(generator, media_type="text/plain")
+        headers = dict(sse.HEADERS)
+        scope = _idempotency_scope("chat_stream", request, idempotency_key)
+        await _admit(request, scope)
+        if scope is None:
+            events = _chat_events(request)
+        else:
+            # 同一个幂等键的请求共用一次生成，各自从头回放事件
+            events, state = idempotency.idempotency_cache.stream(*scope, lambda: _chat_events(request))
+            headers["Idempotency-Status"] = state
+        return StreamingResponse(sse.event_stream(events), media_type="text/event-stream", headers=headers)
+    except idempotency.IdempotencyMismatch as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except admission.Overloaded as e:
+        raise _overloaded(e)
+    except usage_ledger.BudgetExceeded as e:
+        raise _over_budget(e)
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -141,66 +186,196 @@ async def chat_stream(request: ChatRequest):
 @app.post("/clear_session")
 async def clear_session(request: ClearSessionRequest):
     try:
-        memory_core.clear_session_memory(request.session_id)
+        await memory_core.aclear_session_memory(request.session_id)
         return {"status": "ok"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def _require_admin(authorization: Optional[str], admin_token: Optional[str]):
+    if not session_transfer.ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="管理接口未开启：请设置 XINGLING_ADMIN_TOKEN")
+    if not session_transfer.admin_authorized(authorization, admin_token):
+        raise HTTPException(status_code=401, detail="管理令牌不正确", headers={"WWW-Authenticate": "Bearer"})
+
+@app.get("/sessions")
+async def list_sessions(sort: str = "last_active", order: str = "desc", limit: int = 50, cursor: Optional[str] = None,
+                        authorization: Optional[str] = Header(None), x_admin_token: Optional[str] = Header(None)):
+    """
+    分页列出服务端的会话（消息数、字节数、最近活动时间、摘要版本、标题）。需要管理令牌：
+    会话 ID 就是访问会话的凭据，标题是第一条用户消息。
+    sort：last_active（默认）/ messages / bytes / title / session_id；翻页时带上一页返回的 next_cursor
+    """
+    _require_admin(authorization, x_admin_token)
+    try:
+        return await memory_core.alist_sessions(sort, order, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/sessions/rebuild_index")
+async def rebuild_session_index(authorization: Optional[str] = Header(None), x_admin_token: Optional[str] = Header(None)):
+    """从存储里的数据重建会话元数据索引（扫描全部数据，需要管理令牌）"""
+    _require_admin(authorization, x_admin_token)
+    return {"sessions": await memory_core.arebuild_session_index()}
+
+@app.get("/export")
+async def export_sessions(format: str = "ndjson", authorization: Optional[str] = Header(None),
+                          x_admin_token: Optional[str] = Header(None)):
+    """
+    导出服务端保存的全部会话（历史、摘要、归档），流式返回。需要管理令牌（见 XINGLING_ADMIN_TOKEN）。
+    format：ndjson（默认）/ ndjson.gz / tar.gz
+    """
+    _require_admin(authorization, x_admin_token)
+    if format not in session_transfer.EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"不支持的导出格式: {format}")
+    media_type, extension = session_transfer.EXPORT_FORMATS[format]
+    filename = f"xingling-sessions-{time.strftime('%Y%m%d-%H%M%S')}.{extension}"
+    return StreamingResponse(memory_core.export_sessions(format), media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.post("/import")
+async def import_sessions(request: Request, on_conflict: str = "skip", authorization: Optional[str] = Header(None),
+                          x_admin_token: Optional[str] = Header(None)):
+    """
+    导入 /export 的导出文件：请求体就是文件本身（curl --data-binary @backup.tar.gz），格式自动识别。
+    需要管理令牌（见 XINGLING_ADMIN_TOKEN）。
+    on_conflict：skip（默认，已有数据的会话跳过）/ replace（清空后用导入的内容替换）
+    """
+    _require_admin(authorization, x_admin_token)
+    if on_conflict not in ("skip", "replace"):
+        raise HTTPException(status_code=400, detail="on_conflict 只能是 skip 或 replace")
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > session_transfer.IMPORT_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=str(file_ingest.UploadTooLarge(session_transfer.IMPORT_MAX_BYTES)))
+    try:
+        path = await session_transfer.spool(request.stream())
+    except file_ingest.UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    try:
+        return await memory_core.aimport_sessions(path, on_conflict)
+    except session_transfer.ImportFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        os.unlink(path)
+
 @app.get("/status")
 async def status():
-    return {"status": "ok", "name": "杏铃酱"}
+    return {
+        "status": "ok",
+        "name": "杏铃酱",
+        "session_locks": session_locks.stats(),
+        "summary_worker": summarizer.summary_worker.stats(),
+        "search": web_search.web_search.stats(),
+        "search_passages": search_passages.passage_stats.snapshot(),
+        "extraction": memory_core.get_extractor().stats(),
+        "document_notes": doc_analysis.notes_cache.stats(),
+        "streams": sse.stream_stats.snapshot(),
+        "prompt_cache": context_builder.cache_stats.snapshot(),
+        "idempotency": idempotency.idempotency_cache.stats(),
+        "admission": admission.controller.stats(),
+        "upstream": upstream.stats(),
+        "model_routes": model_routing.describe(),
+        "usage_ledger": memory_core.get_ledger().stats(),
+    }
+
+@app.get("/usage")
+async def usage(group_by: str = "day,model", since: Optional[str] = None, until: Optional[str] = None,
+                session_id: Optional[str] = None, key_id: Optional[str] = None, limit: int = 1000,
+                authorization: Optional[str] = Header(None), x_admin_token: Optional[str] = Header(None)):
+    """
+    token 用量汇总（按会话汇总会列出全部会话 ID，需要管理令牌）。group_by：day / session / key / model / task
+    用逗号组合（空表示总计）；since / until：YYYY-MM-DD（含）；key_id：API 密钥 SHA-256 的前 12 位（汇总结果里的 key_id）
+    """
+    _require_admin(authorization, x_admin_token)
+    try:
+        columns = [g.strip() for g in group_by.split(",") if g.strip()]
+        rows = await memory_core.ausage_rollup(columns, since, until, session_id, key_id, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"group_by": group_by, "rows": rows}
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus 文本格式的指标"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+class UploadForm(BaseModel):
+    """/upload 表单里文件以外的字段"""
+    session_id: str
+    instruction: Optional[str] = None
+    api_key: Optional[str] = None
+    base_url: Optional[str] = None
+    model: Optional[str] = None
+    system_prompt: Optional[str] = None
+    search_enabled: Optional[bool] = False
+    search_provider: Optional[str] = "tavily"
+    search_api_key: Optional[str] = None
+    search_result_count: Optional[int] = 3
+    search_deadline: Optional[float] = None
+    search_hedge_api_key: Optional[str] = None
 
 @app.post("/upload")
-async def upload_file(
-    session_id: str = Form(...),
-    file: UploadFile = File(...),
-    api_key: Optional[str] = Form(None),
-    base_url: Optional[str] = Form(None),
-    model: Optional[str] = Form(None),
-    system_prompt: Optional[str] = Form(None),
-    search_enabled: Optional[bool] = Form(False),
-    search_provider: Optional[str] = Form("tavily"),
-    search_api_key: Optional[str] = Form(None),
-    search_result_count: Optional[int] = Form(3),
-):
+async def upload_file(request: Request):
     """
-    上传文件并让 AI 分析（流式返回）
+    上传文件并让 AI 分析（流式返回）。multipart 表单：file 为文件，其余字段见 UploadForm。
+    请求体直接流式解析，文件边收边写临时文件，超过大小上限立即中止（413）
     """
-    # 保存上传的文件到临时目录
-    suffix = os.path.splitext(file.filename)[1]
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        content = await file.read()
-        tmp.write(content)
-        tmp_path = tmp.name
+    # 请求体明显超过上限时直接拒绝，不必等整个文件传完
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > file_ingest.UPLOAD_MAX_BYTES + 64 * 1024:
+        raise HTTPException(status_code=413, detail=str(file_ingest.UploadTooLarge(file_ingest.UPLOAD_MAX_BYTES)))
 
+    # 按块把上传的文件写到临时目录，同时计算内容哈希
     try:
-        # 提取文件内容
-        file_content = memory_core.extract_text_from_file(tmp_path)
+        upload = await file_ingest.receive_upload(request.headers.get("content-type", ""), request.stream())
+    except file_ingest.UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except file_ingest.UploadFormError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        try:
+            form = UploadForm(**upload.fields)
+        except ValidationError as e:
+            raise RequestValidationError(e.errors())
+        try:
+            await memory_core.acheck_budget(form.session_id, form.api_key, form.base_url)
+            memory_core.admission_check(form.api_key, form.base_url)
+        except admission.Overloaded as e:
+            raise _overloaded(e)
+        except usage_ledger.BudgetExceeded as e:
+            raise _over_budget(e)
+
+        # 提取文件内容（同一份文件再次上传时直接用缓存）；文件损坏时返回 422 而不是 500
+        try:
+            file_content = await memory_core.aextract_text_from_file(upload.path, upload.digest, form.session_id)
+        except Exception as e:
+            print(f"提取文件内容失败（{upload.filename}）: {e}")
+            raise HTTPException(status_code=422, detail=f"无法读取文件《{upload.filename}》的内容: {e}")
         if not file_content.strip():
             return StreamingResponse(iter(["（文件内容为空）"]), media_type="text/plain")
 
-        # 构建用户消息：包含文件内容和分析指令
-        user_message = f"请分析以下文件内容（文件名：{file.filename}）：\n\n{file_content[:10000]}"
-        if len(file_content) > 10000:
-            user_message += "\n\n（文件较长，已截取前10000字符）"
-
-        # 调用流式对话函数，将分析结果流式返回
-        generator = memory_core.chat_with_memory_stream(
-            session_id=session_id,
-            user_message=user_message,
-            api_key=api_key,
-            base_url=base_url,
-            model=model,
-            system_prompt=system_prompt,
-            search_enabled=search_enabled,
-            search_provider=search_provider,
-            search_api_key=search_api_key,
-            search_result_count=search_result_count,
+        # 长文档分段提取要点后再汇总（见 doc_analysis），分析结果流式返回
+        events = memory_core.aanalyze_document_events(
+            session_id=form.session_id,
+            filename=upload.filename,
+            text=file_content,
+            digest=upload.digest,
+            instruction=form.instruction,
+            api_key=form.api_key,
+            base_url=form.base_url,
+            model=form.model,
+            system_prompt=form.system_prompt,
+            search_enabled=form.search_enabled,
+            search_provider=form.search_provider,
+            search_api_key=form.search_api_key,
+            search_result_count=form.search_result_count,
+            search_deadline=form.search_deadline,
+            search_hedge_api_key=form.search_hedge_api_key,
         )
-        return StreamingResponse(generator, media_type="text/plain")
+        return StreamingResponse(sse.event_stream(events), media_type="text/event-stream", headers=sse.HEADERS)
     finally:
         # 删除临时文件
-        os.unlink(tmp_path)
+        os.unlink(upload.path)
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,14 +1,28 @@
 # 杏铃酱 xingling-chat 核心代码
 # Copyright (c) 2026 zhyyuka
 # 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
-import json
+import asyncio
 import os
 import sys
-from typing import Optional, List, Dict, Generator
-from openai import OpenAI
-import requests
-import PyPDF2
-import docx
+import threading
+import time
+from typing import Optional, List, Dict, Generator, AsyncGenerator, Tuple
+
+import admission
+import context_builder
+import doc_analysis
+import file_ingest
+import metrics
+import model_routing
+import recall_index
+import session_store
+import session_transfer
+import sse
+import summarizer
+import upstream
+import usage_ledger
+import web_search
+from session_locks import session_locks
 
 # ---------- 确定数据存储目录（兼容开发环境和打包后的 exe）----------
 if getattr(sys, 'frozen', False):
@@ -16,140 +30,355 @@ if getattr(sys, 'frozen', False):
 else:
     BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-MEMORY_DIR = os.path.join(BASE_DIR, "memory_sessions")
-os.makedirs(MEMORY_DIR, exist_ok=True)
+# 目录在第一次写入时才创建（会话存储、提取缓存、锁文件各自负责），导入本模块不碰磁盘
+MEMORY_DIR = os.getenv("XINGLING_MEMORY_DIR") or os.path.join(BASE_DIR, "memory_sessions")
+
+# ---------- 多进程部署（uvicorn main:app --workers N）----------
+# 开启后：同一会话的轮次跨 worker 用文件锁串行化，各 worker 的会话缓存按版本号核对，
+# 召回索引按归档条数同步，后台摘要用租约保证整个进程池只执行一次
+MULTI_WORKER = os.getenv("XINGLING_MULTI_WORKER", "0") == "1"
+if MULTI_WORKER:
+    session_locks.enable_process_locks(os.path.join(MEMORY_DIR, "locks"))
 
 # ---------- 默认配置（从环境变量读取，作为后备）----------
 DEFAULT_API_KEY = os.getenv("DEEPSEEK_API_KEY", "")
 DEFAULT_BASE_URL = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
 DEFAULT_MODEL = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
 DEFAULT_SYSTEM_PROMPT = "你是一个友善的AI助手，名叫杏铃酱。"
-
-def _get_history_path(session_id: str) -> str:
-    return os.path.join(MEMORY_DIR, f"history_{session_id}.json")
-
-def _get_summary_path(session_id: str) -> str:
-    return os.path.join(MEMORY_DIR, f"summary_{session_id}.txt")
+# 调用模型失败时的回复（非流式接口；流式接口改为发送 error 事件）
+FAILED_REPLY = "（抱歉，我现在无法回答，请稍后再试。）"
+# 流式请求带上 stream_options.include_usage，最后一个 chunk 会返回本轮用量（含前缀缓存命中数）；
+# 不支持该参数的兼容接口可以设为 0 关闭
+STREAM_USAGE = os.getenv("XINGLING_STREAM_USAGE", "1") == "1"
+_STREAM_OPTIONS = {"stream_options": {"include_usage": True}} if STREAM_USAGE else {}
+
+# 会话存储、提取器、用量账本和召回索引都在第一次用到时按当时的 MEMORY_DIR 创建；
+# 基准脚本和测试换数据目录时调用 set_memory_dir()，不要直接改 MEMORY_DIR
+_store: Optional[session_store.SessionStore] = None
+_file_extractor: Optional[file_ingest.Extractor] = None
+_ledger: Optional[usage_ledger.UsageLedger] = None
+_store_lock = threading.Lock()
+
+def get_store() -> session_store.SessionStore:
+    """返回当前的会话存储（首次调用时按 XINGLING_SESSION_STORE 打开）"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = session_store.open_store(MEMORY_DIR, validate=MULTI_WORKER)
+    return _store
+
+def get_extractor() -> file_ingest.Extractor:
+    """上传文件的文本提取器（提取结果按内容哈希缓存在 memory_sessions/extracted/，有大小和时间上限）"""
+    global _file_extractor
+    if _file_extractor is None:
+        with _store_lock:
+            if _file_extractor is None:
+                _file_extractor = file_ingest.Extractor(os.path.join(MEMORY_DIR, "extracted"))
+    return _file_extractor
+
+def get_ledger() -> usage_ledger.UsageLedger:
+    """token 用量账本（memory_sessions/usage.db，第一次写入时才创建文件）"""
+    global _ledger
+    if _ledger is None:
+        with _store_lock:
+            if _ledger is None:
+                _ledger = usage_ledger.UsageLedger(os.path.join(MEMORY_DIR, usage_ledger.LEDGER_FILENAME))
+    return _ledger
+
+def _new_recall() -> recall_index.RecallIndexes:
+    # 归档消息的检索索引（按会话懒加载）
+    return recall_index.RecallIndexes(lambda session_id, start: get_store().load_archive(session_id, start))
+
+_recall = _new_recall()
+
+def close():
+    """关闭已经打开的存储、提取器和账本（应用退出时调用；没用到过的不会被创建）"""
+    global _store, _file_extractor, _ledger
+    with _store_lock:
+        store, extractor, ledger = _store, _file_extractor, _ledger
+        _store = _file_extractor = _ledger = None
+    if extractor is not None:
+        extractor.shutdown()
+    if ledger is not None:
+        ledger.close()
+    if store is not None:
+        store.close()
+
+def set_memory_dir(memory_dir: str):
+    """换数据目录（基准脚本、测试用）：关闭按旧目录打开的对象，之后按新目录重新创建"""
+    global MEMORY_DIR, _recall
+    close()
+    MEMORY_DIR = memory_dir
+    _recall = _new_recall()
+    if MULTI_WORKER:
+        session_locks.enable_process_locks(os.path.join(MEMORY_DIR, "locks"))
 
 def load_history(session_id: str) -> List[Dict]:
-    path = _get_history_path(session_id)
-    if os.path.exists(path):
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return []
+    with metrics.span("load_history", metrics.STORE_SECONDS, {"op": "load_history"}):
+        return get_store().load_history(session_id)
 
 def save_history(session_id: str, history: List[Dict]):
-    path = _get_history_path(session_id)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(history, f, ensure_ascii=False, indent=2)
+    with metrics.span("save_history", metrics.STORE_SECONDS, {"op": "save_history"}):
+        get_store().save_history(session_id, history)
+
+def append_history(session_id: str, messages: List[Dict]):
+    with metrics.span("append_history", metrics.STORE_SECONDS, {"op": "append_history"}):
+        get_store().append_history(session_id, messages)
 
 def load_summary(session_id: str) -> str:
-    path = _get_summary_path(session_id)
-    if os.path.exists(path):
-        with open(path, "r", encoding="utf-8") as f:
-            return f.read().strip()
-    return ""
+    with metrics.span("load_summary", metrics.STORE_SECONDS, {"op": "load_summary"}):
+        return get_store().load_summary(session_id)
 
 def save_summary(session_id: str, summary: str):
-    path = _get_summary_path(session_id)
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(summary)
+    with metrics.span("save_summary", metrics.STORE_SECONDS, {"op": "save_summary"}):
+        get_store().save_summary(session_id, summary)
+
+def archive_messages(session_id: str, messages: List[Dict]):
+    """把移出历史的旧消息写入归档并更新检索索引"""
+    get_store().archive_messages(session_id, messages)
+    _recall.on_archived(session_id)
 
-def _create_client(api_key: Optional[str] = None, base_url: Optional[str] = None) -> OpenAI:
+def recall_memories(session_id: str, query: str) -> List[str]:
+    """从归档中召回与 query 最相关的旧对话片段"""
+    if MULTI_WORKER:
+        _recall.sync(session_id, get_store().archive_count(session_id))
+    return _recall.recall(session_id, query)
+
+def _resolve_endpoint(api_key: Optional[str], base_url: Optional[str]) -> Tuple[str, str]:
     key = api_key if api_key is not None else DEFAULT_API_KEY
     url = base_url if base_url is not None else DEFAULT_BASE_URL
-    return OpenAI(api_key=key, base_url=url)
+    return key, url
+
+def _route(task: str, api_key: Optional[str], base_url: Optional[str], model: Optional[str]) -> model_routing.Route:
+    """按任务类型选上游和参数（见 model_routing）；路由没有配置的部分用传入的值，未传入则用默认值"""
+    key, url = _resolve_endpoint(api_key, base_url)
+    return model_routing.resolve(task, key, url, model if model is not None else DEFAULT_MODEL)
 
-def generate_summary(messages: List[Dict], api_key: Optional[str] = None, base_url: Optional[str] = None, model: Optional[str] = None) -> str:
+def _chat_params(route: model_routing.Route, messages: List[Dict], stream: bool = False) -> Dict:
+    params = route.params(messages)
+    if stream:
+        params.update(_STREAM_OPTIONS)
+    return params
+
+def _chat_route(session_id: str, api_key: Optional[str], base_url: Optional[str], model: Optional[str]) -> model_routing.Route:
+    """
+    对话的路由：会话或密钥超出当天预算时按 usage_ledger.BUDGET_ACTION 处理，
+    降级时改用 downgrade 路由，拒绝（或没有配置降级路由）时抛出 usage_ledger.BudgetExceeded
+    """
+    exceeded = get_ledger().over_budget(session_id, _resolve_endpoint(api_key, base_url)[0])
+    if exceeded is None:
+        return _route(model_routing.CHAT, api_key, base_url, model)
+    if usage_ledger.BUDGET_ACTION == "downgrade" and model_routing.configured(model_routing.DOWNGRADE):
+        return _route(model_routing.DOWNGRADE, api_key, base_url, model)
+    raise exceeded
+
+def admission_check(api_key: Optional[str] = None, base_url: Optional[str] = None):
+    """接口层在开始一轮对话前调用：所有上游都排不过来（或都在熔断）时直接抛出 admission.Overloaded"""
+    upstream.check(_route(model_routing.CHAT, api_key, base_url, None).endpoints)
+
+async def acheck_budget(session_id: str, api_key: Optional[str] = None, base_url: Optional[str] = None):
+    """接口层在开始一轮对话前调用：超出预算且不能降级时直接抛出 usage_ledger.BudgetExceeded"""
+    await asyncio.to_thread(_chat_route, session_id, api_key, base_url, None)
+
+async def ausage_rollup(group_by, since: Optional[str] = None, until: Optional[str] = None,
+                        session_id: Optional[str] = None, key: Optional[str] = None, limit: int = 1000) -> List[Dict]:
+    """按天 / 会话 / 密钥 / 模型 / 任务汇总 token 用量（见 UsageLedger.rollup），参数无效时抛出 ValueError"""
+    return await asyncio.to_thread(get_ledger().rollup, group_by, since, until, session_id, key, limit)
+
+def _summary_complete(api_key: Optional[str], base_url: Optional[str], model: Optional[str],
+                      session_id: Optional[str] = None, task: str = model_routing.SUMMARY):
+    route = _route(task, api_key, base_url, model)
+
+    def complete(messages: List[Dict]) -> str:
+        with upstream.open_sync(route.endpoints, route.params(messages)) as attempt:
+            _record_usage(session_id, api_key, base_url, attempt.endpoint.model, attempt.response.usage, task)
+            return attempt.response.choices[0].message.content
+    return complete
+
+def _asummary_complete(api_key: Optional[str], base_url: Optional[str], model: Optional[str],
+                       session_id: Optional[str] = None, task: str = model_routing.SUMMARY):
+    """异步版本；每次调用经过准入控制，排队优先级由任务的路由决定（摘要是后台，文档分析是交互）"""
+    route = _route(task, api_key, base_url, model)
+
+    async def complete(messages: List[Dict]) -> str:
+        cost = sum(context_builder.estimate_tokens(m["content"]) for m in messages) + route.max_tokens
+        attempt = await upstream.aopen(route.endpoints, route.params(messages), session_id=session_id,
+                                       priority=route.priority, cost=cost)
+        async with attempt:
+            usage = _record_usage(session_id, api_key, base_url, attempt.endpoint.model, attempt.response.usage, task)
+            attempt.grant.settle(usage)
+            return attempt.response.choices[0].message.content
+    return complete
+
+def generate_summary(messages: List[Dict], api_key: Optional[str] = None, base_url: Optional[str] = None, model: Optional[str] = None, previous_summary: str = "") -> str:
+    """
+    调用 LLM 生成历史摘要；传入 previous_summary 时在旧摘要基础上增量合并
+    """
     if not messages:
-        return ""
-    summary_prompt = "请总结以下对话内容，用简洁的语言概括主要话题和关键信息：\n\n"
-    for msg in messages:
-        role = "用户" if msg["role"] == "user" else "助手"
-        summary_prompt += f"{role}: {msg['content']}\n"
-    
-    client = _create_client(api_key, base_url)
-    model_name = model if model is not None else DEFAULT_MODEL
-    
+        return previous_summary
     try:
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=[
-                {"role": "system", "content": "你是一个善于总结的助手。"},
-                {"role": "user", "content": summary_prompt}
-            ],
-            temperature=0.3,
-            max_tokens=300
-        )
-        return response.choices[0].message.content
+        with metrics.span("generate_summary", metrics.SUMMARY_SECONDS):
+            return summarizer.summarize(messages, previous_summary, _summary_complete(api_key, base_url, model))
     except Exception as e:
         print(f"生成摘要失败: {e}")
+        metrics.UPSTREAM_ERRORS.labels(kind="summary").inc()
         return "（摘要生成失败）"
 
-def search_web(query: str, provider: str, api_key: str, result_count: int = 3) -> str:
-    if not api_key:
-        return "（未提供搜索 API 密钥）"
-    
+async def agenerate_summary(messages: List[Dict], api_key: Optional[str] = None, base_url: Optional[str] = None, model: Optional[str] = None, previous_summary: str = "") -> str:
+    """
+    generate_summary 的异步版本（分块摘要并发执行）
+    """
+    if not messages:
+        return previous_summary
     try:
-        if provider == "tavily":
-            url = "https://api.tavily.com/search"
-            payload = {
-                "api_key": api_key,
-                "query": query,
-                "search_depth": "basic",
-                "max_results": result_count,
-                "include_answer": False,
-                "include_raw_content": False
-            }
-            resp = requests.post(url, json=payload, timeout=10)
-            if resp.status_code == 200:
-                data = resp.json()
-                results = data.get("results", [])
-                if results:
-                    formatted = "\n\n".join([f"{r.get('title', '无标题')}: {r.get('content', '')}" for r in results])
-                    return f"以下是联网搜索到的信息：\n{formatted}"
-                else:
-                    return "（未搜索到相关信息）"
-            else:
-                return f"（搜索失败：HTTP {resp.status_code}）"
-        elif provider == "google_serper":
-            url = "https://google.serper.dev/search"
-            headers = {"X-API-KEY": api_key, "Content-Type": "application/json"}
-            payload = {"q": query, "num": result_count}
-            resp = requests.post(url, json=payload, headers=headers, timeout=10)
-            if resp.status_code == 200:
-                data = resp.json()
-                items = data.get("organic", [])
-                if items:
-                    formatted = "\n\n".join([f"{item.get('title', '无标题')}: {item.get('snippet', '')}" for item in items])
-                    return f"以下是联网搜索到的信息：\n{formatted}"
-                else:
-                    return "（未搜索到相关信息）"
-            else:
-                return f"（搜索失败：HTTP {resp.status_code}）"
-        else:
-            return "（不支持的搜索服务商）"
+        with metrics.span("generate_summary", metrics.SUMMARY_SECONDS):
+            return await summarizer.asummarize(messages, previous_summary, _asummary_complete(api_key, base_url, model))
+    except Exception as e:
+        print(f"生成摘要失败: {e}")
+        metrics.UPSTREAM_ERRORS.labels(kind="summary").inc()
+        return "（摘要生成失败）"
+
+def _rollover_summary(session_id: str, history: List[Dict], summary: str, api_key: Optional[str], base_url: Optional[str], model: Optional[str]) -> List[Dict]:
+    """同步库调用使用：在已持有会话锁时把较早的历史并入摘要，返回剩余历史。失败时保持原样"""
+    cut = summarizer.split_for_rollover(history)
+    if not cut:
+        return history
+    try:
+        with metrics.span("generate_summary", metrics.SUMMARY_SECONDS, session_id=session_id):
+            new_summary = summarizer.summarize(history[:cut], summary,
+                                                 _summary_complete(api_key, base_url, model, session_id))
     except Exception as e:
-        return f"（搜索出错：{str(e)}）"
+        print(f"生成摘要失败: {e}")
+        metrics.UPSTREAM_ERRORS.labels(kind="summary").inc()
+        return history
+    archive_messages(session_id, history[:cut])
+    save_summary(session_id, new_summary)
+    history = history[cut:]
+    save_history(session_id, history)
+    return history
+
+async def arollover_summary(session_id: str, api_key: Optional[str] = None, base_url: Optional[str] = None, model: Optional[str] = None):
+    """
+    后台摘要任务：只在读取快照和写回结果时持有会话锁，调用模型期间对话可以照常进行。
+    写回时只截掉参与摘要的那部分前缀，期间新追加的消息会保留。
+    多进程部署时用租约保证同一会话的摘要在整个进程池里同时只有一个在跑。
+    """
+    with session_locks.lease(f"summary:{session_id}") as owned:
+        if owned:
+            await _arollover_summary(session_id, api_key, base_url, model)
+
+async def _arollover_summary(session_id: str, api_key: Optional[str], base_url: Optional[str], model: Optional[str]):
+    async with session_locks.acquire(session_id):
+        history = await asyncio.to_thread(load_history, session_id)
+        summary = await asyncio.to_thread(load_summary, session_id)
+    cut = summarizer.split_for_rollover(history)
+    if not cut:
+        return
+    try:
+        with metrics.span("generate_summary", metrics.SUMMARY_SECONDS, session_id=session_id):
+            new_summary = await summarizer.asummarize(history[:cut], summary,
+                                                      _asummary_complete(api_key, base_url, model, session_id))
+    except Exception:
+        metrics.UPSTREAM_ERRORS.labels(kind="summary").inc()
+        raise
+    async with session_locks.acquire(session_id):
+        current = await asyncio.to_thread(load_history, session_id)
+        current_summary = await asyncio.to_thread(load_summary, session_id)
+        if len(current) < cut or current[cut - 1] != history[cut - 1] or current_summary != summary:
+            # 会话在此期间被清空或改写，放弃这次结果
+            return
+        await asyncio.to_thread(archive_messages, session_id, current[:cut])
+        await asyncio.to_thread(save_summary, session_id, new_summary)
+        await asyncio.to_thread(save_history, session_id, current[cut:])
+
+def _schedule_rollover(session_id: str, history: List[Dict], api_key: Optional[str], base_url: Optional[str], model: Optional[str]):
+    if summarizer.split_for_rollover(history):
+        summarizer.summary_worker.submit(
+            session_id, lambda: arollover_summary(session_id, api_key, base_url, model), size=len(history)
+        )
+
+def search_web(query: str, provider: str, api_key: str, result_count: int = 3) -> str:
+    """
+    联网搜索，返回搜索结果文本（带缓存和连接复用，见 web_search；按与 query 的相关程度节选，见 search_passages）
+    """
+    return web_search.format_outcome(web_search.web_search.search(query, provider, api_key, result_count), query)
+
+async def asearch_web(query: str, provider: str, api_key: str, result_count: int = 3) -> str:
+    """
+    search_web 的异步版本
+    """
+    return web_search.format_outcome(await web_search.web_search.asearch(query, provider, api_key, result_count),
+                                     query)
+
+async def asearch_web_bounded(query: str, provider: str, api_key: str, result_count: int = 3,
+                              deadline: Optional[float] = None, hedge_api_key: Optional[str] = None,
+                              session_id: Optional[str] = None) -> Tuple[Optional[str], Dict]:
+    """
+    限时搜索：返回 (搜索结果文本, 搜索状态)。到截止时间还没有结果时文本为 None，本轮不带搜索结果继续对话；
+    传入 hedge_api_key（另一家服务商的密钥）时，主服务商迟迟不返回会同时向另一家发起请求
+    """
+    outcome, status = await web_search.web_search.ahedged(
+        query, provider, api_key, result_count,
+        deadline=deadline if deadline is not None else web_search.SEARCH_DEADLINE,
+        hedge_api_key=hedge_api_key,
+        session_id=session_id,
+    )
+    return (web_search.format_outcome(outcome, query) if outcome is not None else None), status
 
 def extract_text_from_file(file_path: str) -> str:
     """根据文件扩展名提取文本内容"""
-    ext = os.path.splitext(file_path)[1].lower()
-    if ext == '.txt':
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            return f.read()
-    elif ext == '.pdf':
-        text = ""
-        with open(file_path, 'rb') as f:
-            reader = PyPDF2.PdfReader(f)
-            for page in reader.pages:
-                text += page.extract_text() + "\n"
-        return text
-    elif ext == '.docx':
-        doc = docx.Document(file_path)
-        return "\n".join([para.text for para in doc.paragraphs])
-    else:
-        return "（不支持的文件格式）"
+    return file_ingest.extract_text(file_path)
+
+async def aextract_text_from_file(file_path: str, digest: Optional[str] = None, session_id: Optional[str] = None) -> str:
+    """
+    异步提取文本：PDF 分页并行、docx 在线程里解析，结果按内容的 SHA-256 缓存（见 file_ingest）
+    """
+    return await get_extractor().aextract(file_path, digest, owner=session_id)
+
+def _build_messages(history: List[Dict], summary: str, search_result: Optional[str], user_message: str, system_prompt: Optional[str], model_name: str, recalled: Optional[List[str]] = None) -> Tuple[List[Dict], Dict]:
+    """按模型的 token 预算把摘要、历史、召回的旧对话、搜索结果和本轮用户消息拼成请求 messages，同时返回各部分用量"""
+    system = system_prompt if system_prompt is not None else DEFAULT_SYSTEM_PROMPT
+    return context_builder.build_context(
+        history, summary, search_result, user_message, system,
+        budget=context_builder.budget_for_model(model_name),
+        recall=recalled,
+    )
+
+def _stream_frames(chunk) -> List[Tuple[str, str]]:
+    """从一个流式 chunk 中取出 (类型, 文本) 片段：先 reasoning 后 content"""
+    frames = []
+    if chunk.choices and chunk.choices[0].delta:
+        delta = chunk.choices[0].delta
+        if getattr(delta, 'reasoning_content', None):
+            frames.append(("reasoning", delta.reasoning_content))
+        if delta.content:
+            frames.append(("content", delta.content))
+    return frames
+
+def _record_usage(session_id: Optional[str], api_key: Optional[str], base_url: Optional[str], model_name: str, usage,
+                  task: str = model_routing.CHAT) -> Optional[Dict]:
+    """
+    把一次调用的用量记进账本（记在请求方的密钥名下，即使路由换了上游）并统计输入 token 和前缀缓存命中数
+    （前缀缓存只统计对话），返回要写进历史和上下文报告的用量（接口没返回 usage 时为 None）
+    """
+    record = context_builder.usage_from_response(usage)
+    if record is not None:
+        get_ledger().record(session_id, _resolve_endpoint(api_key, base_url)[0], model_name, task, record)
+        if task in (model_routing.CHAT, model_routing.DOWNGRADE):
+            context_builder.cache_stats.record(model_name, record)
+        metrics.PROMPT_TOKENS.labels(model=model_name).inc(record["prompt"])
+        metrics.PROMPT_CACHED_TOKENS.labels(model=model_name).inc(record["cached"])
+    return record
+
+def _assistant_message(content: str, usage: Optional[Dict]) -> Dict:
+    msg = context_builder.make_message("assistant", content)
+    if usage is not None:
+        msg["usage"] = usage
+    return msg
+
+def _sse(frame_type: str, content) -> str:
+    return sse.format_event(frame_type, content)
 
 def chat_with_memory(
     session_id: str,
@@ -162,54 +391,121 @@ def chat_with_memory(
     search_provider: str = "tavily",
     search_api_key: Optional[str] = None,
     search_result_count: int = 3,
+    context_report: Optional[Dict] = None,
 ) -> str:
-    history = load_history(session_id)
-    summary = load_summary(session_id)
-
-    messages = []
-    if summary:
-        messages.append({"role": "system", "content": f"历史摘要：{summary}"})
-    for msg in history[-40:]:
-        messages.append({"role": msg["role"], "content": msg["content"]})
-    
-    if search_enabled and search_api_key:
-        search_result = search_web(user_message, search_provider, search_api_key, search_result_count)
-        messages.append({"role": "system", "content": f"联网搜索结果（供参考）：\n{search_result}"})
-    
-    messages.append({"role": "user", "content": user_message})
-    
-    client = _create_client(api_key, base_url)
-    model_name = model if model is not None else DEFAULT_MODEL
-    system = system_prompt if system_prompt is not None else DEFAULT_SYSTEM_PROMPT
-    
-    if messages[0]["role"] != "system":
-        messages.insert(0, {"role": "system", "content": system})
-    else:
-        messages[0]["content"] = f"{system}\n\n{messages[0]['content']}"
-    
-    try:
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=messages,
-            temperature=0.7,
-            max_tokens=2000,
-            stream=False
-        )
-        reply = response.choices[0].message.content
-    except Exception as e:
-        print(f"API 调用失败: {e}")
-        reply = "（抱歉，我现在无法回答，请稍后再试。）"
-    
-    history.append({"role": "user", "content": user_message})
-    history.append({"role": "assistant", "content": reply})
-    
-    if len(history) >= 40:
-        summary_text = generate_summary(history[:-2], api_key, base_url, model)
-        save_summary(session_id, summary_text)
-        history = history[-2:]
-    
-    save_history(session_id, history)
-    return reply
+    """
+    普通对话函数（非流式，同步版本，供库调用；接口层请用 achat_with_memory）
+    传入 context_report 字典时，会写入本轮上下文各部分的 token 用量
+    """
+    with session_locks.acquire_sync(session_id):
+        history = load_history(session_id)
+        summary = load_summary(session_id)
+        recalled = recall_memories(session_id, user_message)
+
+        search_result = None
+        if search_enabled and search_api_key:
+            search_result = search_web(user_message, search_provider, search_api_key, search_result_count)
+        route = _chat_route(session_id, api_key, base_url, model)
+        model_name = route.model
+        messages, report = _build_messages(history, summary, search_result, user_message, system_prompt, model_name, recalled)
+        if context_report is not None:
+            context_report.update(report)
+
+        try:
+            with upstream.open_sync(route.endpoints, _chat_params(route, messages)) as attempt:
+                reply = attempt.response.choices[0].message.content
+                usage = _record_usage(session_id, api_key, base_url, attempt.endpoint.model, attempt.response.usage,
+                                      route.task)
+        except Exception as e:
+            print(f"API 调用失败: {e}")
+            reply = FAILED_REPLY
+            usage = None
+        if context_report is not None and usage is not None:
+            context_report["usage"] = usage
+
+        turn = [context_builder.make_message("user", user_message), _assistant_message(reply, usage)]
+        history.extend(turn)
+
+        append_history(session_id, turn)
+        _rollover_summary(session_id, history, summary, api_key, base_url, model)
+        return reply
+
+async def achat_with_memory(
+    session_id: str,
+    user_message: str,
+    api_key: Optional[str] = None,
+    base_url: Optional[str] = None,
+    model: Optional[str] = None,
+    system_prompt: Optional[str] = None,
+    search_enabled: bool = False,
+    search_provider: str = "tavily",
+    search_api_key: Optional[str] = None,
+    search_result_count: int = 3,
+    context_report: Optional[Dict] = None,
+    search_deadline: Optional[float] = None,
+    search_hedge_api_key: Optional[str] = None,
+) -> str:
+    """
+    普通对话函数（非流式，异步版本）：LLM、搜索和文件读写都不会阻塞事件循环
+    """
+    with metrics.span("turn", metrics.TURN_SECONDS, {"mode": "chat"}, session_id=session_id):
+        lock_requested = time.perf_counter()
+        async with session_locks.acquire(session_id):
+            metrics.log_span("lock_wait", time.perf_counter() - lock_requested, session_id=session_id)
+            history = await asyncio.to_thread(load_history, session_id)
+            summary = await asyncio.to_thread(load_summary, session_id)
+            with metrics.span("recall"):
+                recalled = await asyncio.to_thread(recall_memories, session_id, user_message)
+
+            search_result = None
+            search_status = None
+            if search_enabled and search_api_key:
+                with metrics.span("search", provider=search_provider) as fields:
+                    search_result, search_status = await asearch_web_bounded(
+                        user_message, search_provider, search_api_key, search_result_count, search_deadline, search_hedge_api_key,
+                        session_id)
+                    fields["state"] = search_status["state"]
+            # 超出预算时降级或抛出 BudgetExceeded（由接口层返回 429）
+            route = await asyncio.to_thread(_chat_route, session_id, api_key, base_url, model)
+            model_name = route.model
+            messages, report = _build_messages(history, summary, search_result, user_message, system_prompt, model_name, recalled)
+            if search_status is not None:
+                report["search_status"] = search_status
+            if route.task == model_routing.DOWNGRADE:
+                report["downgraded"] = True
+            report["trace_id"] = metrics.current_trace_id()
+            if context_report is not None:
+                context_report.update(report)
+
+            try:
+                with metrics.span("upstream", model=model_name) as fields:
+                    attempt = await upstream.aopen(route.endpoints, _chat_params(route, messages),
+                                                   session_id=session_id, cost=report["total"] + route.max_tokens)
+                    async with attempt:
+                        usage = _record_usage(session_id, api_key, base_url, attempt.endpoint.model,
+                                              attempt.response.usage, route.task)
+                        attempt.grant.settle(usage)
+                    fields["upstream"] = attempt.endpoint.base_url
+                    fields["usage"] = usage
+                reply = attempt.response.choices[0].message.content
+            except admission.Overloaded:
+                # 排不上队：不写历史，由接口层返回 503 + Retry-After
+                raise
+            except Exception as e:
+                print(f"API 调用失败: {e}")
+                metrics.UPSTREAM_ERRORS.labels(kind="chat").inc()
+                reply = FAILED_REPLY
+                usage = None
+            if context_report is not None and usage is not None:
+                context_report["usage"] = usage
+
+            turn = [context_builder.make_message("user", user_message), _assistant_message(reply, usage)]
+            history.extend(turn)
+
+            await asyncio.to_thread(append_history, session_id, turn)
+            # 摘要交给后台队列，不拖慢本轮响应
+            _schedule_rollover(session_id, history, api_key, base_url, model)
+            return reply
 
 def chat_with_memory_stream(
     session_id: str,
@@ -222,163 +518,187 @@ def chat_with_memory_stream(
     search_provider: str = "tavily",
     search_api_key: Optional[str] = None,
     search_result_count: int = 3,
+    context_report: Optional[Dict] = None,
 ) -> Generator[str, None, None]:
-    history = load_history(session_id)
-    summary = load_summary(session_id)
-
-    messages = []
-    if summary:
-        messages.append({"role": "system", "content": f"历史摘要：{summary}"})
-    for msg in history[-40:]:
-        messages.append({"role": msg["role"], "content": msg["content"]})
-
-    if search_enabled and search_api_key:
-        search_result = search_web(user_message, search_provider, search_api_key, search_result_count)
-        messages.append({"role": "system", "content": f"联网搜索结果（供参考）：\n{search_result}"})
-
-    messages.append({"role": "user", "content": user_message})
-
-    client = _create_client(api_key, base_url)
-    model_name = model if model is not None else DEFAULT_MODEL
-    system = system_prompt if system_prompt is not None else DEFAULT_SYSTEM_PROMPT
-
-    if messages[0]["role"] != "system":
-        messages.insert(0, {"role": "system", "content": system})
-    else:
-        messages[0]["content"] = f"{system}\n\n{messages[0]['content']}"
-
-    try:
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=messages,
-            temperature=0.7,
-            max_tokens=2000,
-            stream=True
-        )
-        full_content = ""
-        reasoning_content = ""
-        for chunk in response:
-            if chunk.choices and chunk.choices[0].delta and hasattr(chunk.choices[0].delta, 'reasoning_content') and chunk.choices[0].delta.reasoning_content:
-                reasoning_piece = chunk.choices[0].delta.reasoning_content
-                reasoning_content += reasoning_piece
-                yield f"data: {json.dumps({'type': 'reasoning', 'content': reasoning_piece})}\n\n"
-            if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
-                content_piece = chunk.choices[0].delta.content
-                full_content += content_piece
-                yield f"data: {json.dumps({'type': 'content', 'content': content_piece})}\n\n"
-        history.append({"role": "user", "content": user_message})
-        history.append({"role": "assistant", "content": full_content})
-        if len(history) >= 40:
-            summary_text = generate_summary(history[:-2], api_key, base_url, model)
-            save_summary(session_id, summary_text)
-            history = history[-2:]
-        save_history(session_id, history)
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        yield f"data: {json.dumps({'type': 'error', 'content': str(e)})}\n\n"
-
-def clear_session_memory(session_id: str):
-    hist_path = _get_history_path(session_id)
-    sum_path = _get_summary_path(session_id)
-    if os.path.exists(hist_path):
-        os.remove(hist_path)
-    if os.path.exists(sum_path):
-        os.remove(sum_path)    if os.path.exists(path):
-        with open(path, "r", encoding="utf-8") as f:
-            return f.read().strip()
-    return ""
-
-def save_summary(session_id: str, summary: str):
-    path = _get_summary_path(session_id)
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(summary)
-
-def _create_client(api_key: Optional[str] = None, base_url: Optional[str] = None) -> OpenAI:
-    """根据传入的配置创建 OpenAI 客户端，未传入则使用默认值"""
-    key = api_key if api_key is not None else DEFAULT_API_KEY
-    url = base_url if base_url is not None else DEFAULT_BASE_URL
-    return OpenAI(api_key=key, base_url=url)
-
-def generate_summary(messages: List[Dict], api_key: Optional[str] = None, base_url: Optional[str] = None, model: Optional[str] = None) -> str:
     """
-    调用 LLM 生成历史摘要
+    流式版本，返回 SSE 格式数据，分别发送 reasoning 和 content（同步版本，供库调用）
+    开头会先发送一个 context 帧，内容为本轮上下文各部分的 token 用量；结束时发送 usage 帧（接口返回了用量时）
     """
-    if not messages:
-        return ""
-    summary_prompt = "请总结以下对话内容，用简洁的语言概括主要话题和关键信息：\n\n"
-    for msg in messages:
-        role = "用户" if msg["role"] == "user" else "助手"
-        summary_prompt += f"{role}: {msg['content']}\n"
-    
-    client = _create_client(api_key, base_url)
-    model_name = model if model is not None else DEFAULT_MODEL
-    
-    try:
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=[
-                {"role": "system", "content": "你是一个善于总结的助手。"},
-                {"role": "user", "content": summary_prompt}
-            ],
-            temperature=0.3,
-            max_tokens=300
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        print(f"生成摘要失败: {e}")
-        return "（摘要生成失败）"
-
-def search_web(query: str, provider: str, api_key: str, result_count: int = 3) -> str:
+    with session_locks.acquire_sync(session_id):
+        history = load_history(session_id)
+        summary = load_summary(session_id)
+        recalled = recall_memories(session_id, user_message)
+
+        search_result = None
+        if search_enabled and search_api_key:
+            search_result = search_web(user_message, search_provider, search_api_key, search_result_count)
+        route = _chat_route(session_id, api_key, base_url, model)
+        model_name = route.model
+        messages, report = _build_messages(history, summary, search_result, user_message, system_prompt, model_name, recalled)
+        if context_report is not None:
+            context_report.update(report)
+
+        yield _sse("context", report)
+        try:
+            full_content = ""
+            usage = None
+            with upstream.open_sync(route.endpoints, _chat_params(route, messages, stream=True),
+                                    stream=True) as attempt:
+                for chunk in attempt:
+                    if getattr(chunk, "usage", None) is not None:
+                        usage = chunk.usage
+                    for frame_type, piece in _stream_frames(chunk):
+                        if frame_type == "content":
+                            full_content += piece
+                        yield _sse(frame_type, piece)
+            usage = _record_usage(session_id, api_key, base_url, attempt.endpoint.model, usage, route.task)
+            if usage is not None:
+                yield _sse("usage", usage)
+            # 流结束后保存历史
+            turn = [context_builder.make_message("user", user_message), _assistant_message(full_content, usage)]
+            history.extend(turn)
+            append_history(session_id, turn)
+            _rollover_summary(session_id, history, summary, api_key, base_url, model)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            yield _sse("error", str(e))
+
+async def achat_with_memory_events(
+    session_id: str,
+    user_message: str,
+    api_key: Optional[str] = None,
+    base_url: Optional[str] = None,
+    model: Optional[str] = None,
+    system_prompt: Optional[str] = None,
+    search_enabled: bool = False,
+    search_provider: str = "tavily",
+    search_api_key: Optional[str] = None,
+    search_result_count: int = 3,
+    context_report: Optional[Dict] = None,
+    search_deadline: Optional[float] = None,
+    search_hedge_api_key: Optional[str] = None,
+) -> AsyncGenerator[Tuple[str, object], None]:
     """
-    联网搜索，返回搜索结果文本
+    流式对话（异步生成器），产出 (类型, 内容) 事件：status / context / reasoning / content / usage / error。
+    usage 在回复结束后发出，包含本轮输入 token 和命中前缀缓存的 token 数。
+    由 sse.event_stream 合并编码后发给前端
     """
-    if not api_key:
-        return "（未提供搜索 API 密钥）"
-    
+    turn_started = time.perf_counter()
     try:
-        if provider == "tavily":
-            url = "https://api.tavily.com/search"
-            payload = {
-                "api_key": api_key,
-                "query": query,
-                "search_depth": "basic",
-                "max_results": result_count,
-                "include_answer": False,
-                "include_raw_content": False
-            }
-            resp = requests.post(url, json=payload, timeout=10)
-            if resp.status_code == 200:
-                data = resp.json()
-                results = data.get("results", [])
-                if results:
-                    formatted = "\n\n".join([f"{r.get('title', '无标题')}: {r.get('content', '')}" for r in results])
-                    return f"以下是联网搜索到的信息：\n{formatted}"
-                else:
-                    return "（未搜索到相关信息）"
-            else:
-                return f"（搜索失败：HTTP {resp.status_code}）"
-        elif provider == "google_serper":
-            url = "https://google.serper.dev/search"
-            headers = {"X-API-KEY": api_key, "Content-Type": "application/json"}
-            payload = {"q": query, "num": result_count}
-            resp = requests.post(url, json=payload, headers=headers, timeout=10)
-            if resp.status_code == 200:
-                data = resp.json()
-                items = data.get("organic", [])
-                if items:
-                    formatted = "\n\n".join([f"{item.get('title', '无标题')}: {item.get('snippet', '')}" for item in items])
-                    return f"以下是联网搜索到的信息：\n{formatted}"
-                else:
-                    return "（未搜索到相关信息）"
-            else:
-                return f"（搜索失败：HTTP {resp.status_code}）"
-        else:
-            return "（不支持的搜索服务商）"
-    except Exception as e:
-        return f"（搜索出错：{str(e)}）"
-
-def chat_with_memory(
+        async with session_locks.acquire(session_id):
+            metrics.log_span("lock_wait", time.perf_counter() - turn_started, session_id=session_id)
+            history = await asyncio.to_thread(load_history, session_id)
+            summary = await asyncio.to_thread(load_summary, session_id)
+            with metrics.span("recall"):
+                recalled = await asyncio.to_thread(recall_memories, session_id, user_message)
+
+            search_result = None
+            search_status = None
+            if search_enabled and search_api_key:
+                with metrics.span("search", provider=search_provider) as fields:
+                    search_result, search_status = await asearch_web_bounded(
+                        user_message, search_provider, search_api_key, search_result_count, search_deadline, search_hedge_api_key,
+                        session_id)
+                    fields["state"] = search_status["state"]
+            try:
+                route = await asyncio.to_thread(_chat_route, session_id, api_key, base_url, model)
+            except usage_ledger.BudgetExceeded as e:
+                # 超出预算：本轮不写历史
+                yield ("error", str(e))
+                return
+            model_name = route.model
+            messages, report = _build_messages(history, summary, search_result, user_message, system_prompt, model_name, recalled)
+            if search_status is not None:
+                report["search_status"] = search_status
+            if route.task == model_routing.DOWNGRADE:
+                report["downgraded"] = True
+            report["trace_id"] = metrics.current_trace_id()
+            if context_report is not None:
+                context_report.update(report)
+
+            if search_status is not None and search_status["state"] != "ok":
+                # 搜索被跳过或只拿到部分结果时单独告知前端
+                yield ("status", search_status)
+            yield ("context", report)
+            metrics.STREAMS_IN_FLIGHT.inc()
+            try:
+                requested = time.perf_counter()
+                # 开始出字之前的失败会换上游重试，迟迟不出字时会对冲（见 upstream）
+                attempt = await upstream.aopen(route.endpoints, _chat_params(route, messages, stream=True), stream=True,
+                                               session_id=session_id, cost=report["total"] + route.max_tokens)
+                async with attempt:
+                    parts = []
+                    thoughts = []
+                    received = 0
+                    first_token = None
+                    usage = None
+                    try:
+                        async for chunk in attempt:
+                            if getattr(chunk, "usage", None) is not None:
+                                usage = chunk.usage
+                            for frame_type, piece in _stream_frames(chunk):
+                                if first_token is None:
+                                    first_token = time.perf_counter()
+                                    metrics.TTFT_SECONDS.observe(first_token - requested)
+                                    metrics.log_span("upstream_ttft", first_token - requested, model=attempt.endpoint.model,
+                                                     upstream=attempt.endpoint.base_url)
+                                received += 1
+                                if frame_type == "content":
+                                    parts.append(piece)
+                                elif frame_type == "reasoning":
+                                    thoughts.append(piece)
+                                yield (frame_type, piece)
+                        if first_token is not None:
+                            streamed = time.perf_counter() - first_token
+                            if streamed > 0 and received > 1:
+                                metrics.STREAM_TOKENS_PER_SECOND.observe(received / streamed)
+                            metrics.log_span("upstream_stream", streamed, tokens=received,
+                                             usage=context_builder.usage_from_response(usage))
+                    except (asyncio.CancelledError, GeneratorExit):
+                        # 客户端断开：马上关闭上游连接（不再为没人看的 token 付费），保存已生成的部分
+                        await attempt.close()
+                        generated = context_builder.estimate_tokens("".join(thoughts) + "".join(parts))
+                        saved = sse.stream_stats.record_cancel(generated)
+                        print(f"客户端断开（会话 {session_id}），已关闭上游流，估计省下 {saved} 个 token")
+                        if parts:
+                            reply = context_builder.make_message("assistant", "".join(parts))
+                            reply["truncated"] = True
+                            turn = [context_builder.make_message("user", user_message), reply]
+                            history.extend(turn)
+                            await asyncio.to_thread(append_history, session_id, turn)
+                            _schedule_rollover(session_id, history, api_key, base_url, model)
+                        raise
+                    usage = _record_usage(session_id, api_key, base_url, attempt.endpoint.model, usage, route.task)
+                    sse.stream_stats.record_completion(
+                        usage["completion"] if usage is not None and usage["completion"]
+                        else context_builder.estimate_tokens("".join(thoughts) + "".join(parts)))
+                    attempt.grant.settle(usage)
+                    if usage is not None:
+                        yield ("usage", usage)
+                    full_content = "".join(parts)
+                    # 流结束后保存历史
+                    turn = [context_builder.make_message("user", user_message), _assistant_message(full_content, usage)]
+                    history.extend(turn)
+                    await asyncio.to_thread(append_history, session_id, turn)
+                    # 摘要交给后台队列，不拖慢本轮响应
+                    _schedule_rollover(session_id, history, api_key, base_url, model)
+            except admission.Overloaded as e:
+                # 排不上队：本轮不写历史，前端收到 error 事件后可以稍后重试
+                yield ("error", str(e))
+            except Exception as e:
+                import traceback
+                traceback.print_exc()
+                metrics.UPSTREAM_ERRORS.labels(kind="stream").inc()
+                yield ("error", str(e))
+            finally:
+                metrics.STREAMS_IN_FLIGHT.dec()
+    finally:
+        elapsed = time.perf_counter() - turn_started
+        metrics.TURN_SECONDS.labels(mode="stream").observe(elapsed)
+        metrics.log_span("turn", elapsed, session_id=session_id, mode="stream")
+
+async def achat_with_memory_stream(
     session_id: str,
     user_message: str,
     api_key: Optional[str] = None,
@@ -389,61 +709,26 @@ def chat_with_memory(
     search_provider: str = "tavily",
     search_api_key: Optional[str] = None,
     search_result_count: int = 3,
-) -> str:
+    context_report: Optional[Dict] = None,
+    search_deadline: Optional[float] = None,
+    search_hedge_api_key: Optional[str] = None,
+) -> AsyncGenerator[str, None]:
     """
-    普通对话函数（非流式）
+    流式版本（异步生成器），输出格式与 chat_with_memory_stream 相同（每个片段一帧，不合并）
     """
-    history = load_history(session_id)
-    summary = load_summary(session_id)
-
-    messages = []
-    if summary:
-        messages.append({"role": "system", "content": f"历史摘要：{summary}"})
-    for msg in history[-40:]:
-        messages.append({"role": msg["role"], "content": msg["content"]})
-    
-    if search_enabled and search_api_key:
-        search_result = search_web(user_message, search_provider, search_api_key, search_result_count)
-        messages.append({"role": "system", "content": f"联网搜索结果（供参考）：\n{search_result}"})
-    
-    messages.append({"role": "user", "content": user_message})
-    
-    client = _create_client(api_key, base_url)
-    model_name = model if model is not None else DEFAULT_MODEL
-    system = system_prompt if system_prompt is not None else DEFAULT_SYSTEM_PROMPT
-    
-    if messages[0]["role"] != "system":
-        messages.insert(0, {"role": "system", "content": system})
-    else:
-        messages[0]["content"] = f"{system}\n\n{messages[0]['content']}"
-    
-    try:
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=messages,
-            temperature=0.7,
-            max_tokens=2000,
-            stream=False
-        )
-        reply = response.choices[0].message.content
-    except Exception as e:
-        print(f"API 调用失败: {e}")
-        reply = "（抱歉，我现在无法回答，请稍后再试。）"
-    
-    history.append({"role": "user", "content": user_message})
-    history.append({"role": "assistant", "content": reply})
-    
-    if len(history) >= 40:
-        summary_text = generate_summary(history[:-2], api_key, base_url, model)
-        save_summary(session_id, summary_text)
-        history = history[-2:]
-    
-    save_history(session_id, history)
-    return reply
-
-def chat_with_memory_stream(
+    async for frame_type, content in achat_with_memory_events(
+        session_id, user_message, api_key, base_url, model, system_prompt,
+        search_enabled, search_provider, search_api_key, search_result_count, context_report,
+        search_deadline, search_hedge_api_key,
+    ):
+        yield _sse(frame_type, content)
+
+async def aanalyze_document_events(
     session_id: str,
-    user_message: str,
+    filename: str,
+    text: str,
+    digest: str,
+    instruction: Optional[str] = None,
     api_key: Optional[str] = None,
     base_url: Optional[str] = None,
     model: Optional[str] = None,
@@ -452,73 +737,80 @@ def chat_with_memory_stream(
     search_provider: str = "tavily",
     search_api_key: Optional[str] = None,
     search_result_count: int = 3,
-) -> Generator[str, None, None]:
+    search_deadline: Optional[float] = None,
+    search_hedge_api_key: Optional[str] = None,
+) -> AsyncGenerator[Tuple[str, object], None]:
     """
-    流式版本，返回 SSE 格式数据，分别发送 reasoning 和 content
+    分析上传的文档（流式事件）：短文档直接对话；长文档先分段并发提取要点（每段完成时产出一个 progress 事件），
+    再把要点交给 achat_with_memory_events 生成最终回答。分段要点按 (文档哈希, 要求) 缓存
     """
-    history = load_history(session_id)
-    summary = load_summary(session_id)
-
-    messages = []
-    if summary:
-        messages.append({"role": "system", "content": f"历史摘要：{summary}"})
-    for msg in history[-40:]:
-        messages.append({"role": msg["role"], "content": msg["content"]})
-
-    if search_enabled and search_api_key:
-        search_result = search_web(user_message, search_provider, search_api_key, search_result_count)
-        messages.append({"role": "system", "content": f"联网搜索结果（供参考）：\n{search_result}"})
-
-    messages.append({"role": "user", "content": user_message})
-
-    client = _create_client(api_key, base_url)
-    model_name = model if model is not None else DEFAULT_MODEL
-    system = system_prompt if system_prompt is not None else DEFAULT_SYSTEM_PROMPT
-
-    if messages[0]["role"] != "system":
-        messages.insert(0, {"role": "system", "content": system})
+    instruction = (instruction or "").strip() or doc_analysis.DEFAULT_INSTRUCTION
+    if context_builder.estimate_tokens(text) <= doc_analysis.DOC_DIRECT_TOKENS:
+        user_message = doc_analysis.direct_message(filename, instruction, text)
     else:
-        messages[0]["content"] = f"{system}\n\n{messages[0]['content']}"
-
-    try:
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=messages,
-            temperature=0.7,
-            max_tokens=2000,
-            stream=True
-        )
-        full_content = ""
-        reasoning_content = ""
-        for chunk in response:
-            # 发送 reasoning（如果有）
-            if chunk.choices and chunk.choices[0].delta and hasattr(chunk.choices[0].delta, 'reasoning_content') and chunk.choices[0].delta.reasoning_content:
-                reasoning_piece = chunk.choices[0].delta.reasoning_content
-                reasoning_content += reasoning_piece
-                yield f"data: {json.dumps({'type': 'reasoning', 'content': reasoning_piece})}\n\n"
-            # 发送 content（如果有）
-            if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
-                content_piece = chunk.choices[0].delta.content
-                full_content += content_piece
-                yield f"data: {json.dumps({'type': 'content', 'content': content_piece})}\n\n"
-        # 流结束后保存历史
-        history.append({"role": "user", "content": user_message})
-        history.append({"role": "assistant", "content": full_content})
-        if len(history) >= 40:
-            summary_text = generate_summary(history[:-2], api_key, base_url, model)
-            save_summary(session_id, summary_text)
-            history = history[-2:]
-        save_history(session_id, history)
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        yield f"data: {json.dumps({'type': 'error', 'content': str(e)})}\n\n"
+        notes = doc_analysis.notes_cache.get(digest, instruction)
+        if notes is not None:
+            yield ("progress", {"stage": "map", "done": len(notes), "total": len(notes), "cached": True})
+        else:
+            chunks = doc_analysis.chunk_by_tokens(text)
+            yield ("progress", {"stage": "map", "done": 0, "total": len(chunks)})
+            complete = _asummary_complete(api_key, base_url, model, session_id, model_routing.DOC_CHUNK)
+            results: List[Optional[str]] = [None] * len(chunks)
+            done = 0
+            async for index, note in doc_analysis.amap_chunks(chunks, instruction, filename, complete):
+                results[index] = note
+                done += 1
+                yield ("progress", {"stage": "map", "chunk": index, "done": done, "total": len(chunks),
+                                        "failed": note is None})
+            notes = [note if note is not None else "（这一段分析失败）" for note in results]
+            try:
+                reduced = await doc_analysis.areduce_notes(notes, instruction, complete)
+            except Exception as e:
+                print(f"合并文档要点失败: {e}")
+                reduced = None
+            if reduced is not None:
+                notes = reduced
+                if all(note is not None for note in results):
+                    doc_analysis.notes_cache.put(digest, instruction, notes)
+        user_message = doc_analysis.notes_message(filename, instruction, notes)
+
+    async for event in achat_with_memory_events(
+        session_id, user_message, api_key, base_url, model, system_prompt,
+        search_enabled, search_provider, search_api_key, search_result_count,
+        search_deadline=search_deadline, search_hedge_api_key=search_hedge_api_key,
+    ):
+        yield event
 
 def clear_session_memory(session_id: str):
-    """删除该会话的记忆文件"""
-    hist_path = _get_history_path(session_id)
-    sum_path = _get_summary_path(session_id)
-    if os.path.exists(hist_path):
-        os.remove(hist_path)
-    if os.path.exists(sum_path):
-        os.remove(sum_path)
+    """删除该会话的历史、摘要、归档和上传文档的提取缓存"""
+    get_store().clear(session_id)
+    _recall.drop(session_id)
+    get_extractor().forget(session_id)
+
+async def aclear_session_memory(session_id: str):
+    """clear_session_memory 的异步版本：等该会话正在进行的轮次结束后再清空"""
+    async with session_locks.acquire(session_id):
+        await asyncio.to_thread(clear_session_memory, session_id)
+
+async def alist_sessions(sort: str = "last_active", order: str = "desc", limit: int = 50,
+                         cursor: Optional[str] = None) -> Dict:
+    """从会话元数据索引分页列出会话；参数无效时抛出 ValueError"""
+    sessions, next_cursor = await asyncio.to_thread(get_store().list_sessions, sort, order, limit, cursor)
+    return {"sessions": sessions, "next_cursor": next_cursor}
+
+async def arebuild_session_index() -> int:
+    """按存储里的数据重建会话元数据索引，返回会话数"""
+    return await asyncio.to_thread(get_store().rebuild_index)
+
+def export_sessions(fmt: str = "ndjson") -> AsyncGenerator[bytes, None]:
+    """全部会话的导出内容（格式见 session_transfer.EXPORT_FORMATS），边读边产出"""
+    return session_transfer.export_stream(get_store(), fmt)
+
+def _on_imported(session_ids):
+    for session_id in session_ids:
+        _recall.drop(session_id)
+
+async def aimport_sessions(path: str, on_conflict: str = "skip") -> Dict:
+    """导入 export_sessions 产出的文件（三种格式都行），返回导入结果；写过的会话的召回索引会重建"""
+    return await asyncio.to_thread(session_transfer.import_file, get_store(), path, on_conflict,
+                                   on_written=_on_imported)
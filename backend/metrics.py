@@ -0,0 +1,297 @@
+# 杏铃酱 xingling-chat 指标与追踪
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+进程内的指标和请求追踪，不依赖 prometheus_client。
+
+- Counter / Gauge / Histogram：支持标签，线程安全；render() 输出 Prometheus 文本格式（/metrics）
+- 追踪：每个 HTTP 请求一个 trace id（沿用请求头 X-Request-ID，没有则新生成，并写回响应头 X-Trace-Id），
+  保存在 contextvars 里，随 asyncio 任务和 to_thread 自动传递
+- span(stage)：记录一个阶段的耗时，可同时写入某个直方图；设置 XINGLING_TRACE_LOG=1 时
+  每个阶段输出一行 JSON（trace_id / span / ms / 附加字段），XINGLING_TRACE_FILE 指定输出文件（默认标准输出），
+  按 trace_id 过滤就能看到一个慢请求各阶段的耗时
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# ---------- 追踪配置（从环境变量读取）----------
+TRACE_LOG = os.getenv("XINGLING_TRACE_LOG", "0") == "1"
+TRACE_FILE = os.getenv("XINGLING_TRACE_FILE", "")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+
+
+def _format_value(value: float) -> str:
+    value = float(value)
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if value.is_integer() and abs(value) < 1e15 else repr(value)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children: Dict[Tuple[str, ...], object] = {}
+        REGISTRY.append(self)
+
+    def labels(self, **labels):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _default(self):
+        if self.labelnames:
+            raise ValueError(f"{self.name} 需要标签：{', '.join(self.labelnames)}")
+        return self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            children = list(self._children.items())
+        for key, child in sorted(children):
+            lines.extend(child.render(self.name, self.labelnames, key))
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        with self._lock:
+            self.value = value
+
+    def render(self, name, labelnames, key):
+        return [f"{name}{_label_text(labelnames, key)} {_format_value(self.value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+    def dec(self, amount: float = 1.0):
+        self._default().dec(amount)
+
+    def set(self, value: float):
+        self._default().set(value)
+
+
+class _HistogramValue:
+    def __init__(self, buckets: Sequence[float]):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    def render(self, name, labelnames, key):
+        with self._lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            le = 'le="%s"' % _format_value(bound)
+            lines.append(f"{name}_bucket{_label_text(labelnames, key, le)} {cumulative}")
+        le = 'le="+Inf"'
+        lines.append(f"{name}_bucket{_label_text(labelnames, key, le)} {count}")
+        lines.append(f"{name}_sum{_label_text(labelnames, key)} {_format_value(total)}")
+        lines.append(f"{name}_count{_label_text(labelnames, key)} {count}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+
+REGISTRY: List[_Metric] = []
+
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ---------- 指标定义 ----------
+TTFT_SECONDS = Histogram("xingling_ttft_seconds", "从发出请求到收到第一个 token 的时间")
+STREAM_TOKENS_PER_SECOND = Histogram("xingling_stream_tokens_per_second", "流式回复的输出速度（片段/秒）",
+                                     buckets=RATE_BUCKETS)
+TURN_SECONDS = Histogram("xingling_turn_seconds", "一轮对话的总耗时（含排队）", ["mode"])
+SEARCH_SECONDS = Histogram("xingling_search_seconds", "联网搜索请求耗时", ["provider", "outcome"])
+SEARCH_PASSAGES = Counter("xingling_search_passages_total", "搜索结果切出的片段数（按去向：注入 / 重复 / 不相关或超出预算）",
+                          ["outcome"])
+SUMMARY_SECONDS = Histogram("xingling_summary_seconds", "生成摘要的耗时")
+STORE_SECONDS = Histogram("xingling_store_seconds", "会话存储读写耗时", ["op"])
+EXTRACT_SECONDS = Histogram("xingling_extract_seconds", "上传文件的文本提取耗时", ["format", "cached"])
+PROMPT_TOKENS = Counter("xingling_prompt_tokens_total", "发给模型的输入 token 数（按接口返回的 usage）", ["model"])
+PROMPT_CACHED_TOKENS = Counter("xingling_prompt_cached_tokens_total", "输入中命中上游前缀缓存的 token 数", ["model"])
+UPSTREAM_ERRORS = Counter("xingling_upstream_errors_total", "调用模型接口失败的次数", ["kind"])
+STREAMS_IN_FLIGHT = Gauge("xingling_streams_in_flight", "正在进行的流式回复数")
+REQUESTS = Counter("xingling_http_requests_total", "HTTP 请求数", ["path", "status"])
+UPSTREAM_ATTEMPTS = Counter("xingling_upstream_attempts_total", "向各上游发起的请求数（按结果）", ["upstream", "outcome"])
+UPSTREAM_HEDGES = Counter("xingling_upstream_hedges_total", "因迟迟没有开始出字而发起的对冲请求数")
+ADMISSION_ACTIVE = Gauge("xingling_admission_active", "占用上游名额的请求数", ["upstream"])
+ADMISSION_QUEUE = Gauge("xingling_admission_queue_depth", "等待上游名额的请求数", ["upstream", "priority"])
+ADMISSION_WAIT_SECONDS = Histogram("xingling_admission_wait_seconds", "等待上游名额的时间", ["upstream", "priority"])
+ADMISSION_SHED = Counter("xingling_admission_shed_total", "因上游繁忙被拒绝的请求数", ["upstream"])
+
+
+# ---------- 追踪 ----------
+_trace_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("xingling_trace_id", default=None)
+_log_lock = threading.Lock()
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def current_trace_id() -> Optional[str]:
+    return _trace_id.get()
+
+
+def set_trace_id(trace_id: Optional[str]) -> contextvars.Token:
+    return _trace_id.set(trace_id)
+
+
+def reset_trace_id(token: contextvars.Token):
+    _trace_id.reset(token)
+
+
+def log_span(name: str, seconds: float, **fields):
+    if not TRACE_LOG:
+        return
+    record = {"ts": round(time.time(), 3), "trace_id": _trace_id.get(), "span": name,
+              "ms": round(seconds * 1000, 2), **fields}
+    line = json.dumps(record, ensure_ascii=False, default=str)
+    with _log_lock:
+        if TRACE_FILE:
+            with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        else:
+            print(line, flush=True)
+
+
+@contextmanager
+def span(name: str, histogram: Optional[Histogram] = None, labels: Optional[Dict[str, str]] = None,
+         **fields) -> Iterator[Dict]:
+    """
+    记录一个阶段的耗时：写入 histogram（如果给了），并在开启追踪日志时输出一行 JSON。
+    产出一个字典，阶段内可以往里补充要写进日志的字段
+    """
+    extra: Dict = dict(fields)
+    start = time.perf_counter()
+    try:
+        yield extra
+    finally:
+        elapsed = time.perf_counter() - start
+        if histogram is not None:
+            (histogram.labels(**labels) if labels else histogram).observe(elapsed)
+        log_span(name, elapsed, **extra)
+
+
+class TraceMiddleware:
+    """纯 ASGI 中间件：为每个请求设置 trace id 并写进响应头，统计请求数和耗时"""
+
+    def __init__(self, app, header: str = "x-request-id"):
+        self.app = app
+        self.header = header.encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        incoming = dict(scope.get("headers") or []).get(self.header)
+        trace_id = incoming.decode("latin-1")[:64] if incoming else new_trace_id()
+        token = set_trace_id(trace_id)
+        status = {"code": 500}
+        start = time.perf_counter()
+
+        async def send_with_trace(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-trace-id", trace_id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace)
+        finally:
+            # 未知路径（404）合并成一个标签值，避免扫描请求撑大指标
+            path = scope.get("path", "") if status["code"] != 404 else "other"
+            REQUESTS.labels(path=path, status=status["code"]).inc()
+            log_span("request", time.perf_counter() - start, path=path, status=status["code"])
+            reset_trace_id(token)
@@ -0,0 +1,107 @@
+# 杏铃酱 xingling-chat 模型路由
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+按任务类型选择模型和上游，让后台任务不必和对话抢同一个（昂贵的）模型：
+
+- chat：对话回复
+- summary：长期记忆摘要（后台）
+- doc_chunk：长文档的分段要点和合并
+- downgrade：会话或密钥超出当天的 token 预算、且 XINGLING_BUDGET_ACTION=downgrade 时对话改用的路由
+  （见 usage_ledger；没有在 XINGLING_MODEL_ROUTES 里配置时超出预算的对话直接拒绝）
+
+所有配置都在 XINGLING_MODEL_ROUTES（JSON）里，每个任务可以写 base_url / api_key / model / timeout（秒）/
+max_tokens / temperature / priority（interactive 或 background，决定准入排队的优先级）/
+fallbacks（这个任务专用的备用上游，不写时用 XINGLING_UPSTREAM_FALLBACKS），例如把摘要交给本机的小模型：
+{"summary": {"base_url": "http://localhost:11434/v1", "api_key": "ollama", "model": "qwen2.5:3b", "timeout": 60}}
+
+没写的字段沿用默认值（DEFAULT_ROUTES）和请求里的上游、模型；写了 base_url 但没写 api_key 时不带密钥
+（本机服务一般不需要），不会把用户的密钥发给别的服务。
+"""
+import json
+import os
+from typing import Dict, List, Optional
+
+import admission
+import summarizer
+import upstream
+
+# ---------- 路由配置（从环境变量读取）----------
+MODEL_ROUTES: Dict[str, Dict] = json.loads(os.getenv("XINGLING_MODEL_ROUTES", "") or "{}")
+
+CHAT = "chat"
+SUMMARY = "summary"
+DOC_CHUNK = "doc_chunk"
+DOWNGRADE = "downgrade"
+
+# 各任务的默认参数；timeout 为 None 时用 openai 客户端的默认超时
+DEFAULT_ROUTES: Dict[str, Dict] = {
+    CHAT: {"max_tokens": 2000, "temperature": 0.7, "timeout": None, "priority": "interactive"},
+    SUMMARY: {"max_tokens": summarizer.SUMMARY_MAX_TOKENS, "temperature": 0.3, "timeout": None, "priority": "background"},
+    DOC_CHUNK: {"max_tokens": summarizer.SUMMARY_MAX_TOKENS, "temperature": 0.3, "timeout": None, "priority": "interactive"},
+    DOWNGRADE: {"max_tokens": 1000, "temperature": 0.7, "timeout": None, "priority": "interactive"},
+}
+
+PRIORITIES = {"interactive": admission.INTERACTIVE, "background": admission.BACKGROUND}
+
+
+class Route:
+    """一个任务解析后的路由：依次尝试的上游和调用参数"""
+    __slots__ = ("task", "endpoints", "max_tokens", "temperature", "timeout", "priority")
+
+    def __init__(self, task: str, endpoints: List[upstream.Endpoint], max_tokens: int, temperature: float,
+                 timeout: Optional[float], priority: int):
+        self.task = task
+        self.endpoints = endpoints
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.timeout = timeout
+        self.priority = priority
+
+    @property
+    def model(self) -> str:
+        return self.endpoints[0].model
+
+    def params(self, messages: List[Dict]) -> Dict:
+        """chat.completions.create 除 model / stream 以外的参数"""
+        params = {"messages": messages, "temperature": self.temperature, "max_tokens": self.max_tokens}
+        if self.timeout is not None:
+            params["timeout"] = self.timeout
+        return params
+
+
+def _settings(task: str) -> Dict:
+    if task not in DEFAULT_ROUTES:
+        raise ValueError(f"未知的任务类型: {task}")
+    return {**DEFAULT_ROUTES[task], **MODEL_ROUTES.get(task, {})}
+
+
+def configured(task: str) -> bool:
+    """XINGLING_MODEL_ROUTES 里是否单独配置了这个任务"""
+    return bool(MODEL_ROUTES.get(task))
+
+
+def resolve(task: str, api_key: str, base_url: str, model: str) -> Route:
+    """api_key / base_url / model 是请求里的（已补上默认值），路由没有配置的部分沿用它们"""
+    settings = _settings(task)
+    if settings.get("base_url"):
+        api_key, base_url = settings.get("api_key") or upstream.NO_API_KEY, settings["base_url"]
+    endpoints = upstream.endpoints(api_key, base_url, settings.get("model") or model, settings.get("fallbacks"))
+    return Route(task, endpoints, int(settings["max_tokens"]), float(settings["temperature"]),
+                 settings["timeout"], PRIORITIES[settings["priority"]])
+
+
+def describe() -> Dict[str, Dict]:
+    """/status 用：各任务生效的配置（不含密钥）"""
+    result = {}
+    for task in DEFAULT_ROUTES:
+        settings = _settings(task)
+        result[task] = {
+            "base_url": settings.get("base_url") or "（跟随请求）",
+            "model": settings.get("model") or "（跟随请求）",
+            "max_tokens": settings["max_tokens"],
+            "timeout": settings["timeout"],
+            "priority": settings["priority"],
+            "fallbacks": [item["base_url"] for item in settings.get("fallbacks", upstream.UPSTREAM_FALLBACKS)],
+        }
+    return result
@@ -0,0 +1,207 @@
+# 杏铃酱 xingling-chat 旧记忆检索
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+对归档（已并入摘要、移出历史的消息）建立本地 BM25 索引，每轮按用户消息召回最相关的几条旧对话。
+
+- 分词：中日韩文本切成二元组（bigram），单字片段保留单字；英文和数字按词切分并转小写
+- 倒排表用 array 紧凑保存（文档号递增，天然有序），新归档的消息增量加入索引
+- 查询时按文档频率从低到高处理查询词：稀有词在预算内完整遍历倒排表；超出预算的常见词
+  只给得分最高的候选加分（在有序倒排表上二分查找），10 万条归档下单次查询在几毫秒内
+  （见 bench/recall.py）
+- 不依赖任何外部服务；每个会话的索引首次使用时从存储中的归档构建，按 LRU 保留
+- 没有实现基于本地 embedding 模型的向量召回；BM25 已能覆盖"用户提到过的具体事实"这一主要场景
+"""
+import math
+import os
+import re
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+# ---------- 召回配置（从环境变量读取）----------
+RECALL_ENABLED = os.getenv("XINGLING_RECALL", "1") != "0"
+RECALL_TOP_K = int(os.getenv("XINGLING_RECALL_TOP_K", "4"))
+RECALL_SNIPPET_CHARS = int(os.getenv("XINGLING_RECALL_SNIPPET_CHARS", "200"))
+RECALL_CACHE_SESSIONS = int(os.getenv("XINGLING_RECALL_CACHE_SESSIONS", "32"))
+RECALL_BUILD_WAIT = float(os.getenv("XINGLING_RECALL_BUILD_WAIT", "0.2"))
+RECALL_MAX_QUERY_TERMS = 12        # 只用区分度最高（文档频率最低）的若干查询词
+RECALL_POSTING_BUDGET = 8000       # 完整遍历倒排表的总条数上限
+RECALL_PROBE_CANDIDATES = 200      # 超出预算后，只对得分最高的这些候选继续二分查找加分
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_SEGMENT_RE = re.compile(r"[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af\uf900-\ufaff]+|[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    terms: List[str] = []
+    for match in _SEGMENT_RE.finditer(text.lower()):
+        seg = match.group()
+        if seg[0].isascii():
+            terms.append(seg)
+        elif len(seg) == 1:
+            terms.append(seg)
+        else:
+            terms.extend(seg[i:i + 2] for i in range(len(seg) - 1))
+    return terms
+
+
+class BM25Index:
+    """
+    单个会话的增量 BM25 索引。
+    每条倒排记录直接保存 BM25 的词项权重 tf*(k1+1)/(tf+k1*(1-b+b*dl/avgdl))，
+    avgdl 取写入时的平均长度（数据量一大就基本稳定），查询时只需乘以 idf 再累加。
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, Tuple[array, array]] = {}  # term -> (文档号, 词项权重)
+        self._texts: List[Tuple[str, str]] = []  # (role, content)
+        self._total_length = 0
+        self._lock = threading.Lock()
+        self.update_lock = threading.Lock()  # 串行化从存储追加归档的操作
+        self.ready = threading.Event()
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def add(self, messages: List[Dict]):
+        with self._lock:
+            postings = self._postings
+            for msg in messages:
+                doc_id = len(self._texts)
+                terms = tokenize(msg["content"])
+                self._total_length += len(terms)
+                avgdl = self._total_length / (doc_id + 1)
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * len(terms) / avgdl) if avgdl else BM25_K1
+                single = (BM25_K1 + 1) / (1 + norm)  # tf=1 的权重，绝大多数词项都是这种情况
+                for term, tf in Counter(terms).items():
+                    posting = postings.get(term)
+                    if posting is None:
+                        posting = postings[term] = (array("I"), array("f"))
+                    posting[0].append(doc_id)
+                    posting[1].append(single if tf == 1 else tf * (BM25_K1 + 1) / (tf + norm))
+                self._texts.append((msg["role"], msg["content"]))
+
+    def search(self, query: str, k: int = RECALL_TOP_K) -> List[Tuple[float, str, str]]:
+        """返回 [(得分, role, content)]，按得分从高到低"""
+        with self._lock:
+            n = len(self._texts)
+            if not n:
+                return []
+            terms = []
+            for term in set(tokenize(query)):
+                posting = self._postings.get(term)
+                if posting is not None:
+                    terms.append((len(posting[0]), term, posting))
+            terms.sort()
+            terms = terms[:RECALL_MAX_QUERY_TERMS]
+
+            scores: Dict[int, float] = {}
+            budget = RECALL_POSTING_BUDGET
+            probing = False
+            for df, _, (docs, weights) in terms:
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                if not probing and (df <= budget or not scores):
+                    # 倒排表太长且还没有候选时，只看最近的 budget 条（偏向较新的记忆）
+                    start = max(df - budget, 0)
+                    get = scores.get
+                    for doc_id, weight in zip(docs[start:], weights[start:]):
+                        scores[doc_id] = get(doc_id, 0.0) + idf * weight
+                    budget -= df - start
+                    continue
+                if not probing:
+                    probing = True
+                    if len(scores) > RECALL_PROBE_CANDIDATES:
+                        top = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+                        scores = dict(top[:RECALL_PROBE_CANDIDATES])
+                for doc_id in scores:
+                    pos = bisect_left(docs, doc_id)
+                    if pos < df and docs[pos] == doc_id:
+                        scores[doc_id] += idf * weights[pos]
+
+            best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+            return [(score, *self._texts[doc_id]) for doc_id, score in best]
+
+
+class RecallIndexes:
+    """
+    按会话缓存 BM25Index；load_archive(session_id, start) 用来从存储读取归档。
+    冷会话的索引在后台线程构建，查询最多等待 RECALL_BUILD_WAIT 秒，超时的这一轮不召回，
+    避免超大归档的首次构建拖慢对话。
+    """
+
+    def __init__(self, load_archive: Callable[[str, int], List[Dict]], max_sessions: int = RECALL_CACHE_SESSIONS):
+        self.load_archive = load_archive
+        self.max_sessions = max_sessions
+        self._indexes: "OrderedDict[str, BM25Index]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _catch_up(self, session_id: str, index: BM25Index):
+        # 从存储读取索引还没有的那部分归档；重复调用是幂等的
+        with index.update_lock:
+            index.add(self.load_archive(session_id, len(index)))
+
+    def _build(self, session_id: str, index: BM25Index):
+        try:
+            self._catch_up(session_id, index)
+            index.ready.set()
+            self._catch_up(session_id, index)
+        except Exception as e:
+            print(f"构建检索索引失败（会话 {session_id}）: {e}")
+            self.drop(session_id)
+
+    def _get(self, session_id: str) -> Optional[BM25Index]:
+        with self._lock:
+            index = self._indexes.get(session_id)
+            created = index is None
+            if created:
+                index = self._indexes[session_id] = BM25Index()
+                while len(self._indexes) > self.max_sessions:
+                    self._indexes.popitem(last=False)
+            else:
+                self._indexes.move_to_end(session_id)
+        if created:
+            threading.Thread(target=self._build, args=(session_id, index), daemon=True).start()
+        return index if index.ready.wait(RECALL_BUILD_WAIT) else None
+
+    def on_archived(self, session_id: str):
+        """归档新增消息后调用：已加载的索引增量更新，未加载的等首次查询时再构建"""
+        with self._lock:
+            index = self._indexes.get(session_id)
+        if index is not None and index.ready.is_set():
+            self._catch_up(session_id, index)
+
+    def sync(self, session_id: str, archived: int):
+        """
+        多进程部署时归档可能被其他 worker 改过：archived 是存储里当前的归档条数，
+        比已加载的索引多就增量补上，少（会话被清空过）就丢掉索引，下次查询重新构建
+        """
+        with self._lock:
+            index = self._indexes.get(session_id)
+        if index is None or not index.ready.is_set():
+            return
+        if archived < len(index):
+            self.drop(session_id)
+        elif archived > len(index):
+            self._catch_up(session_id, index)
+
+    def drop(self, session_id: str):
+        with self._lock:
+            self._indexes.pop(session_id, None)
+
+    def recall(self, session_id: str, query: str, k: int = RECALL_TOP_K) -> List[str]:
+        """返回格式化好的旧对话片段（"用户: ..." / "助手: ..."）"""
+        if not RECALL_ENABLED or not query.strip():
+            return []
+        index = self._get(session_id)
+        if index is None:
+            return []
+        snippets = []
+        for _, role, content in index.search(query, k):
+            text = content if len(content) <= RECALL_SNIPPET_CHARS else content[:RECALL_SNIPPET_CHARS] + "…"
+            snippets.append(f"{'用户' if role == 'user' else '助手'}: {text}")
+        return snippets
@@ -0,0 +1,223 @@
+# 杏铃酱 xingling-chat 搜索结果精选
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+联网搜索结果注入 prompt 之前的本地后处理，取代原来把每条结果的全文直接拼起来的做法：
+
+1. 切段：每条结果的正文按段落和句子切成不超过 SEARCH_PASSAGE_TOKENS 的片段
+2. 去重：片段按词切成 shingle（连续 SHINGLE_SIZE 个词，中文是二元组，分词同 recall_index），
+   用 bottom-k MinHash 签名（一个哈希函数，保留最小的 MINHASH_SIZE 个值）估计 Jaccard 相似度，
+   达到 SEARCH_DEDUP_THRESHOLD 的片段只保留排在前面的那个（不同网站转载同一段话很常见）。
+   片段最多几百个，直接两两比较签名，不用 LSH 分桶
+3. 排序：以本次的全部片段为语料，按 BM25 对用户消息打分；有片段和用户消息有共同词时，完全没有共同词的片段直接丢掉；
+   得分相同（例如都没有共同词）时保持服务商给的顺序
+4. 预算：按得分从高到低取片段，总量不超过 SEARCH_CONTEXT_TOKENS；每条来源编号并带上标题和链接，
+   同一来源的片段按原文顺序放在一起
+
+所以调大 search_result_count 只会让候选更多，注入的 token 数不变。全部在本地计算，几十条结果在几毫秒内；
+设置 XINGLING_SEARCH_RERANK=0 恢复原来的全文拼接。
+"""
+import heapq
+import math
+import os
+import re
+import threading
+import zlib
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import metrics
+from context_builder import estimate_tokens
+from recall_index import BM25_B, BM25_K1, tokenize
+
+# ---------- 搜索结果精选配置（从环境变量读取）----------
+SEARCH_RERANK = os.getenv("XINGLING_SEARCH_RERANK", "1") != "0"
+SEARCH_CONTEXT_TOKENS = int(os.getenv("XINGLING_SEARCH_CONTEXT_TOKENS", "1200"))
+SEARCH_PASSAGE_TOKENS = int(os.getenv("XINGLING_SEARCH_PASSAGE_TOKENS", "120"))
+SEARCH_DEDUP_THRESHOLD = float(os.getenv("XINGLING_SEARCH_DEDUP_THRESHOLD", "0.7"))
+
+SHINGLE_SIZE = 3
+MINHASH_SIZE = 64
+
+# 句子边界：中文句末标点，或英文句末标点后跟空白
+_SENTENCE_RE = re.compile(r"(?<=[。！？；!?])|(?<=[.;])\s+")
+_CJK_END_RE = re.compile(r"[\u3000-\u303f\u3400-\u9fff\uff00-\uffef]$")
+
+
+def _join(sentences: List[str]) -> str:
+    # 中文句子之间不加空格，英文句子之间加一个
+    text = sentences[0]
+    for sentence in sentences[1:]:
+        text += sentence if _CJK_END_RE.search(text) else " " + sentence
+    return text
+
+
+class Passage:
+    __slots__ = ("source", "order", "text", "tokens", "terms", "score")
+
+    def __init__(self, source: int, order: int, text: str):
+        self.source = source  # 第几条搜索结果
+        self.order = order    # 在这条结果里的顺序
+        self.text = text
+        self.tokens = estimate_tokens(text)
+        self.terms = tokenize(text)
+        self.score = 0.0
+
+
+def split_passages(text: str, max_tokens: int = SEARCH_PASSAGE_TOKENS) -> List[str]:
+    """按段落和句子切分，相邻的短句合并到 max_tokens 以内；单句过长时按字数拆开"""
+    passages: List[str] = []
+    for paragraph in re.split(r"\n\s*\n|\n", text):
+        current, size = [], 0
+        for sentence in _SENTENCE_RE.split(paragraph):
+            sentence = sentence.strip()
+            if not sentence:
+                continue
+            pieces = [sentence[i:i + max_tokens] for i in range(0, len(sentence), max_tokens)]
+            for piece in pieces:
+                tokens = estimate_tokens(piece)
+                if current and size + tokens > max_tokens:
+                    passages.append(_join(current))
+                    current, size = [], 0
+                current.append(piece)
+                size += tokens
+        if current:
+            passages.append(_join(current))
+    return passages
+
+
+def minhash(terms: Sequence[str]) -> Optional[Tuple[int, ...]]:
+    """片段的 bottom-k MinHash 签名（升序）；没有可用词时返回 None（不参与去重）"""
+    if not terms:
+        return None
+    if len(terms) < SHINGLE_SIZE:
+        shingles = {" ".join(terms)}
+    else:
+        shingles = {" ".join(terms[i:i + SHINGLE_SIZE]) for i in range(len(terms) - SHINGLE_SIZE + 1)}
+    # crc32 在各进程之间一致（内置 hash 每次启动都不同），签名可以复现
+    return tuple(heapq.nsmallest(MINHASH_SIZE, {zlib.crc32(s.encode("utf-8")) for s in shingles}))
+
+
+def similarity(a: Tuple[int, ...], b: Tuple[int, ...]) -> float:
+    """两个签名估计的 Jaccard 相似度：并集的最小 k 个值里，两边都有的比例（shingle 少于 k 个时就是精确值）"""
+    union = heapq.nsmallest(MINHASH_SIZE, set(a) | set(b))
+    both = set(a) & set(b)
+    return sum(h in both for h in union) / len(union)
+
+
+def dedupe(passages: List[Passage], threshold: float = SEARCH_DEDUP_THRESHOLD) -> List[Passage]:
+    """去掉和前面某个片段近似重复的片段（保留排在前面的，即服务商排序更靠前的来源）"""
+    kept: List[Passage] = []
+    signatures: List[Tuple[int, ...]] = []
+    for passage in passages:
+        signature = minhash(passage.terms)
+        if signature is not None:
+            if any(similarity(signature, other) >= threshold for other in signatures):
+                continue
+            signatures.append(signature)
+        kept.append(passage)
+    return kept
+
+
+def score(passages: List[Passage], query: str):
+    """以这批片段为语料，按 BM25 给每个片段打分（写入 passage.score）"""
+    query_terms = set(tokenize(query))
+    if not passages or not query_terms:
+        return
+    n = len(passages)
+    avgdl = sum(len(p.terms) for p in passages) / n or 1.0
+    counts = [Counter(p.terms) for p in passages]
+    df = Counter(term for c in counts for term in query_terms if term in c)
+    for passage, tf in zip(passages, counts):
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * len(passage.terms) / avgdl)
+        total = 0.0
+        for term in query_terms:
+            f = tf.get(term)
+            if f:
+                idf = math.log(1 + (n - df[term] + 0.5) / (df[term] + 0.5))
+                total += idf * f * (BM25_K1 + 1) / (f + norm)
+        passage.score = total
+
+
+class PassageStats:
+    """/status 用：累计的候选片段数、去重丢掉的和（不相关或超出预算）没选上的片段数、注入的 token 数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.searches = 0
+        self.candidates = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.kept = 0
+        self.tokens_in = 0
+        self.tokens_out = 0
+
+    def record(self, candidates: int, duplicates: int, dropped: int, kept: int, tokens_in: int, tokens_out: int):
+        with self._lock:
+            self.searches += 1
+            self.candidates += candidates
+            self.duplicates += duplicates
+            self.dropped += dropped
+            self.kept += kept
+            self.tokens_in += tokens_in
+            self.tokens_out += tokens_out
+        metrics.SEARCH_PASSAGES.labels(outcome="kept").inc(kept)
+        metrics.SEARCH_PASSAGES.labels(outcome="duplicate").inc(duplicates)
+        metrics.SEARCH_PASSAGES.labels(outcome="dropped").inc(dropped)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "enabled": SEARCH_RERANK,
+                "context_tokens": SEARCH_CONTEXT_TOKENS,
+                "searches": self.searches,
+                "candidates": self.candidates,
+                "duplicates": self.duplicates,
+                "dropped": self.dropped,
+                "kept": self.kept,
+                "tokens_in": self.tokens_in,
+                "tokens_out": self.tokens_out,
+            }
+
+
+passage_stats = PassageStats()
+
+
+def select(items: List[Dict], query: str, budget: int = SEARCH_CONTEXT_TOKENS) -> List[Tuple[Dict, List[Passage]]]:
+    """
+    对搜索结果（[{"title", "content", "url"}]）切段、去重、排序并按预算选取，
+    返回 [(来源, 选中的片段)]，来源按最相关片段的名次排列，片段按原文顺序
+    """
+    passages = [Passage(source, order, text)
+                for source, item in enumerate(items)
+                for order, text in enumerate(split_passages(item.get("content") or ""))]
+    unique = dedupe(passages)
+    score(unique, query)
+    ranked = sorted(unique, key=lambda p: (-p.score, p.source, p.order))
+    if ranked and ranked[0].score > 0:
+        ranked = [p for p in ranked if p.score > 0]
+
+    chosen: List[Passage] = []
+    used = 0
+    for passage in ranked:
+        if used + passage.tokens <= budget:
+            chosen.append(passage)
+            used += passage.tokens
+    passage_stats.record(len(passages), len(passages) - len(unique), len(unique) - len(chosen), len(chosen),
+                         sum(p.tokens for p in passages), used)
+
+    by_source: Dict[int, List[Passage]] = {}
+    for passage in chosen:  # chosen 按得分排序，字典的插入顺序就是来源的名次
+        by_source.setdefault(passage.source, []).append(passage)
+    return [(items[source], sorted(selected, key=lambda p: p.order)) for source, selected in by_source.items()]
+
+
+def format_selected(selected: List[Tuple[Dict, List[Passage]]]) -> str:
+    """编号列出来源（标题和链接）和选中的片段，方便模型在回答里注明出处"""
+    blocks = []
+    for number, (item, passages) in enumerate(selected, 1):
+        header = f"[{number}] {item.get('title') or '无标题'}"
+        if item.get("url"):
+            header += f"（{item['url']}）"
+        blocks.append(header + "\n" + " …… ".join(p.text for p in passages))
+    return "以下是联网搜索到的信息（按与问题的相关程度节选，[编号] 为来源）：\n" + "\n\n".join(blocks)
@@ -0,0 +1,269 @@
+# 杏铃酱 xingling-chat 会话元数据索引
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+每个会话一行的元数据（SQLite 表 session_meta）：消息数、归档条数、字节数、最近活动时间、摘要版本、标题。
+
+- 随写入增量更新：历史、摘要、归档每次写入时只改这一行（SQLite 后端和写入放在同一个事务里；
+  JSON 后端的索引单独放在 memory_sessions/session_index.db），清空会话时删除这一行。
+  列出会话不再需要扫描目录、打开每个会话的文件
+- 字节数是历史、摘要、归档正文的 UTF-8 字节数之和；标题取会话里第一条用户消息的开头，之后不再改变
+- 最近活动时间是历史最后一次写入的时间；摘要和归档（后台摘要时发生）不算活动
+- 列表按 last_active / messages / bytes / title / session_id 排序，用游标（上一页最后一行的排序值和会话 ID）
+  翻页，翻到多深都只扫一页的行数
+- 索引可以随时从存储里的数据重建（rebuild）：旧数据第一次打开时自动重建一次，也可以手动运行
+  python session_store.py reindex
+"""
+import base64
+import json
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+TITLE_CHARS = 40
+LIST_DEFAULT_LIMIT = 50
+LIST_MAX_LIMIT = 500
+REBUILD_ARCHIVE_PAGE = 1000
+
+SORT_KEYS = ("last_active", "messages", "bytes", "title", "session_id")
+FIELDS = ("session_id", "title", "messages", "archived", "bytes", "last_active", "summary_version")
+
+
+class SqliteConnections:
+    """每个线程一个 SQLite 连接（WAL 模式）"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def get(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+def content_bytes(messages: Iterable[Dict]) -> int:
+    return sum(len(m["content"].encode("utf-8")) for m in messages)
+
+
+def make_title(messages: Iterable[Dict]) -> str:
+    for msg in messages:
+        if msg["role"] == "user" and msg["content"].strip():
+            return " ".join(msg["content"].split())[:TITLE_CHARS]
+    return ""
+
+
+def _encode_cursor(sort: str, order: str, value, session_id: str) -> str:
+    raw = json.dumps([sort, order, value, session_id], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str, sort: str, order: str) -> Tuple[object, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, cursor_order, value, session_id = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise ValueError("无效的翻页游标") from e
+    if (cursor_sort, cursor_order) != (sort, order) or not isinstance(session_id, str):
+        raise ValueError("翻页游标与排序方式不一致")
+    return value, session_id
+
+
+class SessionIndex:
+    """
+    session_meta 表的读写。写入方法可以传入调用方的连接，和它自己的写入放在同一个事务里；
+    不传时用构造时给的连接工厂
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS session_meta (
+        session_id TEXT PRIMARY KEY,
+        title TEXT NOT NULL DEFAULT '',
+        messages INTEGER NOT NULL DEFAULT 0,
+        archived INTEGER NOT NULL DEFAULT 0,
+        history_bytes INTEGER NOT NULL DEFAULT 0,
+        summary_bytes INTEGER NOT NULL DEFAULT 0,
+        archive_bytes INTEGER NOT NULL DEFAULT 0,
+        bytes INTEGER NOT NULL DEFAULT 0,
+        last_active REAL NOT NULL,
+        summary_version INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS idx_meta_last_active ON session_meta(last_active, session_id);
+    CREATE INDEX IF NOT EXISTS idx_meta_messages ON session_meta(messages, session_id);
+    CREATE INDEX IF NOT EXISTS idx_meta_bytes ON session_meta(bytes, session_id);
+    CREATE INDEX IF NOT EXISTS idx_meta_title ON session_meta(title, session_id);
+    CREATE TABLE IF NOT EXISTS session_meta_state (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """
+    _KEEP_TITLE = "title = CASE WHEN title = '' THEN excluded.title ELSE title END"
+    SET_HISTORY = (
+        "INSERT INTO session_meta (session_id, title, messages, history_bytes, bytes, last_active) "
+        "VALUES (?1, ?2, ?3, ?4, ?4, ?5) ON CONFLICT(session_id) DO UPDATE SET "
+        "messages = excluded.messages, history_bytes = excluded.history_bytes, "
+        "bytes = excluded.history_bytes + summary_bytes + archive_bytes, "
+        f"last_active = excluded.last_active, {_KEEP_TITLE}"
+    )
+    APPEND_HISTORY = (
+        "INSERT INTO session_meta (session_id, title, messages, history_bytes, bytes, last_active) "
+        "VALUES (?1, ?2, ?3, ?4, ?4, ?5) ON CONFLICT(session_id) DO UPDATE SET "
+        "messages = messages + excluded.messages, history_bytes = history_bytes + excluded.history_bytes, "
+        "bytes = bytes + excluded.history_bytes, "
+        f"last_active = excluded.last_active, {_KEEP_TITLE}"
+    )
+    SET_SUMMARY = (
+        "INSERT INTO session_meta (session_id, summary_bytes, bytes, last_active, summary_version) "
+        "VALUES (?1, ?2, ?2, ?3, 1) ON CONFLICT(session_id) DO UPDATE SET "
+        "summary_bytes = excluded.summary_bytes, bytes = history_bytes + excluded.summary_bytes + archive_bytes, "
+        "summary_version = summary_version + 1"
+    )
+    ADD_ARCHIVE = (
+        "INSERT INTO session_meta (session_id, title, archived, archive_bytes, bytes, last_active) "
+        "VALUES (?1, ?2, ?3, ?4, ?4, ?5) ON CONFLICT(session_id) DO UPDATE SET "
+        "archived = archived + excluded.archived, archive_bytes = archive_bytes + excluded.archive_bytes, "
+        f"bytes = bytes + excluded.archive_bytes, {_KEEP_TITLE}"
+    )
+
+    def __init__(self, connect: Callable[[], sqlite3.Connection]):
+        self._connect = connect
+        connect().executescript(self.SCHEMA)
+
+    # ---------- 写入 ----------
+
+    def on_history(self, session_id: str, messages: List[Dict], append: bool = False,
+                   conn: Optional[sqlite3.Connection] = None):
+        params = (session_id, make_title(messages), len(messages), content_bytes(messages), time.time())
+        (conn or self._connect()).execute(self.APPEND_HISTORY if append else self.SET_HISTORY, params)
+
+    def on_summary(self, session_id: str, summary: str, conn: Optional[sqlite3.Connection] = None):
+        params = (session_id, len(summary.strip().encode("utf-8")), time.time())
+        (conn or self._connect()).execute(self.SET_SUMMARY, params)
+
+    def on_archive(self, session_id: str, messages: List[Dict], conn: Optional[sqlite3.Connection] = None):
+        params = (session_id, make_title(messages), len(messages), content_bytes(messages), time.time())
+        (conn or self._connect()).execute(self.ADD_ARCHIVE, params)
+
+    def on_clear(self, session_id: str, conn: Optional[sqlite3.Connection] = None):
+        (conn or self._connect()).execute("DELETE FROM session_meta WHERE session_id = ?", (session_id,))
+
+    # ---------- 读取 ----------
+
+    @staticmethod
+    def _row(row) -> Dict:
+        item = dict(zip(FIELDS, row))
+        item["last_active"] = round(item["last_active"], 3)
+        return item
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        row = self._connect().execute(
+            f"SELECT {', '.join(FIELDS)} FROM session_meta WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return self._row(row) if row else None
+
+    def count(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM session_meta").fetchone()[0]
+
+    def list(self, sort: str = "last_active", order: str = "desc", limit: int = LIST_DEFAULT_LIMIT,
+             cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """返回 (一页会话元数据, 下一页的游标)；没有下一页时游标为 None。参数无效时抛出 ValueError"""
+        if sort not in SORT_KEYS:
+            raise ValueError(f"不支持的排序字段: {sort}（可选 {', '.join(SORT_KEYS)}）")
+        if order not in ("asc", "desc"):
+            raise ValueError("order 只能是 asc 或 desc")
+        limit = min(max(int(limit), 1), LIST_MAX_LIMIT)
+        direction, op = ("DESC", "<") if order == "desc" else ("ASC", ">")
+        sql = f"SELECT {', '.join(FIELDS)} FROM session_meta"
+        params: list = []
+        if cursor:
+            value, session_id = _decode_cursor(cursor, sort, order)
+            if sort == "session_id":
+                sql += f" WHERE session_id {op} ?"
+                params.append(session_id)
+            else:
+                sql += f" WHERE ({sort}, session_id) {op} (?, ?)"
+                params.extend((value, session_id))
+        sql += f" ORDER BY {sort} {direction}" + (f", session_id {direction}" if sort != "session_id" else "")
+        sql += " LIMIT ?"
+        params.append(limit + 1)
+        rows = self._connect().execute(sql, params).fetchall()
+        items = [self._row(r) for r in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_cursor = _encode_cursor(sort, order, last[FIELDS.index(sort)], last[0])
+        return items, next_cursor
+
+    # ---------- 重建 ----------
+
+    def built(self) -> bool:
+        row = self._connect().execute("SELECT value FROM session_meta_state WHERE key = 'built'").fetchone()
+        return row is not None
+
+    def rebuild(self, store, last_modified: Optional[Callable[[str], Optional[float]]] = None) -> int:
+        """
+        按存储里的数据重新生成全部元数据，返回会话数。标题、最近活动时间和摘要版本尽量沿用旧索引
+        （标题定下后不再改变，后两项数据里没有）；没有旧值时标题取最早的用户消息，最近活动时间用
+        last_modified 给的时间，再没有就用当前时间
+        """
+        conn = self._connect()
+        previous = {row[0]: row[1:] for row in conn.execute(
+            "SELECT session_id, title, last_active, summary_version FROM session_meta")}
+        now = time.time()
+        rows = []
+        for session_id in store.session_ids():
+            history = store.load_history(session_id)
+            summary = store.load_summary(session_id)
+            archived = archive_bytes = 0
+            title = ""
+            start = 0
+            while True:
+                page = store.load_archive(session_id, start, REBUILD_ARCHIVE_PAGE)
+                if not page:
+                    break
+                title = title or make_title(page)
+                archived += len(page)
+                archive_bytes += content_bytes(page)
+                start += len(page)
+            if not history and not summary and not archived:
+                continue
+            history_bytes = content_bytes(history)
+            summary_bytes = len(summary.encode("utf-8"))
+            old_title, active, version = previous.get(session_id, ("", None, None))
+            title = old_title or title or make_title(history)
+            if active is None:
+                active = (last_modified(session_id) if last_modified else None) or now
+            if version is None:
+                version = 1 if summary else 0
+            rows.append((session_id, title, len(history), archived, history_bytes, summary_bytes, archive_bytes,
+                         history_bytes + summary_bytes + archive_bytes, active, version))
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM session_meta")
+            conn.executemany(
+                "INSERT INTO session_meta (session_id, title, messages, archived, history_bytes, summary_bytes, "
+                "archive_bytes, bytes, last_active, summary_version) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            conn.execute(
+                "INSERT INTO session_meta_state (key, value) VALUES ('built', ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (str(now),),
+            )
+        return len(rows)
@@ -0,0 +1,347 @@
+# 杏铃酱 xingling-chat 会话串行化
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+按 session_id 串行化对话轮次：同一会话的请求按到达顺序排队执行（读历史 → 调模型 → 写历史），
+不同会话之间完全并行。这样两个标签页同时发消息不会互相覆盖历史，摘要也不会重复生成。
+
+异步接口用 acquire()，同步库调用用 acquire_sync()；两者拿的是同一把锁（每个会话一把，线程和协程都能等待，
+按到达顺序交接），同步库调用和异步接口同时处理同一会话时也会排队。
+空闲会话的锁会被移除，锁表大小只与当前活跃会话数有关。
+
+多进程部署（uvicorn --workers N）时调用 enable_process_locks(目录)：进程内的锁拿到之后，
+再拿这个会话自己的锁文件（文件名是会话 ID 的哈希）上的排他文件锁（fcntl.flock，Windows 上 msvcrt.locking），
+不同 worker 处理同一会话时也会排队，不同会话互不影响。本进程里没有其他请求在等这个会话时，
+释放前删除锁文件（目录里只留下活跃会话的锁文件）；别的进程可能已经打开了被删除的文件，
+所以加锁成功后要核对打开的还是路径上现在的那个文件，不是就换新文件重来。
+lease() 用于"整个进程池只执行一次"的后台任务。
+"""
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+LEASE_STRIPES = int(os.getenv("XINGLING_LEASE_STRIPES", "1024"))
+LOCK_POLL_MAX = 0.05  # 等待其他进程释放文件锁时的最长轮询间隔（秒）
+
+
+class FileLock:
+    """跨进程的排他锁，每次加锁打开一个新的文件描述符，解锁时关闭。同一个对象不可重入"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd: Optional[int] = None
+
+    def _lock(self, blocking: bool) -> bool:
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            except OSError:
+                os.close(fd)
+                if blocking:
+                    raise
+                return False
+            except BaseException:
+                os.close(fd)
+                raise
+            if self._is_current(fd):
+                self._fd = fd
+                return True
+            # 等锁期间持有者删掉了这个文件（见 release(remove=True)），换路径上的新文件重来
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _is_current(self, fd: int) -> bool:
+        try:
+            on_disk = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        opened = os.fstat(fd)
+        return (on_disk.st_ino, on_disk.st_dev) == (opened.st_ino, opened.st_dev)
+
+    def try_acquire(self) -> bool:
+        return self._lock(blocking=False)
+
+    def acquire(self):
+        if fcntl is not None:
+            self._lock(blocking=True)
+            return
+        delay = 0.001
+        while not self.try_acquire():
+            time.sleep(delay)
+            delay = min(delay * 2, LOCK_POLL_MAX)
+
+    async def aacquire(self):
+        # 不占用线程池：非阻塞地尝试，拿不到就退避后重试
+        delay = 0.001
+        while not self.try_acquire():
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, LOCK_POLL_MAX)
+
+    def release(self, remove: bool = False):
+        """remove=True 时在解锁前删除锁文件（仍持有锁，删除是安全的；Windows 上打开的文件删不掉，跳过）"""
+        fd, self._fd = self._fd, None
+        if fd is None:
+            return
+        if remove and fcntl is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(fd)
+
+
+class _SessionLock:
+    """
+    线程和协程都可以等待的互斥锁：释放时直接把锁交给排在最前面的等待者（线程用 Event 唤醒，
+    协程通过 call_soon_threadsafe 唤醒），所以是公平的，协程等待时也不占用线程
+    """
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._locked = False
+        self._waiters: deque = deque()  # threading.Event 或 (事件循环, Future)
+
+    def acquire(self):
+        with self._mutex:
+            if not self._locked:
+                self._locked = True
+                return
+            event = threading.Event()
+            self._waiters.append(event)
+        event.wait()  # 醒来时锁已经交给自己
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future())
+        with self._mutex:
+            if not self._locked:
+                self._locked = True
+                return
+            self._waiters.append(waiter)
+        future = waiter[1]
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._mutex:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            if future.done() and not future.cancelled():
+                # 锁已经交给自己，任务却在醒来前被取消了
+                self.release()
+            # 否则 _wake 会发现 Future 已取消，把锁继续往下交
+            raise
+
+    def _wake(self, future: asyncio.Future):
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+    def release(self):
+        with self._mutex:
+            if not self._waiters:
+                self._locked = False
+                return
+            waiter = self._waiters.popleft()
+        if isinstance(waiter, threading.Event):
+            waiter.set()
+        else:
+            loop, future = waiter
+            loop.call_soon_threadsafe(self._wake, future)
+
+
+class _Slot:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = _SessionLock()
+        self.users = 0  # 持有者 + 排队者
+
+
+def session_digest(session_id: str) -> str:
+    """会话 ID 的短哈希，用在公开的统计里"""
+    return hashlib.sha256(session_id.encode("utf-8")).hexdigest()[:12]
+
+
+class SessionLockManager:
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._slots: Dict[str, _Slot] = {}
+        self.acquired = 0
+        self.contended = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.max_depth = 0
+        self.lock_dir: Optional[str] = None
+        self._lock_dir_ready = False
+        self.leases_skipped = 0
+
+    def enable_process_locks(self, lock_dir: str):
+        """开启跨进程锁（多 worker 部署）；lock_dir 是所有 worker 共用的目录，第一次加锁时创建"""
+        self.lock_dir = lock_dir
+        self._lock_dir_ready = False
+
+    def _ensure_lock_dir(self):
+        if not self._lock_dir_ready:
+            os.makedirs(self.lock_dir, exist_ok=True)
+            self._lock_dir_ready = True
+
+    def _file_lock(self, name: str) -> Optional[FileLock]:
+        if self.lock_dir is None:
+            return None
+        self._ensure_lock_dir()
+        digest = hashlib.sha1(name.encode("utf-8")).hexdigest()
+        return FileLock(os.path.join(self.lock_dir, f"session-{digest}.lock"))
+
+    def _enter(self, session_id: str) -> Tuple[_Slot, int]:
+        with self._guard:
+            slot = self._slots.get(session_id)
+            if slot is None:
+                slot = self._slots[session_id] = _Slot()
+            depth = slot.users
+            slot.users += 1
+            self.max_depth = max(self.max_depth, depth)
+        return slot, depth
+
+    def _leave(self, session_id: str, slot: _Slot):
+        with self._guard:
+            slot.users -= 1
+            if slot.users == 0 and self._slots.get(session_id) is slot:
+                del self._slots[session_id]
+
+    def _idle(self, slot: _Slot) -> bool:
+        """本进程里除了当前持有者没有其他请求在等这个会话"""
+        with self._guard:
+            return slot.users <= 1
+
+    def _record(self, waited: float, depth: int):
+        with self._guard:
+            self.acquired += 1
+            if depth:
+                self.contended += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    @asynccontextmanager
+    async def acquire(self, session_id: str):
+        slot, depth = self._enter(session_id)
+        file_lock = self._file_lock(session_id)
+        start = time.perf_counter()
+        try:
+            await slot.lock.aacquire()
+        except BaseException:
+            self._leave(session_id, slot)
+            raise
+        try:
+            if file_lock is not None:
+                await file_lock.aacquire()
+        except BaseException:
+            slot.lock.release()
+            self._leave(session_id, slot)
+            raise
+        self._record(time.perf_counter() - start, depth)
+        try:
+            yield
+        finally:
+            if file_lock is not None:
+                file_lock.release(remove=self._idle(slot))
+            slot.lock.release()
+            self._leave(session_id, slot)
+
+    @contextmanager
+    def acquire_sync(self, session_id: str):
+        slot, depth = self._enter(session_id)
+        file_lock = self._file_lock(session_id)
+        start = time.perf_counter()
+        slot.lock.acquire()
+        try:
+            if file_lock is not None:
+                file_lock.acquire()
+        except BaseException:
+            slot.lock.release()
+            self._leave(session_id, slot)
+            raise
+        self._record(time.perf_counter() - start, depth)
+        try:
+            yield
+        finally:
+            if file_lock is not None:
+                file_lock.release(remove=self._idle(slot))
+            slot.lock.release()
+            self._leave(session_id, slot)
+
+    @contextmanager
+    def lease(self, name: str) -> Iterator[bool]:
+        """
+        跨进程的"只执行一次"：拿到租约时产出 True，其他 worker 正在执行同名任务时产出 False（调用方应跳过）。
+        未开启跨进程锁时总是 True（进程内的去重由调用方负责）
+        """
+        if self.lock_dir is None:
+            yield True
+            return
+        self._ensure_lock_dir()
+        # 租约只用 try_acquire，不会排队等待；按哈希分片让锁文件数量有上限，
+        # 偶尔撞到同一分片只会让其中一个任务推迟到下次触发
+        stripe = int(hashlib.sha1(name.encode("utf-8")).hexdigest()[:8], 16) % LEASE_STRIPES
+        file_lock = FileLock(os.path.join(self.lock_dir, f"lease-{stripe:04d}.lock"))
+        if not file_lock.try_acquire():
+            with self._guard:
+                self.leases_skipped += 1
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            file_lock.release()
+
+    def queue_depth(self, session_id: str) -> int:
+        """该会话当前排队等待的请求数（不含正在执行的那个）"""
+        with self._guard:
+            slot = self._slots.get(session_id)
+            return max(slot.users - 1, 0) if slot is not None else 0
+
+    def stats(self, top: int = 5) -> Dict:
+        with self._guard:
+            slots: List[Tuple[str, _Slot]] = list(self._slots.items())
+            queued = [(sid, slot.users - 1) for sid, slot in slots if slot.users > 1]
+            queued.sort(key=lambda item: item[1], reverse=True)
+            return {
+                "active_sessions": len(slots),
+                "queued": sum(depth for _, depth in queued),
+                # 会话 ID 就是访问会话的凭据，/status 是公开的，只给出短哈希（能对上日志，反推不出 ID）
+                "busiest": [{"session": session_digest(sid), "queue_depth": depth} for sid, depth in queued[:top]],
+                "acquired": self.acquired,
+                "contended": self.contended,
+                "max_queue_depth": self.max_depth,
+                "wait_seconds_total": round(self.wait_total, 6),
+                "wait_seconds_max": round(self.wait_max, 6),
+                "wait_seconds_avg": round(self.wait_total / self.acquired, 6) if self.acquired else 0.0,
+                "process_locks": self.lock_dir is not None,
+                "leases_skipped": self.leases_skipped,
+            }
+
+
+session_locks = SessionLockManager()
@@ -0,0 +1,712 @@
+# 杏铃酱 xingling-chat 会话存储
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+会话历史与摘要的存储后端。
+
+- JsonSessionStore：原来的 memory_sessions/history_<id>.json + summary_<id>.txt 布局，写入改为原子替换
+- SqliteSessionStore：SQLite（WAL 模式），每条消息一行，每轮对话只需追加两行
+- CachedSessionStore：包在任意后端外面的热会话 LRU 缓存，消息以紧凑元组保存
+
+摘要后移出历史的消息不会丢弃，而是追加到归档（archive）里，供 recall_index 检索召回。
+
+通过环境变量 XINGLING_SESSION_STORE 选择后端（sqlite / json，默认 sqlite）。
+首次打开 SQLite 库时会自动把旧的 JSON/TXT 文件迁移进来（只做一次，原文件保留）。
+手动迁移：python session_store.py migrate
+
+多进程部署时每个 worker 有自己的 LRU 缓存：open_store(validate=True) 让缓存每次使用前核对会话的版本
+（SQLite 里每次写入递增的版本号，JSON 文件的 mtime/大小），别的 worker 改过就重新读取。
+
+每次写入同时更新会话元数据索引（session_index），list_sessions 分页列出会话；重建：python session_store.py reindex
+"""
+import glob
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from itertools import islice
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+from session_index import SessionIndex, SqliteConnections
+from session_locks import FileLock
+
+SESSION_STORE_BACKEND = os.getenv("XINGLING_SESSION_STORE", "sqlite")
+SESSION_CACHE_SIZE = int(os.getenv("XINGLING_SESSION_CACHE_SIZE", "256"))
+SQLITE_FILENAME = "sessions.db"
+INDEX_FILENAME = "session_index.db"  # JSON 后端的元数据索引
+
+# 紧凑消息记录：(role, content, extra)，extra 为除 role/content 外的其他字段，没有则为 None
+Record = Tuple[str, str, Optional[Dict]]
+# 批量导入的一项：("session", 会话, 历史, 摘要) 或 ("archive", 会话, 归档消息)
+ImportItem = Tuple
+
+
+def to_record(msg: Dict) -> Record:
+    extra = {k: v for k, v in msg.items() if k not in ("role", "content")}
+    return (sys.intern(msg["role"]), msg["content"], extra or None)
+
+
+def from_record(record: Record) -> Dict:
+    role, content, extra = record
+    msg = {"role": role, "content": content}
+    if extra:
+        msg.update(extra)
+    return msg
+
+
+def _atomic_write(path: str, data: str):
+    """先写临时文件再 os.replace，写到一半崩溃也不会损坏原文件"""
+    tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class SessionStore:
+    """存储接口。history 以消息字典列表表示：{"role": ..., "content": ...}"""
+
+    def load_history(self, session_id: str) -> List[Dict]:
+        raise NotImplementedError
+
+    def save_history(self, session_id: str, history: List[Dict]):
+        """整体替换该会话的历史（摘要后截断时使用）"""
+        raise NotImplementedError
+
+    def append_history(self, session_id: str, messages: List[Dict]):
+        """在历史末尾追加消息（每轮对话使用）"""
+        history = self.load_history(session_id)
+        history.extend(messages)
+        self.save_history(session_id, history)
+
+    def load_summary(self, session_id: str) -> str:
+        raise NotImplementedError
+
+    def save_summary(self, session_id: str, summary: str):
+        raise NotImplementedError
+
+    def archive_messages(self, session_id: str, messages: List[Dict]):
+        """把并入摘要后移出历史的消息追加到归档（供检索召回）"""
+        raise NotImplementedError
+
+    def load_archive(self, session_id: str, start: int = 0, limit: Optional[int] = None) -> List[Dict]:
+        """读取归档中第 start 条之后的消息（最多 limit 条，None 表示全部）"""
+        raise NotImplementedError
+
+    def archive_count(self, session_id: str) -> int:
+        return len(self.load_archive(session_id))
+
+    def version(self, session_id: str) -> Optional[Hashable]:
+        """会话历史或摘要每次改动后都会变化的值，用来判断缓存是否过期；不支持时返回 None"""
+        return None
+
+    def clear(self, session_id: str):
+        raise NotImplementedError
+
+    def has_session(self, session_id: str) -> bool:
+        return bool(self.load_history(session_id) or self.load_summary(session_id) or self.archive_count(session_id))
+
+    def import_sessions(self, items: List[ImportItem], replace: bool = False) -> List[str]:
+        """
+        按顺序写入一批导入记录（见 ImportItem）。目标里已有数据的会话在 replace=False 时跳过，
+        它后面的归档也一起跳过；replace=True 时先清空再写入。返回本批跳过的会话 ID
+        """
+        skipped = set()
+        for kind, session_id, *payload in items:
+            if kind == "session":
+                if self.has_session(session_id):
+                    if not replace:
+                        skipped.add(session_id)
+                        continue
+                    self.clear(session_id)
+                history, summary = payload
+                self.save_history(session_id, history)
+                if summary:
+                    self.save_summary(session_id, summary)
+            elif session_id not in skipped:
+                self.archive_messages(session_id, payload[0])
+        return sorted(skipped)
+
+    def session_ids(self) -> List[str]:
+        raise NotImplementedError
+
+    # ---------- 会话元数据索引（见 session_index）----------
+
+    def list_sessions(self, sort: str = "last_active", order: str = "desc", limit: int = 50,
+                      cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        return self.index.list(sort, order, limit, cursor)
+
+    def session_meta(self, session_id: str) -> Optional[Dict]:
+        return self.index.get(session_id)
+
+    def rebuild_index(self) -> int:
+        return self.index.rebuild(self)
+
+    def ensure_index(self):
+        """索引还没建过（旧数据第一次打开）时从现有数据重建一次"""
+        if not self.index.built():
+            self.rebuild_index()
+
+    def close(self):
+        pass
+
+
+class JsonSessionStore(SessionStore):
+    """原有的文件布局：每个会话一个 history JSON 和一个 summary TXT"""
+
+    def __init__(self, memory_dir: str):
+        self.memory_dir = memory_dir
+        os.makedirs(memory_dir, exist_ok=True)
+        self._index: Optional[SessionIndex] = None
+        self._index_connections: Optional[SqliteConnections] = None
+        self._index_lock = threading.Lock()
+
+    @property
+    def index(self) -> SessionIndex:
+        # 第一次用到时才打开（迁移时作为只读来源的 JsonSessionStore 不会创建索引文件）
+        if self._index is None:
+            with self._index_lock:
+                if self._index is None:
+                    self._index_connections = SqliteConnections(os.path.join(self.memory_dir, INDEX_FILENAME))
+                    self._index = SessionIndex(self._index_connections.get)
+        return self._index
+
+    def history_path(self, session_id: str) -> str:
+        return os.path.join(self.memory_dir, f"history_{session_id}.json")
+
+    def summary_path(self, session_id: str) -> str:
+        return os.path.join(self.memory_dir, f"summary_{session_id}.txt")
+
+    def archive_path(self, session_id: str) -> str:
+        return os.path.join(self.memory_dir, f"archive_{session_id}.jsonl")
+
+    def load_history(self, session_id: str) -> List[Dict]:
+        path = self.history_path(session_id)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return []
+
+    def save_history(self, session_id: str, history: List[Dict]):
+        _atomic_write(self.history_path(session_id), json.dumps(history, ensure_ascii=False, indent=2))
+        self.index.on_history(session_id, history)
+
+    def load_summary(self, session_id: str) -> str:
+        path = self.summary_path(session_id)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read().strip()
+        return ""
+
+    def save_summary(self, session_id: str, summary: str):
+        _atomic_write(self.summary_path(session_id), summary)
+        self.index.on_summary(session_id, summary)
+
+    def archive_messages(self, session_id: str, messages: List[Dict]):
+        # 归档只追加，用 JSON Lines 格式
+        with open(self.archive_path(session_id), "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(m, ensure_ascii=False) + "\n" for m in messages))
+        self.index.on_archive(session_id, messages)
+
+    def load_archive(self, session_id: str, start: int = 0, limit: Optional[int] = None) -> List[Dict]:
+        path = self.archive_path(session_id)
+        if not os.path.exists(path):
+            return []
+        with open(path, "r", encoding="utf-8") as f:
+            lines = islice(f, start, None if limit is None else start + limit)
+            return [json.loads(line) for line in lines if line.strip()]
+
+    def archive_count(self, session_id: str) -> int:
+        path = self.archive_path(session_id)
+        if not os.path.exists(path):
+            return 0
+        with open(path, "rb") as f:
+            return sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 20), b""))
+
+    def version(self, session_id: str) -> Optional[Hashable]:
+        # 写入都是原子替换，换文件后 inode / mtime 至少有一个会变
+        stamps = []
+        for path in (self.history_path(session_id), self.summary_path(session_id)):
+            try:
+                st = os.stat(path)
+                stamps.append((st.st_ino, st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                stamps.append(None)
+        return tuple(stamps)
+
+    def clear(self, session_id: str):
+        for path in (self.history_path(session_id), self.summary_path(session_id), self.archive_path(session_id)):
+            if os.path.exists(path):
+                os.remove(path)
+        self.index.on_clear(session_id)
+
+    def session_ids(self) -> List[str]:
+        ids = set()
+        for pattern, prefix, suffix in (("history_*.json", "history_", ".json"), ("summary_*.txt", "summary_", ".txt")):
+            for path in glob.glob(os.path.join(self.memory_dir, pattern)):
+                ids.add(os.path.basename(path)[len(prefix):-len(suffix)])
+        return sorted(ids)
+
+    def _last_modified(self, session_id: str) -> Optional[float]:
+        try:
+            return os.path.getmtime(self.history_path(session_id))
+        except OSError:
+            return None
+
+    def rebuild_index(self) -> int:
+        return self.index.rebuild(self, self._last_modified)
+
+    def close(self):
+        if self._index_connections is not None:
+            self._index_connections.close()
+
+
+class SqliteSessionStore(SessionStore):
+    """SQLite + WAL，每条消息一行；每个线程一个连接"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        extra TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, id);
+    CREATE TABLE IF NOT EXISTS archive (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        extra TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_archive_session ON archive(session_id, id);
+    CREATE TABLE IF NOT EXISTS summaries (
+        session_id TEXT PRIMARY KEY,
+        summary TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    CREATE TABLE IF NOT EXISTS session_versions (
+        session_id TEXT PRIMARY KEY,
+        version INTEGER NOT NULL
+    );
+    """
+    # 和写入放在同一个事务里；清空会话时也只递增不删除，版本号不会回到旧值
+    BUMP_VERSION = (
+        "INSERT INTO session_versions (session_id, version) VALUES (?, 1) "
+        "ON CONFLICT(session_id) DO UPDATE SET version = version + 1"
+    )
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._connections = SqliteConnections(db_path)
+        self._conn = self._connections.get
+        self._conn().executescript(self.SCHEMA)
+        # 元数据索引放在同一个库里，和每次写入在同一个事务中更新
+        self.index = SessionIndex(self._conn)
+
+    def load_records(self, session_id: str) -> List[Record]:
+        rows = self._conn().execute(
+            "SELECT role, content, extra FROM messages WHERE session_id = ? ORDER BY id", (session_id,)
+        ).fetchall()
+        return [(sys.intern(role), content, json.loads(extra) if extra else None) for role, content, extra in rows]
+
+    def load_history(self, session_id: str) -> List[Dict]:
+        return [from_record(r) for r in self.load_records(session_id)]
+
+    @staticmethod
+    def _rows(session_id: str, messages: Iterable[Dict]):
+        for msg in messages:
+            role, content, extra = to_record(msg)
+            yield session_id, role, content, json.dumps(extra, ensure_ascii=False) if extra else None
+
+    def save_history(self, session_id: str, history: List[Dict]):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            conn.executemany(
+                "INSERT INTO messages (session_id, role, content, extra) VALUES (?, ?, ?, ?)",
+                self._rows(session_id, history),
+            )
+            conn.execute(self.BUMP_VERSION, (session_id,))
+            self.index.on_history(session_id, history, conn=conn)
+
+    def append_history(self, session_id: str, messages: List[Dict]):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT INTO messages (session_id, role, content, extra) VALUES (?, ?, ?, ?)",
+                self._rows(session_id, messages),
+            )
+            conn.execute(self.BUMP_VERSION, (session_id,))
+            self.index.on_history(session_id, messages, append=True, conn=conn)
+
+    def load_summary(self, session_id: str) -> str:
+        row = self._conn().execute("SELECT summary FROM summaries WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0].strip() if row else ""
+
+    def save_summary(self, session_id: str, summary: str):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT INTO summaries (session_id, summary) VALUES (?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET summary = excluded.summary",
+                (session_id, summary),
+            )
+            conn.execute(self.BUMP_VERSION, (session_id,))
+            self.index.on_summary(session_id, summary, conn=conn)
+
+    def archive_messages(self, session_id: str, messages: List[Dict]):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT INTO archive (session_id, role, content, extra) VALUES (?, ?, ?, ?)",
+                self._rows(session_id, messages),
+            )
+            self.index.on_archive(session_id, messages, conn=conn)
+
+    def load_archive(self, session_id: str, start: int = 0, limit: Optional[int] = None) -> List[Dict]:
+        rows = self._conn().execute(
+            "SELECT role, content, extra FROM archive WHERE session_id = ? ORDER BY id LIMIT ? OFFSET ?",
+            (session_id, -1 if limit is None else limit, start),
+        ).fetchall()
+        return [from_record((role, content, json.loads(extra) if extra else None)) for role, content, extra in rows]
+
+    def archive_count(self, session_id: str) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM archive WHERE session_id = ?", (session_id,)).fetchone()[0]
+
+    def version(self, session_id: str) -> Optional[Hashable]:
+        row = self._conn().execute(
+            "SELECT version FROM session_versions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def clear(self, session_id: str):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM summaries WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM archive WHERE session_id = ?", (session_id,))
+            conn.execute(self.BUMP_VERSION, (session_id,))
+            self.index.on_clear(session_id, conn=conn)
+
+    HAS_SESSION = (
+        "SELECT EXISTS(SELECT 1 FROM messages WHERE session_id = ?1) "
+        "OR EXISTS(SELECT 1 FROM summaries WHERE session_id = ?1) "
+        "OR EXISTS(SELECT 1 FROM archive WHERE session_id = ?1)"
+    )
+
+    def has_session(self, session_id: str) -> bool:
+        return bool(self._conn().execute(self.HAS_SESSION, (session_id,)).fetchone()[0])
+
+    def import_sessions(self, items: List[ImportItem], replace: bool = False) -> List[str]:
+        # 整批一个事务：导入大量小会话时不必每个会话提交一次
+        conn = self._conn()
+        skipped = set()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for kind, session_id, *payload in items:
+                if kind == "session":
+                    if conn.execute(self.HAS_SESSION, (session_id,)).fetchone()[0]:
+                        if not replace:
+                            skipped.add(session_id)
+                            continue
+                        for table in ("messages", "summaries", "archive"):
+                            conn.execute(f"DELETE FROM {table} WHERE session_id = ?", (session_id,))
+                        self.index.on_clear(session_id, conn=conn)
+                    history, summary = payload
+                    conn.executemany(
+                        "INSERT INTO messages (session_id, role, content, extra) VALUES (?, ?, ?, ?)",
+                        self._rows(session_id, history),
+                    )
+                    self.index.on_history(session_id, history, conn=conn)
+                    if summary:
+                        conn.execute("INSERT INTO summaries (session_id, summary) VALUES (?, ?)", (session_id, summary))
+                        self.index.on_summary(session_id, summary, conn=conn)
+                    conn.execute(self.BUMP_VERSION, (session_id,))
+                elif session_id not in skipped:
+                    conn.executemany(
+                        "INSERT INTO archive (session_id, role, content, extra) VALUES (?, ?, ?, ?)",
+                        self._rows(session_id, payload[0]),
+                    )
+                    self.index.on_archive(session_id, payload[0], conn=conn)
+        return sorted(skipped)
+
+    def session_ids(self) -> List[str]:
+        rows = self._conn().execute(
+            "SELECT session_id FROM messages UNION SELECT session_id FROM summaries ORDER BY 1"
+        ).fetchall()
+        return [r[0] for r in rows]
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        self._conn().execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
+
+    def close(self):
+        self._connections.close()
+
+
+class CachedSessionStore(SessionStore):
+    """
+    热会话 LRU 缓存（写穿透）。缓存里存 Record 元组而不是字典，
+    追加消息时直接扩展缓存中的列表，不需要重新读取整个会话。
+    validate=True 时（多进程部署）每次命中前核对后端的版本号，其他进程写过的会话会重新读取。
+    """
+
+    def __init__(self, backend: SessionStore, max_sessions: int = SESSION_CACHE_SIZE, validate: bool = False):
+        self.backend = backend
+        self.max_sessions = max_sessions
+        self.validate = validate
+        self._lock = threading.RLock()
+        self._history: "OrderedDict[str, List[Record]]" = OrderedDict()
+        self._summary: Dict[str, str] = {}
+        self._versions: Dict[str, Hashable] = {}  # 仅 validate 模式：缓存内容对应的版本
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def _touch(self, session_id: str):
+        self._history.move_to_end(session_id)
+        while len(self._history) > self.max_sessions:
+            evicted, _ = self._history.popitem(last=False)
+            self._summary.pop(evicted, None)
+            self._versions.pop(evicted, None)
+
+    def _drop(self, session_id: str):
+        self._history.pop(session_id, None)
+        self._summary.pop(session_id, None)
+        self._versions.pop(session_id, None)
+
+    def _fresh(self, session_id: str) -> bool:
+        """validate 模式下核对版本，过期的缓存直接丢掉；调用方不持有 self._lock"""
+        if not self.validate:
+            return True
+        with self._lock:
+            if session_id not in self._history:
+                return False
+            cached = self._versions.get(session_id)
+        if self.backend.version(session_id) == cached:
+            return True
+        with self._lock:
+            if self._versions.get(session_id) == cached:
+                self._drop(session_id)
+                self.stale += 1
+        return False
+
+    def load_history(self, session_id: str) -> List[Dict]:
+        if self._fresh(session_id):
+            with self._lock:
+                records = self._history.get(session_id)
+                if records is not None:
+                    self.hits += 1
+                    self._touch(session_id)
+                    return [from_record(r) for r in records]
+        self.misses += 1
+        # 先取版本再读内容：中间有别的写入时缓存的是旧版本号，下次核对会重新读取
+        version = self.backend.version(session_id) if self.validate else None
+        if isinstance(self.backend, SqliteSessionStore):
+            records = self.backend.load_records(session_id)
+        else:
+            records = [to_record(m) for m in self.backend.load_history(session_id)]
+        with self._lock:
+            self._history[session_id] = records
+            self._summary.pop(session_id, None)
+            if self.validate:
+                self._versions[session_id] = version
+            self._touch(session_id)
+        return [from_record(r) for r in records]
+
+    def _write(self, session_id: str, write, update):
+        """
+        写穿透。validate 模式下只有写之前缓存仍是最新的，才就地更新缓存并记下写后的版本，否则丢掉缓存。
+        （会话的写入都在会话锁内进行，写前写后两次读版本之间不会有其他进程插进来）
+        """
+        before = self.backend.version(session_id) if self.validate else None
+        write()
+        after = self.backend.version(session_id) if self.validate else None
+        with self._lock:
+            if session_id not in self._history:
+                return
+            if self.validate and self._versions.get(session_id) != before:
+                self._drop(session_id)
+                return
+            update()
+            if self.validate:
+                self._versions[session_id] = after
+            self._touch(session_id)
+
+    def save_history(self, session_id: str, history: List[Dict]):
+        # 整体替换：写完后缓存内容就是刚写入的历史；摘要只有写之前缓存是最新的才保留
+        before = self.backend.version(session_id) if self.validate else None
+        self.backend.save_history(session_id, history)
+        after = self.backend.version(session_id) if self.validate else None
+        with self._lock:
+            if self.validate:
+                if session_id not in self._history or self._versions.get(session_id) != before:
+                    self._summary.pop(session_id, None)
+                self._versions[session_id] = after
+            self._history[session_id] = [to_record(m) for m in history]
+            self._touch(session_id)
+
+    def append_history(self, session_id: str, messages: List[Dict]):
+        self._write(session_id, lambda: self.backend.append_history(session_id, messages),
+                    lambda: self._history[session_id].extend(to_record(m) for m in messages))
+
+    def load_summary(self, session_id: str) -> str:
+        if self._fresh(session_id):
+            with self._lock:
+                if session_id in self._summary:
+                    return self._summary[session_id]
+        summary = self.backend.load_summary(session_id)
+        with self._lock:
+            if session_id in self._history:
+                self._summary[session_id] = summary
+        return summary
+
+    def save_summary(self, session_id: str, summary: str):
+        def update():
+            self._summary[session_id] = summary.strip()
+
+        self._write(session_id, lambda: self.backend.save_summary(session_id, summary), update)
+
+    def archive_messages(self, session_id: str, messages: List[Dict]):
+        self.backend.archive_messages(session_id, messages)
+
+    def load_archive(self, session_id: str, start: int = 0, limit: Optional[int] = None) -> List[Dict]:
+        return self.backend.load_archive(session_id, start, limit)
+
+    def archive_count(self, session_id: str) -> int:
+        return self.backend.archive_count(session_id)
+
+    def version(self, session_id: str) -> Optional[Hashable]:
+        return self.backend.version(session_id)
+
+    def clear(self, session_id: str):
+        self.backend.clear(session_id)
+        with self._lock:
+            self._drop(session_id)
+
+    def has_session(self, session_id: str) -> bool:
+        return self.backend.has_session(session_id)
+
+    def import_sessions(self, items: List[ImportItem], replace: bool = False) -> List[str]:
+        skipped = self.backend.import_sessions(items, replace)
+        with self._lock:
+            for item in items:
+                self._drop(item[1])
+        return skipped
+
+    def invalidate(self, session_id: Optional[str] = None):
+        with self._lock:
+            if session_id is None:
+                self._history.clear()
+                self._summary.clear()
+                self._versions.clear()
+            else:
+                self._drop(session_id)
+
+    def session_ids(self) -> List[str]:
+        return self.backend.session_ids()
+
+    def list_sessions(self, sort: str = "last_active", order: str = "desc", limit: int = 50,
+                      cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        return self.backend.list_sessions(sort, order, limit, cursor)
+
+    def session_meta(self, session_id: str) -> Optional[Dict]:
+        return self.backend.session_meta(session_id)
+
+    def rebuild_index(self) -> int:
+        return self.backend.rebuild_index()
+
+    def ensure_index(self):
+        self.backend.ensure_index()
+
+    def close(self):
+        self.invalidate()
+        self.backend.close()
+
+
+def migrate_json_sessions(memory_dir: str, dest: SessionStore, overwrite: bool = False) -> int:
+    """
+    把 memory_dir 下旧的 history_*.json / summary_*.txt 导入 dest，返回迁移的会话数。
+    目标中已有数据的会话默认跳过（可重复运行）。
+    """
+    source = JsonSessionStore(memory_dir)
+    migrated = 0
+    for session_id in source.session_ids():
+        if not overwrite and (dest.load_history(session_id) or dest.load_summary(session_id)):
+            continue
+        try:
+            history = source.load_history(session_id)
+        except (OSError, ValueError) as e:
+            print(f"迁移会话 {session_id} 失败: {e}")
+            continue
+        dest.save_history(session_id, history)
+        archived = source.load_archive(session_id)
+        if archived:
+            dest.archive_messages(session_id, archived)
+        summary = source.load_summary(session_id)
+        if summary:
+            dest.save_summary(session_id, summary)
+        migrated += 1
+    return migrated
+
+
+def open_store(memory_dir: str, backend: str = SESSION_STORE_BACKEND, validate: bool = False) -> SessionStore:
+    """按配置打开存储后端（外面包一层 LRU 缓存；多进程部署时 validate=True）"""
+    if backend not in ("json", "sqlite"):
+        raise ValueError(f"未知的会话存储后端: {backend}")
+    os.makedirs(memory_dir, exist_ok=True)
+    store: SessionStore
+    # 多个 worker 同时启动时只让一个执行迁移和索引重建
+    migrate_lock = FileLock(os.path.join(memory_dir, ".migrate.lock"))
+    migrate_lock.acquire()
+    try:
+        if backend == "json":
+            store = JsonSessionStore(memory_dir)
+        else:
+            store = SqliteSessionStore(os.path.join(memory_dir, SQLITE_FILENAME))
+            if store.get_meta("json_migrated") is None:
+                count = migrate_json_sessions(memory_dir, store)
+                store.set_meta("json_migrated", str(count))
+                if count:
+                    print(f"已从 JSON 文件迁移 {count} 个会话到 {SQLITE_FILENAME}")
+        store.ensure_index()
+    finally:
+        migrate_lock.release()
+    return CachedSessionStore(store, validate=validate)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="会话存储工具")
+    parser.add_argument("command", choices=["migrate", "reindex"])
+    parser.add_argument("--dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "memory_sessions"))
+    parser.add_argument("--overwrite", action="store_true", help="覆盖 SQLite 中已存在的会话")
+    args = parser.parse_args()
+
+    if args.command == "reindex":
+        n = open_store(args.dir).rebuild_index()
+        print(f"索引重建完成：{n} 个会话")
+    else:
+        target = SqliteSessionStore(os.path.join(args.dir, SQLITE_FILENAME))
+        n = migrate_json_sessions(args.dir, target, overwrite=args.overwrite)
+        target.set_meta("json_migrated", str(n))
+        print(f"迁移完成：{n} 个会话")
@@ -0,0 +1,454 @@
+# 杏铃酱 xingling-chat 会话导出与导入
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+服务端保存的全部会话（历史、摘要、归档）整体导出和导入，用于备份或搬到另一台机器。
+
+格式是 NDJSON，每行一条记录：
+  {"type": "header", "format": "xingling-sessions", "version": 1, "exported_at": ...}
+  {"type": "session", "session_id": ..., "summary": ..., "history": [...]}   每个会话一行
+  {"type": "archive", "session_id": ..., "messages": [...]}                  归档分页，紧跟在所属会话后面
+  {"type": "end", "sessions": 会话数, "archive_messages": 归档条数}
+也可以导出成 gzip 压缩的 NDJSON，或 .tar.gz：里面是同样的记录按会话拆开的成员
+（header.ndjson、sessions/<序号>/session.ndjson、sessions/<序号>/archive-<页>.ndjson、end.ndjson）。
+
+- 导出：逐个会话读取，读历史和摘要时持有会话锁（拿到一致的快照），归档按 EXPORT_ARCHIVE_PAGE 条分页读，
+  边读边压缩边发送。除会话 ID 列表外，内存占用只和单个会话的历史加一页归档有关，与总数据量无关；读取绕过会话缓存，
+  不会把热会话挤出去
+- 导入：请求体先按块落盘，再在线程里逐行解析和校验（三种格式自动识别）。会话按 ID 哈希分到
+  IMPORT_WORKERS 条写入通道并行写入，同一会话的记录总在同一条通道里按顺序写；每条通道攒够
+  IMPORT_BATCH_MESSAGES 条消息提交一批（SQLite 下一批一个事务），通道队列有上限，解析再快也不会
+  把内存撑大
+- 校验不通过的记录跳过，结果里报告位置（行号，tar 里是 成员:行号）；会话记录无效时它的归档一起跳过
+- 目标里已有数据的会话默认跳过（on_conflict=skip，可以重复导入）；on_conflict=replace 先清空再写入，
+  写入每个会话时持有它的会话锁，不会和正在进行的对话交错
+- 导出和导入能读写全部会话，默认关闭：设置 XINGLING_ADMIN_TOKEN 后才可用，请求要带
+  Authorization: Bearer <令牌>（或 X-Admin-Token 头）
+"""
+import asyncio
+import gzip
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import os
+import re
+import tarfile
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait as futures_wait
+from typing import AsyncIterator, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import session_store
+from file_ingest import UploadTooLarge
+from session_locks import session_locks
+
+# ---------- 导出导入配置（从环境变量读取）----------
+EXPORT_ARCHIVE_PAGE = int(os.getenv("XINGLING_EXPORT_ARCHIVE_PAGE", "500"))
+EXPORT_FLUSH_BYTES = 64 * 1024
+EXPORT_GZIP_LEVEL = int(os.getenv("XINGLING_EXPORT_GZIP_LEVEL", "6"))
+IMPORT_MAX_BYTES = int(float(os.getenv("XINGLING_IMPORT_MAX_MB", "2048")) * 1024 * 1024)
+IMPORT_WORKERS = int(os.getenv("XINGLING_IMPORT_WORKERS", "4"))
+IMPORT_BATCH_MESSAGES = int(os.getenv("XINGLING_IMPORT_BATCH_MESSAGES", "2000"))
+IMPORT_QUEUE_BATCHES = 2           # 每条写入通道最多排队的批数
+IMPORT_MAX_ERRORS = 50             # 结果里最多列出的错误条数
+ADMIN_TOKEN = os.getenv("XINGLING_ADMIN_TOKEN", "")  # 为空时 /export、/import、/sessions 等管理接口关闭
+
+FORMAT_NAME = "xingling-sessions"
+FORMAT_VERSION = 1
+ROLES = ("system", "user", "assistant")
+MAX_SESSION_ID_LENGTH = 256
+# 会话 ID 会出现在 JSON 后端的文件名里，不允许路径分隔符和控制字符
+_SESSION_ID_RE = re.compile(r"[^/\\\x00-\x1f]+")
+
+# 导出格式 -> (媒体类型, 文件扩展名)
+EXPORT_FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "ndjson.gz": ("application/gzip", "ndjson.gz"),
+    "tar.gz": ("application/gzip", "tar.gz"),
+}
+
+
+class ImportFormatError(ValueError):
+    pass
+
+
+def admin_authorized(authorization: Optional[str], admin_token: Optional[str]) -> bool:
+    """请求是否带了正确的管理令牌（Authorization: Bearer 或 X-Admin-Token）；没配置令牌时一律拒绝"""
+    if not ADMIN_TOKEN:
+        return False
+    supplied = admin_token
+    if not supplied and authorization and authorization[:7].lower() == "bearer ":
+        supplied = authorization[7:].strip()
+    return bool(supplied) and hmac.compare_digest(supplied.encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+
+def _line(record: Dict) -> bytes:
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def _source(store: session_store.SessionStore) -> session_store.SessionStore:
+    # 导出直接读后端，不经过（也不填充）热会话缓存
+    return store.backend if isinstance(store, session_store.CachedSessionStore) else store
+
+
+def _read_session(store: session_store.SessionStore, session_id: str) -> Tuple[List[Dict], str, int]:
+    return store.load_history(session_id), store.load_summary(session_id), store.archive_count(session_id)
+
+
+async def export_records(store: session_store.SessionStore) -> AsyncIterator[Tuple[int, Dict]]:
+    """按导出顺序产出 (会话序号, 记录)；header 和 end 的序号为 0"""
+    source = _source(store)
+    yield 0, {"type": "header", "format": FORMAT_NAME, "version": FORMAT_VERSION,
+              "exported_at": time.strftime("%Y-%m-%dT%H:%M:%S%z")}
+    sessions = archived_total = 0
+    for session_id in await asyncio.to_thread(source.session_ids):
+        # 归档只追加：在锁内记下条数，锁外分页读到这个条数为止，和历史、摘要构成同一时刻的快照
+        async with session_locks.acquire(session_id):
+            history, summary, archived = await asyncio.to_thread(_read_session, source, session_id)
+        if not history and not summary and not archived:
+            continue  # 列出之后被清空了
+        sessions += 1
+        yield sessions, {"type": "session", "session_id": session_id, "summary": summary, "history": history}
+        for start in range(0, archived, EXPORT_ARCHIVE_PAGE):
+            page = await asyncio.to_thread(source.load_archive, session_id, start,
+                                           min(EXPORT_ARCHIVE_PAGE, archived - start))
+            if not page:
+                break
+            archived_total += len(page)
+            yield sessions, {"type": "archive", "session_id": session_id, "messages": page}
+    yield 0, {"type": "end", "sessions": sessions, "archive_messages": archived_total}
+
+
+class _Sink:
+    """tarfile 的输出目标：写入的字节先攒着，由导出生成器取走"""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def _tar_member(tar: tarfile.TarFile, name: str, data: bytes, mtime: float):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(data))
+    tar.members.clear()  # TarFile 会记住写过的每个成员，流式写出用不到
+
+
+async def _tar_stream(records: AsyncIterator[Tuple[int, Dict]]) -> AsyncIterator[bytes]:
+    # 每条记录一个成员，成员大小在写头部时就要知道，单条记录本来就在内存里
+    sink = _Sink()
+    tar = tarfile.open(fileobj=sink, mode="w|", format=tarfile.PAX_FORMAT)
+    now = time.time()
+    page = 0
+    async for index, record in records:
+        kind = record["type"]
+        if kind in ("header", "end"):
+            name = f"{kind}.ndjson"
+        elif kind == "session":
+            name, page = f"sessions/{index:06d}/session.ndjson", 0
+        else:
+            page += 1
+            name = f"sessions/{index:06d}/archive-{page:05d}.ndjson"
+        _tar_member(tar, name, _line(record), now)
+        yield sink.drain()
+    tar.close()
+    yield sink.drain()
+
+
+async def export_stream(store: session_store.SessionStore, fmt: str = "ndjson") -> AsyncIterator[bytes]:
+    """按 fmt（见 EXPORT_FORMATS）编码的导出内容，攒到 EXPORT_FLUSH_BYTES 左右发一块"""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"不支持的导出格式: {fmt}（可选 {', '.join(EXPORT_FORMATS)}）")
+    records = export_records(store)
+    if fmt == "tar.gz":
+        chunks = _tar_stream(records)
+    else:
+        chunks = (_line(record) async for _, record in records)
+    # wbits=31：zlib 直接输出 gzip 封装，压缩级别可调（tarfile 的流模式固定用最高级别，太慢）
+    compressor = zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, 31) if fmt != "ndjson" else None
+    pending: List[bytes] = []
+    size = 0
+    async for chunk in chunks:
+        if compressor is not None:
+            chunk = compressor.compress(chunk)
+        if chunk:
+            pending.append(chunk)
+            size += len(chunk)
+        if size >= EXPORT_FLUSH_BYTES:
+            yield b"".join(pending)
+            pending, size = [], 0
+    if compressor is not None:
+        pending.append(compressor.flush())
+    if pending:
+        yield b"".join(pending)
+
+
+# ---------- 导入 ----------
+
+async def spool(chunks: AsyncIterator[bytes], max_bytes: int = IMPORT_MAX_BYTES) -> str:
+    """把请求体按块写入临时文件，返回路径；超过 max_bytes 时删除并抛出 UploadTooLarge"""
+    size = 0
+    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".import")
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLarge(max_bytes)
+            await asyncio.to_thread(tmp.write, chunk)
+        tmp.close()
+    except BaseException:
+        tmp.close()
+        os.unlink(tmp.name)
+        raise
+    return tmp.name
+
+
+def _lines(text: Iterable[str], prefix: str = "") -> Iterator[Tuple[str, str]]:
+    for number, line in enumerate(text, 1):
+        if line.strip():
+            yield f"{prefix}{number}", line
+
+
+def read_lines(path: str) -> Iterator[Tuple[str, str]]:
+    """按文件内容识别格式（tar.gz / gzip NDJSON / NDJSON），产出 (位置, 一行)"""
+    if tarfile.is_tarfile(path):
+        # 流模式逐个成员读，不在内存里保留成员列表
+        with tarfile.open(path, mode="r|*") as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                # 流模式下的成员不能 seek，套不上 TextIOWrapper，按字节行读再解码
+                f = tar.extractfile(member)
+                yield from _lines((raw.decode("utf-8") for raw in f), f"{member.name}:")
+        return
+    with open(path, "rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    opener = gzip.open if compressed else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        yield from _lines(f)
+
+
+def _check_messages(messages, field: str) -> Optional[str]:
+    if not isinstance(messages, list):
+        return f"{field} 不是数组"
+    for i, msg in enumerate(messages):
+        if not isinstance(msg, dict):
+            return f"{field}[{i}] 不是对象"
+        if msg.get("role") not in ROLES:
+            return f"{field}[{i}] 的 role 无效: {msg.get('role')!r}"
+        if not isinstance(msg.get("content"), str):
+            return f"{field}[{i}] 的 content 不是字符串"
+    return None
+
+
+def validate_record(record) -> Optional[str]:
+    """返回错误说明，记录有效时返回 None"""
+    if not isinstance(record, dict):
+        return "记录不是对象"
+    kind = record.get("type")
+    if kind == "header":
+        if record.get("format") != FORMAT_NAME:
+            return f"不是会话导出文件（format={record.get('format')!r}）"
+        if not isinstance(record.get("version"), int) or record["version"] > FORMAT_VERSION:
+            return f"不支持的导出版本: {record.get('version')!r}"
+        return None
+    if kind == "end":
+        return None
+    if kind not in ("session", "archive"):
+        return f"未知的记录类型: {kind!r}"
+    session_id = record.get("session_id")
+    if (not isinstance(session_id, str) or len(session_id) > MAX_SESSION_ID_LENGTH
+            or not _SESSION_ID_RE.fullmatch(session_id)):
+        return f"会话 ID 无效: {session_id!r}"
+    if kind == "session":
+        if not isinstance(record.get("summary", ""), str):
+            return "summary 不是字符串"
+        return _check_messages(record.get("history", []), "history")
+    return _check_messages(record.get("messages"), "messages")
+
+
+class ImportReport:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.records = 0
+        self.sessions = 0
+        self.archive_messages = 0
+        self.skipped: List[str] = []
+        self.invalid = 0
+        self.errors: List[Dict] = []
+        self.expected: Optional[Dict] = None
+
+    def error(self, where: str, message: str):
+        self.invalid += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append({"at": where, "error": message})
+
+    def written(self, items: List[session_store.ImportItem], skipped: List[str]):
+        skipped_set = set(skipped)
+        with self._lock:
+            for kind, session_id, *payload in items:
+                if session_id in skipped_set:
+                    continue
+                if kind == "session":
+                    self.sessions += 1
+                else:
+                    self.archive_messages += len(payload[0])
+            self.skipped.extend(skipped)
+
+    def to_dict(self, seconds: float) -> Dict:
+        return {
+            "records": self.records,
+            "sessions_imported": self.sessions,
+            "sessions_skipped": len(self.skipped),
+            "skipped_session_ids": self.skipped[:IMPORT_MAX_ERRORS],
+            "archive_messages": self.archive_messages,
+            "invalid_records": self.invalid,
+            "errors": self.errors,
+            # 文件末尾的 end 记录，可以和上面的数字对照；文件被截断时没有
+            "expected": self.expected,
+            "seconds": round(seconds, 3),
+        }
+
+
+_lane_executors: List[ThreadPoolExecutor] = []
+_lane_lock = threading.Lock()
+
+
+def _executors(count: int) -> List[ThreadPoolExecutor]:
+    # 写入线程常驻复用：SQLite 后端每个线程一个连接，每次导入都新建线程会留下一堆连接
+    with _lane_lock:
+        while len(_lane_executors) < count:
+            _lane_executors.append(ThreadPoolExecutor(1, thread_name_prefix="session-import"))
+        return _lane_executors[:count]
+
+
+class _Lane:
+    """一条写入通道：单线程按提交顺序写入自己那部分会话的批次"""
+
+    def __init__(self, executor: ThreadPoolExecutor, store: session_store.SessionStore, replace: bool,
+                 report: ImportReport, on_written: Optional[Callable[[Set[str]], None]]):
+        self.executor = executor
+        self.store = store
+        self.replace = replace
+        self.report = report
+        self.on_written = on_written
+        self.batch: List[session_store.ImportItem] = []
+        self.batch_messages = 0
+        self.skipped: Set[str] = set()
+        self.pending: Deque[Future] = deque()
+
+    def add(self, item: session_store.ImportItem, messages: int):
+        self.batch.append(item)
+        self.batch_messages += max(messages, 1)
+        if self.batch_messages >= IMPORT_BATCH_MESSAGES:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        # 排队的批次到上限时等最早的一批写完，解析跟着慢下来；写入出错时在这里抛出
+        while len(self.pending) >= IMPORT_QUEUE_BATCHES:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(self._write, self.batch))
+        self.batch, self.batch_messages = [], 0
+
+    def drain(self):
+        while self.pending:
+            self.pending.popleft().result()
+
+    def _write(self, batch: List[session_store.ImportItem]):
+        # 之前批次里跳过的会话，它后面的归档也跳过
+        items = [item for item in batch if item[0] == "session" or item[1] not in self.skipped]
+        if self.replace:
+            # 替换会清空已有数据：逐个会话持有会话锁写入，不和正在进行的对话交错
+            # （一批可能涉及上千个会话，不一次全部锁住；代价是每个会话一个事务）
+            skipped = []
+            for session_id, group in itertools.groupby(items, key=lambda item: item[1]):
+                with session_locks.acquire_sync(session_id):
+                    skipped.extend(self.store.import_sessions(list(group), True))
+        else:
+            skipped = self.store.import_sessions(items, False)
+        self.skipped.update(skipped)
+        self.report.written(items, skipped)
+        if self.on_written is not None:
+            self.on_written({item[1] for item in items})
+
+
+def import_file(store: session_store.SessionStore, path: str, on_conflict: str = "skip",
+                workers: int = IMPORT_WORKERS,
+                on_written: Optional[Callable[[Set[str]], None]] = None) -> Dict:
+    """
+    导入一个导出文件（阻塞，应在线程里调用），返回导入结果。
+    on_written 在每批写入后以该批涉及的会话 ID 调用（用来让召回索引等失效）
+    """
+    if on_conflict not in ("skip", "replace"):
+        raise ValueError(f"on_conflict 只能是 skip 或 replace: {on_conflict}")
+    start = time.perf_counter()
+    report = ImportReport()
+    lanes = [_Lane(executor, store, on_conflict == "replace", report, on_written)
+             for executor in _executors(max(workers, 1))]
+    accepted: Set[str] = set()
+    rejected: Set[str] = set()
+    try:
+        for where, line in read_lines(path):
+            report.records += 1
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                report.error(where, f"JSON 解析失败: {e}")
+                continue
+            problem = validate_record(record)
+            if problem is not None:
+                report.error(where, problem)
+                if isinstance(record, dict) and record.get("type") == "session" and isinstance(record.get("session_id"), str):
+                    rejected.add(record["session_id"])
+                continue
+            kind = record["type"]
+            if kind == "header":
+                continue
+            if kind == "end":
+                report.expected = {k: record.get(k) for k in ("sessions", "archive_messages")}
+                continue
+            session_id = record["session_id"]
+            if kind == "session":
+                if session_id in accepted:
+                    report.error(where, f"会话 {session_id} 重复出现")
+                    continue
+                accepted.add(session_id)
+                history = record.get("history", [])
+                item = ("session", session_id, history, record.get("summary", ""))
+                count = len(history)
+            else:
+                if session_id not in accepted:
+                    if session_id not in rejected:
+                        report.error(where, f"归档前没有会话 {session_id} 的会话记录")
+                    continue
+                item = ("archive", session_id, record["messages"])
+                count = len(record["messages"])
+            digest = hashlib.blake2b(session_id.encode("utf-8"), digest_size=4).digest()
+            lanes[int.from_bytes(digest, "big") % len(lanes)].add(item, count)
+        for lane in lanes:
+            lane.flush()
+    except (OSError, EOFError, UnicodeDecodeError, tarfile.TarError, zlib.error) as e:
+        raise ImportFormatError(f"读取导入文件失败: {e}") from e
+    finally:
+        # 出错时也要等已提交的批次结束，之后才能删除导入文件、返回结果
+        futures_wait([f for lane in lanes for f in lane.pending])
+    for lane in lanes:
+        lane.drain()
+    return report.to_dict(time.perf_counter() - start)
@@ -0,0 +1,237 @@
+# 杏铃酱 xingling-chat 流式输出
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+把对话产生的 (类型, 内容) 事件编码成 text/event-stream。
+
+- 合并：连续的同类型文本片段（上游每次往往只给一两个字）攒到 SSE_WINDOW_MS 毫秒或
+  SSE_MAX_BYTES 字节再发一帧，大幅减少写入次数和 TCP 小包；类型切换或出现非文本事件时立即发出
+- 每帧带递增的 id；空闲超过 SSE_HEARTBEAT 秒（例如等待搜索、分段分析时）发送注释行 ": ping"，
+  防止代理和浏览器因为长时间没有数据断开连接
+- 编码：文本片段直接拼接预先生成的帧前缀和 json.encoder 的 C 实现转义结果，不再为每个片段
+  构造字典并调用 json.dumps；中日韩文字按 UTF-8 原样输出，不再转成 \\uXXXX
+
+帧格式与原来兼容：data: {"type": ..., "content": ...}，前端只看 data 行，
+id 行和注释行会被忽略。用 bench/sse_framing.py 对比合并前后的写入次数和字节数。
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from json.encoder import encode_basestring
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+# ---------- 流式输出配置（从环境变量读取）----------
+SSE_WINDOW_MS = float(os.getenv("XINGLING_SSE_WINDOW_MS", "30"))
+SSE_MAX_BYTES = int(os.getenv("XINGLING_SSE_MAX_BYTES", "256"))
+SSE_HEARTBEAT = float(os.getenv("XINGLING_SSE_HEARTBEAT", "15"))
+
+TEXT_TYPES = ("reasoning", "content")
+HEARTBEAT_FRAME = ": ping\n\n"
+HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",  # 关闭 nginx 的响应缓冲
+}
+
+_PREFIXES = {t: f'data: {{"type": "{t}", "content": ' for t in TEXT_TYPES}
+
+Event = Tuple[str, object]
+
+
+def format_event(frame_type: str, content, event_id: int = None) -> str:
+    """编码一帧；文本内容走快速路径"""
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    prefix = _PREFIXES.get(frame_type)
+    if prefix is not None and isinstance(content, str):
+        return f"{head}{prefix}{encode_basestring(content)}}}\n\n"
+    return f"{head}data: {json.dumps({'type': frame_type, 'content': content}, ensure_ascii=False)}\n\n"
+
+
+class StreamStats:
+    """
+    累计统计：输入片段数 / 输出帧数 / 心跳数 / 输出字节数，
+    以及客户端中途断开的回复数和因此省下的上游 token：已完成回复的平均输出 token 数（优先用上游 usage，
+    没有时按文本估算）减去断开前已生成部分的估算 token 数，单位都是 token 而不是 SSE 片段
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.streams = 0
+        self.events = 0
+        self.frames = 0
+        self.heartbeats = 0
+        self.bytes = 0
+        self.completed_replies = 0
+        self.completed_tokens = 0
+        self.cancelled_replies = 0
+        self.cancelled_tokens = 0
+        self.tokens_saved = 0
+
+    def record(self, events: int, frames: int, heartbeats: int, nbytes: int):
+        with self._lock:
+            self.streams += 1
+            self.events += events
+            self.frames += frames
+            self.heartbeats += heartbeats
+            self.bytes += nbytes
+
+    def record_completion(self, tokens: int):
+        """记录一次完整回复（tokens 为输出 token 数）"""
+        with self._lock:
+            self.completed_replies += 1
+            self.completed_tokens += tokens
+
+    def record_cancel(self, tokens: int) -> int:
+        """记录一次中途断开（tokens 为断开前已生成部分的估算 token 数），返回估算省下的 token 数"""
+        with self._lock:
+            average = self.completed_tokens / self.completed_replies if self.completed_replies else 0
+            saved = max(int(average) - tokens, 0)
+            self.cancelled_replies += 1
+            self.cancelled_tokens += tokens
+            self.tokens_saved += saved
+            return saved
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "streams": self.streams,
+                "events": self.events,
+                "frames": self.frames,
+                "heartbeats": self.heartbeats,
+                "bytes": self.bytes,
+                "events_per_frame": round(self.events / self.frames, 2) if self.frames else 0.0,
+                "completed_replies": self.completed_replies,
+                "cancelled_replies": self.cancelled_replies,
+                "cancelled_tokens_generated": self.cancelled_tokens,
+                "upstream_tokens_saved": self.tokens_saved,
+            }
+
+
+stream_stats = StreamStats()
+_draining: set = set()  # 客户端断开后仍在收尾（关闭上游、保存部分回复）的读取任务
+
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+async def event_stream(events: AsyncIterator[Event], window_ms: float = SSE_WINDOW_MS,
+                       max_bytes: int = SSE_MAX_BYTES, heartbeat: float = SSE_HEARTBEAT,
+                       stats: StreamStats = stream_stats) -> AsyncIterator[str]:
+    """
+    把事件流编码成合并后的 SSE 帧。上游在单独的任务里读取，这样攒帧的时间窗和心跳
+    不依赖上游什么时候给下一个片段；客户端断开（本生成器被关闭）时取消上游任务。
+    """
+    loop = asyncio.get_running_loop()
+    buffered: deque = deque()
+    waiter: Optional[asyncio.Future] = None
+    done = object()
+
+    def push(item):
+        buffered.append(item)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def pump():
+        try:
+            async for event in events:
+                push(event)
+        except Exception as e:
+            push(("error", str(e)))
+        finally:
+            push(done)
+
+    async def next_item(timeout: Optional[float]):
+        # 比 asyncio.wait_for(queue.get()) 轻：不必每个片段都创建一个任务
+        nonlocal waiter
+        if not buffered:
+            waiter = loop.create_future()
+            handle = loop.call_later(timeout, _wake, waiter) if timeout is not None else None
+            try:
+                await waiter
+            finally:
+                waiter = None
+                if handle is not None:
+                    handle.cancel()
+        return buffered.popleft() if buffered else None
+
+    reader = loop.create_task(pump())
+    window = window_ms / 1000
+    next_id = 0
+    counts = [0, 0, 0, 0]  # events, frames, heartbeats, bytes
+    pending_type = None
+    pending: list = []
+    pending_bytes = 0
+    flush_at = None
+
+    def emit(frame_type, content) -> str:
+        nonlocal next_id
+        next_id += 1
+        frame = format_event(frame_type, content, next_id)
+        counts[1] += 1
+        counts[3] += len(frame.encode("utf-8"))
+        return frame
+
+    try:
+        while True:
+            if pending:
+                timeout = max(flush_at - time.monotonic(), 0)
+            else:
+                timeout = heartbeat if heartbeat > 0 else None
+            item = await next_item(timeout)
+            if item is None:
+                if pending:
+                    yield emit(pending_type, "".join(pending))
+                    pending, pending_bytes = [], 0
+                else:
+                    counts[2] += 1
+                    counts[3] += len(HEARTBEAT_FRAME)
+                    yield HEARTBEAT_FRAME
+                continue
+
+            if item is done:
+                break
+            counts[0] += 1
+            frame_type, content = item
+            if frame_type in _PREFIXES and isinstance(content, str):
+                if pending and frame_type != pending_type:
+                    yield emit(pending_type, "".join(pending))
+                    pending, pending_bytes = [], 0
+                if not pending:
+                    pending_type = frame_type
+                    flush_at = time.monotonic() + window
+                pending.append(content)
+                pending_bytes += len(content) * 3  # 按 UTF-8 最坏情况估算
+                if pending_bytes >= max_bytes or window <= 0:
+                    yield emit(pending_type, "".join(pending))
+                    pending, pending_bytes = [], 0
+                continue
+
+            if pending:
+                yield emit(pending_type, "".join(pending))
+                pending, pending_bytes = [], 0
+            yield emit(frame_type, content)
+
+        if pending:
+            yield emit(pending_type, "".join(pending))
+    finally:
+        # 客户端断开时这里会被取消：取消读取任务，让上游生成器关闭连接并保存部分回复；
+        # 收尾在读取任务里独立完成，不受本任务的取消影响
+        stats.record(*counts)
+        if not reader.done():
+            reader.cancel()
+            _draining.add(reader)
+            reader.add_done_callback(_draining.discard)
+        try:
+            # shield：本任务再被取消时不连带打断读取任务的收尾
+            await asyncio.shield(reader)
+        except asyncio.CancelledError:
+            # 读取任务还没结束说明是本任务自己被取消了，清理完继续往上抛；
+            # 读取任务被上面取消后结束的那一次取消在这里吞掉
+            if not reader.done():
+                raise
+        except Exception:
+            pass
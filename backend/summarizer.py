@@ -0,0 +1,244 @@
+# 杏铃酱 xingling-chat 摘要生成
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+长期记忆摘要：增量滚动 + 分层 map-reduce + 后台队列。
+
+- 增量：新摘要 = 旧摘要 + 新增对话，让模型在旧摘要基础上合并，而不是只总结最近几十条然后覆盖
+- 分层：新增内容太长（例如粘贴了整份文件）时先按字数切块分别总结（map），
+  再把分段摘要合并进旧摘要（reduce）；分段摘要本身仍然太长时继续往上合并
+- 后台：SummaryWorker 用 asyncio 队列在后台执行，同一会话同时只有一个摘要任务（single-flight），
+  对话轮次不再等待摘要
+- 退避：某个会话的摘要失败后记下失败时间和当时的历史长度，SUMMARY_RETRY_BASE 秒（连续失败时翻倍，
+  最多 SUMMARY_RETRY_MAX 秒）内或新增不到 SUMMARY_RETRY_MESSAGES 条消息时不再提交，
+  上游持续出错时不会每轮对话都多打一次摘要请求
+"""
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+# ---------- 摘要配置（从环境变量读取）----------
+SUMMARY_TRIGGER = int(os.getenv("XINGLING_SUMMARY_TRIGGER", "30"))
+SUMMARY_KEEP_RECENT = int(os.getenv("XINGLING_SUMMARY_KEEP_RECENT", "10"))
+SUMMARY_CHUNK_CHARS = int(os.getenv("XINGLING_SUMMARY_CHUNK_CHARS", "6000"))
+SUMMARY_MAX_TOKENS = int(os.getenv("XINGLING_SUMMARY_MAX_TOKENS", "500"))
+SUMMARY_CONCURRENCY = int(os.getenv("XINGLING_SUMMARY_CONCURRENCY", "4"))
+SUMMARY_WORKERS = int(os.getenv("XINGLING_SUMMARY_WORKERS", "2"))
+SUMMARY_RETRY_BASE = float(os.getenv("XINGLING_SUMMARY_RETRY_BASE", "30"))
+SUMMARY_RETRY_MAX = float(os.getenv("XINGLING_SUMMARY_RETRY_MAX", "1800"))
+SUMMARY_RETRY_MESSAGES = int(os.getenv("XINGLING_SUMMARY_RETRY_MESSAGES", "10"))
+SUMMARY_BACKOFF_SESSIONS = 1024  # 退避记录超过这个数时清掉已经到期的
+
+SUMMARY_SYSTEM_PROMPT = "你是一个善于总结的助手。"
+
+# complete(messages) -> 模型回复文本；失败时抛出异常
+Complete = Callable[[List[Dict]], str]
+AsyncComplete = Callable[[List[Dict]], Awaitable[str]]
+
+
+def transcript_lines(messages: List[Dict]) -> List[str]:
+    return [f"{'用户' if msg['role'] == 'user' else '助手'}: {msg['content']}" for msg in messages]
+
+
+def chunk_texts(lines: List[str], max_chars: int = SUMMARY_CHUNK_CHARS) -> List[str]:
+    """把若干行按总字数切块；单行超过 max_chars 的会被拆开"""
+    chunks: List[str] = []
+    current: List[str] = []
+    size = 0
+    for line in lines:
+        pieces = [line[i:i + max_chars] for i in range(0, len(line), max_chars)] or [""]
+        for piece in pieces:
+            if current and size + len(piece) > max_chars:
+                chunks.append("\n".join(current))
+                current, size = [], 0
+            current.append(piece)
+            size += len(piece) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def build_chunk_request(text: str) -> List[Dict]:
+    return [
+        {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+        {"role": "user", "content": f"请总结以下对话片段，用简洁的语言概括主要话题和关键信息：\n\n{text}"},
+    ]
+
+
+def build_rollup_request(previous_summary: str, new_content: str) -> List[Dict]:
+    if not previous_summary:
+        prompt = f"请总结以下对话内容，用简洁的语言概括主要话题和关键信息：\n\n{new_content}"
+    else:
+        prompt = "\n\n".join([
+            "下面是之前的长期摘要和之后新增的对话内容。请保留旧摘要中仍然重要的信息"
+            "（人物、偏好、约定、具体事实），把新增内容合并进去，输出一份更新后的完整摘要。",
+            f"【历史摘要】\n{previous_summary}",
+            f"【新增内容】\n{new_content}",
+        ])
+    return [
+        {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def summarize(messages: List[Dict], previous_summary: str, complete: Complete,
+              max_chars: int = SUMMARY_CHUNK_CHARS) -> str:
+    """同步版本：逐块 map，再 reduce 进旧摘要"""
+    chunks = chunk_texts(transcript_lines(messages), max_chars)
+    while len(chunks) > 1:
+        chunks = chunk_texts([complete(build_chunk_request(c)) for c in chunks], max_chars)
+    return complete(build_rollup_request(previous_summary, chunks[0] if chunks else ""))
+
+
+async def asummarize(messages: List[Dict], previous_summary: str, complete: AsyncComplete,
+                     max_chars: int = SUMMARY_CHUNK_CHARS, concurrency: int = SUMMARY_CONCURRENCY) -> str:
+    """异步版本：同一层的分块并发总结（受 concurrency 限制）"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def summarize_chunk(text: str) -> str:
+        async with semaphore:
+            return await complete(build_chunk_request(text))
+
+    chunks = chunk_texts(transcript_lines(messages), max_chars)
+    while len(chunks) > 1:
+        partials = await asyncio.gather(*[summarize_chunk(c) for c in chunks])
+        chunks = chunk_texts(list(partials), max_chars)
+    return await complete(build_rollup_request(previous_summary, chunks[0] if chunks else ""))
+
+
+def split_for_rollover(history: List[Dict], trigger: int = SUMMARY_TRIGGER,
+                       keep_recent: int = SUMMARY_KEEP_RECENT) -> int:
+    """返回应当并入摘要的前缀长度；未达到触发条件返回 0"""
+    if len(history) < trigger:
+        return 0
+    return max(len(history) - keep_recent, 0)
+
+
+class _Backoff:
+    __slots__ = ("failures", "retry_at", "size")
+
+    def __init__(self, failures: int, retry_at: float, size: Optional[int]):
+        self.failures = failures
+        self.retry_at = retry_at
+        self.size = size
+
+
+class SummaryWorker:
+    """
+    后台摘要队列。submit() 只登记任务，由固定数量的 worker 协程执行；
+    同一会话已在排队时只更新任务参数，正在执行时会在结束后再跑一次；最近失败过的会话按退避跳过。
+    """
+
+    def __init__(self, workers: int = SUMMARY_WORKERS, retry_base: float = SUMMARY_RETRY_BASE,
+                 retry_max: float = SUMMARY_RETRY_MAX, retry_messages: int = SUMMARY_RETRY_MESSAGES):
+        self.workers = workers
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.retry_messages = retry_messages
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._pending: Dict[str, Callable[[], Awaitable[None]]] = {}
+        self._running: Dict[str, bool] = {}  # session_id -> 执行期间是否又有新提交
+        self._sizes: Dict[str, Optional[int]] = {}  # session_id -> 提交时的历史长度
+        self._backoff: Dict[str, _Backoff] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.completed = 0
+        self.failed = 0
+        self.backed_off = 0
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._tasks:
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self._pending.clear()
+        self._running.clear()
+        self._sizes.clear()
+        self._tasks = [loop.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._loop = None
+
+    def submit(self, session_id: str, job: Callable[[], Awaitable[None]], size: Optional[int] = None):
+        """登记一个摘要任务；size 是提交时的历史长度，失败退避期间新增够 retry_messages 条消息才重试"""
+        if self._backing_off(session_id, size):
+            self.backed_off += 1
+            return
+        self.start()
+        self._sizes[session_id] = size
+        if session_id in self._running:
+            self._running[session_id] = True
+            self._pending[session_id] = job
+            return
+        if session_id not in self._pending:
+            self._queue.put_nowait(session_id)
+        self._pending[session_id] = job
+
+    async def join(self):
+        """等待队列清空（测试和基准脚本用）"""
+        while self._pending or self._running:
+            await asyncio.sleep(0.01)
+
+    def _backing_off(self, session_id: str, size: Optional[int]) -> bool:
+        backoff = self._backoff.get(session_id)
+        if backoff is None or time.monotonic() >= backoff.retry_at:
+            return False
+        return size is None or backoff.size is None or size < backoff.size + self.retry_messages
+
+    def _record_failure(self, session_id: str, size: Optional[int]):
+        previous = self._backoff.get(session_id)
+        failures = previous.failures + 1 if previous is not None else 1
+        delay = min(self.retry_base * (2 ** (failures - 1)), self.retry_max)
+        now = time.monotonic()
+        self._backoff[session_id] = _Backoff(failures, now + delay, size)
+        if len(self._backoff) > SUMMARY_BACKOFF_SESSIONS:
+            for key in [k for k, b in self._backoff.items() if b.retry_at <= now]:
+                del self._backoff[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": len(self._pending),
+            "running": len(self._running),
+            "completed": self.completed,
+            "failed": self.failed,
+            "backing_off": len(self._backoff),
+            "backed_off": self.backed_off,
+        }
+
+    async def _run(self):
+        while True:
+            session_id = await self._queue.get()
+            job = self._pending.pop(session_id, None)
+            size = self._sizes.pop(session_id, None)
+            if job is None:
+                continue
+            self._running[session_id] = False
+            try:
+                await job()
+                self.completed += 1
+                self._backoff.pop(session_id, None)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                self._record_failure(session_id, size)
+                print(f"后台摘要失败（会话 {session_id}）: {e}")
+            finally:
+                resubmitted = self._running.pop(session_id, False)
+                if resubmitted and session_id in self._pending:
+                    if self._backing_off(session_id, self._sizes.get(session_id)):
+                        # 执行期间又提交的任务：刚刚失败，同样要退避
+                        self._pending.pop(session_id, None)
+                        self._sizes.pop(session_id, None)
+                        self.backed_off += 1
+                    else:
+                        self._queue.put_nowait(session_id)
+
+
+summary_worker = SummaryWorker()
@@ -0,0 +1,17 @@
+# 杏铃酱 xingling-chat 测试公共配置
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+后端模块都按顶层模块互相导入（在 backend 目录下运行），这里把 backend 加进 sys.path；
+数据目录指到临时目录，测试不会写进真实的 memory_sessions。在 backend 目录下运行：python -m pytest tests
+"""
+import os
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+os.environ.setdefault("XINGLING_MEMORY_DIR", tempfile.mkdtemp(prefix="xingling-test-"))
+os.environ.setdefault("XINGLING_PRELOAD", "0")
@@ -0,0 +1,45 @@
+# 杏铃酱 xingling-chat 管理接口鉴权测试
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+import session_transfer
+
+ADMIN_ROUTES = [
+    ("get", "/sessions"),
+    ("post", "/sessions/rebuild_index"),
+    ("get", "/export"),
+    ("post", "/import"),
+    ("get", "/usage"),
+]
+
+
+@pytest.fixture
+def client():
+    return TestClient(main.app)
+
+
+@pytest.mark.parametrize("method,path", ADMIN_ROUTES)
+def test_disabled_without_admin_token(client, monkeypatch, method, path):
+    monkeypatch.setattr(session_transfer, "ADMIN_TOKEN", "")
+    r = getattr(client, method)(path, headers={"Authorization": "Bearer anything"})
+    assert r.status_code == 403
+
+
+@pytest.mark.parametrize("method,path", ADMIN_ROUTES)
+def test_wrong_or_missing_token(client, monkeypatch, method, path):
+    monkeypatch.setattr(session_transfer, "ADMIN_TOKEN", "sekrit")
+    assert getattr(client, method)(path).status_code == 401
+    assert getattr(client, method)(path, headers={"Authorization": "Bearer nope"}).status_code == 401
+
+
+def test_admin_token_accepted(client, monkeypatch):
+    monkeypatch.setattr(session_transfer, "ADMIN_TOKEN", "sekrit")
+    r = client.get("/sessions", headers={"Authorization": "Bearer sekrit"})
+    assert r.status_code == 200 and "sessions" in r.json()
+    r = client.post("/sessions/rebuild_index", headers={"X-Admin-Token": "sekrit"})
+    assert r.status_code == 200
+    r = client.get("/usage", params={"group_by": "session"}, headers={"Authorization": "Bearer sekrit"})
+    assert r.status_code == 200 and r.json()["group_by"] == "session"
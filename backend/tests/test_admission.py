@@ -0,0 +1,108 @@
+# 杏铃酱 xingling-chat 准入控制测试
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+import asyncio
+
+import admission
+
+
+def test_cancel_while_queued_then_release():
+    # 排队的请求被取消后、清理执行之前有人 release：不能对已取消的 future 再 set_result
+    async def main():
+        limiter = admission.Limiter("test", concurrency=1)
+        grant = await limiter.acquire("a")
+        queued = asyncio.create_task(limiter.acquire("b"))
+        await asyncio.sleep(0)
+        assert limiter._queued[admission.INTERACTIVE] == 1
+        queued.cancel()
+        limiter.release(grant)
+        assert limiter.active == 0
+        assert limiter._queued[admission.INTERACTIVE] == 0
+        try:
+            await queued
+        except asyncio.CancelledError:
+            pass
+        # 名额没有被泄漏：之后的请求马上拿到
+        again = await asyncio.wait_for(limiter.acquire("c"), 1)
+        limiter.release(again)
+
+    asyncio.run(main())
+
+
+def test_fair_rotation_between_sessions():
+    # 同一优先级内按会话轮转：a 的大量请求不会挤占 b
+    async def main():
+        limiter = admission.Limiter("test", concurrency=1)
+        order = []
+        first = await limiter.acquire("a")
+
+        async def request(session_id):
+            grant = await limiter.acquire(session_id)
+            order.append(session_id)
+            await asyncio.sleep(0)
+            limiter.release(grant)
+
+        tasks = [asyncio.create_task(request("a")) for _ in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(request("b")))
+        await asyncio.sleep(0)
+        limiter.release(first)
+        await asyncio.gather(*tasks)
+        assert order.index("b") <= 1
+
+    asyncio.run(main())
+
+
+def test_interactive_ahead_of_background():
+    async def main():
+        limiter = admission.Limiter("test", concurrency=1)
+        order = []
+        first = await limiter.acquire("x")
+
+        async def request(session_id, priority):
+            grant = await limiter.acquire(session_id, priority)
+            order.append(priority)
+            limiter.release(grant)
+
+        background = asyncio.create_task(request("bg", admission.BACKGROUND))
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(request("fg", admission.INTERACTIVE))
+        await asyncio.sleep(0)
+        limiter.release(first)
+        await asyncio.gather(background, interactive)
+        assert order == [admission.INTERACTIVE, admission.BACKGROUND]
+
+    asyncio.run(main())
+
+
+def test_queue_timeout_sheds(monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_MAX_WAIT", 0.05)
+
+    async def main():
+        limiter = admission.Limiter("test", concurrency=1)
+        grant = await limiter.acquire("a")
+        try:
+            await limiter.acquire("b")
+        except admission.Overloaded as e:
+            assert e.retry_after >= 1
+        else:
+            raise AssertionError("排队超时应当抛出 Overloaded")
+        assert limiter.shed == 1
+        assert limiter._queued[admission.INTERACTIVE] == 0
+        limiter.release(grant)
+
+    asyncio.run(main())
+
+
+def test_controller_evicts_idle_limiters_only():
+    async def main():
+        controller = admission.AdmissionController(max_size=2, idle_ttl=600)
+        async with controller.slot("llm", "http://u", "busy"):
+            busy = controller.limiter("llm", "http://u", "busy")
+            for i in range(5):
+                controller.limiter("llm", "http://u", f"k{i}")
+            assert busy in controller._limiters.values()
+            assert len(controller._limiters) <= 3
+            assert controller.evicted >= 3
+
+    asyncio.run(main())
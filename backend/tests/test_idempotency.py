@@ -0,0 +1,132 @@
+# 杏铃酱 xingling-chat 幂等请求测试
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+import asyncio
+
+import pytest
+
+import idempotency
+
+KEY = ("chat", "s", "k1")
+
+
+def test_concurrent_calls_share_one_generation():
+    async def main():
+        cache = idempotency.IdempotencyCache()
+        calls = []
+
+        async def factory():
+            calls.append(1)
+            await asyncio.sleep(0.02)
+            return "reply"
+
+        results = await asyncio.gather(*(cache.call(KEY, "d", factory) for _ in range(3)))
+        assert [r for r, _ in results] == ["reply"] * 3
+        assert sorted(state for _, state in results) == ["joined", "joined", "started"]
+        # 完成后的重复请求直接回放
+        assert await cache.call(KEY, "d", factory) == ("reply", "replayed")
+        assert len(calls) == 1
+
+    asyncio.run(main())
+
+
+def test_mismatched_payload_is_rejected():
+    async def main():
+        cache = idempotency.IdempotencyCache()
+
+        async def factory():
+            return "reply"
+
+        await cache.call(KEY, "d1", factory)
+        with pytest.raises(idempotency.IdempotencyMismatch):
+            await cache.call(KEY, "d2", factory)
+
+    asyncio.run(main())
+
+
+def test_uncacheable_result_is_not_replayed():
+    async def main():
+        cache = idempotency.IdempotencyCache()
+        replies = iter(["失败", "成功"])
+
+        async def factory():
+            return next(replies)
+
+        ok = lambda result: result != "失败"
+        assert await cache.call(KEY, "d", factory, cacheable=ok) == ("失败", "started")
+        assert await cache.call(KEY, "d", factory, cacheable=ok) == ("成功", "started")
+        assert await cache.call(KEY, "d", factory, cacheable=ok) == ("成功", "replayed")
+
+    asyncio.run(main())
+
+
+async def _collect(events):
+    return [event async for event in events]
+
+
+def test_stream_join_replays_from_start():
+    async def main():
+        cache = idempotency.IdempotencyCache()
+        gate = asyncio.Event()
+
+        async def factory():
+            yield ("content", "a")
+            await gate.wait()
+            yield ("content", "b")
+
+        first, state = cache.stream(KEY, "d", factory)
+        assert state == "started"
+        reader = asyncio.create_task(_collect(first))
+        await asyncio.sleep(0.01)
+        second, state = cache.stream(KEY, "d", factory)
+        assert state == "joined"
+        joined = asyncio.create_task(_collect(second))
+        gate.set()
+        assert await reader == [("content", "a"), ("content", "b")]
+        assert await joined == [("content", "a"), ("content", "b")]
+        replay, state = cache.stream(KEY, "d", factory)
+        assert state == "replayed"
+        assert await _collect(replay) == [("content", "ab")]
+
+    asyncio.run(main())
+
+
+def test_error_stream_is_not_cached():
+    async def main():
+        cache = idempotency.IdempotencyCache()
+
+        async def factory():
+            yield ("error", "上游出错")
+
+        events, _ = cache.stream(KEY, "d", factory)
+        assert await _collect(events) == [("error", "上游出错")]
+        assert not cache.known(KEY, "d")
+
+    asyncio.run(main())
+
+
+def test_abandoned_stream_is_cancelled_and_reports_it():
+    async def main():
+        cache = idempotency.IdempotencyCache(grace=0.01)
+        closed = []
+
+        async def factory():
+            try:
+                yield ("content", "a")
+                await asyncio.sleep(10)
+            finally:
+                closed.append(True)
+
+        events, _ = cache.stream(KEY, "d", factory)
+        assert await events.__anext__() == ("content", "a")
+        flight = cache._flights[KEY]
+        await events.aclose()
+        await asyncio.sleep(0.05)
+        # 生产任务以取消结束（不是正常完成），上游生成器已关闭，失败的生成不缓存
+        assert flight.task.cancelled()
+        assert closed == [True]
+        assert flight.events[-1] == ("error", "生成已取消")
+        assert cache.stats()["abandoned"] == 1
+        assert not cache.known(KEY, "d")
+
+    asyncio.run(main())
@@ -0,0 +1,26 @@
+# 杏铃酱 xingling-chat 数据目录测试
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+import os
+
+import memory_core
+
+
+def test_set_memory_dir_moves_every_store(tmp_path):
+    first, second = tmp_path / "first", tmp_path / "second"
+    usage = {"prompt": 10, "completion": 2, "cached": 0, "reasoning": 0}
+    memory_core.set_memory_dir(str(first))
+    try:
+        memory_core.save_history("s", [{"role": "user", "content": "你好"}])
+        memory_core.get_ledger().record("s", "key", "m", "chat", usage)
+        memory_core.get_ledger().flush()
+        memory_core.set_memory_dir(str(second))
+        # 换目录后看不到旧目录里的数据，新的写入落在新目录
+        assert memory_core.load_history("s") == []
+        memory_core.get_ledger().record("s", "key", "m", "chat", usage)
+        memory_core.get_ledger().flush()
+        assert memory_core.get_extractor().cache_dir == os.path.join(str(second), "extracted")
+        for directory in (first, second):
+            assert (directory / "usage.db").exists()
+    finally:
+        memory_core.close()
@@ -0,0 +1,139 @@
+# 杏铃酱 xingling-chat 会话锁测试
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+
+import session_locks
+
+
+def _no_overlap(log):
+    depth = 0
+    for kind, _ in log:
+        depth += 1 if kind == "in" else -1
+        assert depth <= 1, log
+
+
+def test_threads_and_coroutines_exclude_each_other_in_arrival_order():
+    locks = session_locks.SessionLockManager()
+    log = []
+
+    def sync_worker(tag):
+        with locks.acquire_sync("s"):
+            log.append(("in", tag))
+            time.sleep(0.05)
+            log.append(("out", tag))
+
+    async def async_worker(tag):
+        async with locks.acquire("s"):
+            log.append(("in", tag))
+            await asyncio.sleep(0.05)
+            log.append(("out", tag))
+
+    async def main():
+        first = threading.Thread(target=sync_worker, args=("t1",))
+        first.start()
+        await asyncio.sleep(0.01)
+        a1 = asyncio.create_task(async_worker("a1"))
+        await asyncio.sleep(0.01)
+        second = threading.Thread(target=sync_worker, args=("t2",))
+        second.start()
+        await asyncio.sleep(0.01)
+        a2 = asyncio.create_task(async_worker("a2"))
+        await asyncio.gather(a1, a2)
+        await asyncio.to_thread(first.join)
+        await asyncio.to_thread(second.join)
+
+    asyncio.run(main())
+    _no_overlap(log)
+    assert [tag for kind, tag in log if kind == "in"] == ["t1", "a1", "t2", "a2"]
+    assert locks.stats()["active_sessions"] == 0
+
+
+def test_cancelled_waiter_does_not_leak_the_lock():
+    locks = session_locks.SessionLockManager()
+
+    async def waiter():
+        async with locks.acquire("s"):
+            pass
+
+    async def main():
+        async with locks.acquire("s"):
+            queued = asyncio.create_task(waiter())
+            await asyncio.sleep(0.01)
+        # 锁已经交给 queued，但它在醒来之前被取消
+        queued.cancel()
+        try:
+            await queued
+        except asyncio.CancelledError:
+            pass
+        await asyncio.wait_for(waiter(), 1)
+
+    asyncio.run(main())
+    assert locks.stats()["active_sessions"] == 0
+
+
+def test_stats_do_not_expose_session_ids():
+    locks = session_locks.SessionLockManager()
+
+    async def main():
+        async with locks.acquire("secret-session"):
+            waiter = asyncio.create_task(_hold(locks, "secret-session"))
+            await asyncio.sleep(0.01)
+            stats = locks.stats()
+        await waiter
+        return stats
+
+    stats = asyncio.run(main())
+    assert stats["busiest"] == [{"session": session_locks.session_digest("secret-session"), "queue_depth": 1}]
+    assert "secret-session" not in repr(stats)
+
+
+async def _hold(locks, session_id):
+    async with locks.acquire(session_id):
+        pass
+
+
+def _count(lock_dir, counter, rounds):
+    locks = session_locks.SessionLockManager()
+    locks.enable_process_locks(lock_dir)
+    for _ in range(rounds):
+        with locks.acquire_sync("shared"):
+            with open(counter) as f:
+                value = int(f.read())
+            with open(counter, "w") as f:
+                f.write(str(value + 1))
+
+
+def test_process_locks_serialize_workers(tmp_path):
+    lock_dir = str(tmp_path / "locks")
+    counter = str(tmp_path / "count")
+    with open(counter, "w") as f:
+        f.write("0")
+    workers = [multiprocessing.Process(target=_count, args=(lock_dir, counter, 100)) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(30)
+        assert worker.exitcode == 0
+    with open(counter) as f:
+        assert f.read() == "300"
+    # 空闲会话的锁文件在释放时删掉
+    assert [name for name in os.listdir(lock_dir) if name.startswith("session-")] == []
+
+
+def test_lease_runs_once(tmp_path):
+    locks = session_locks.SessionLockManager()
+    locks.enable_process_locks(str(tmp_path / "locks"))
+    other = session_locks.SessionLockManager()
+    other.enable_process_locks(str(tmp_path / "locks"))
+    with locks.lease("summary:s") as owned:
+        assert owned
+        with other.lease("summary:s") as also:
+            assert not also
+    with other.lease("summary:s") as owned:
+        assert owned
+    assert other.stats()["leases_skipped"] == 1
@@ -0,0 +1,92 @@
+# 杏铃酱 xingling-chat 会话存储测试
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+import pytest
+
+import session_store
+
+BACKENDS = ["sqlite", "json"]
+
+
+def _msg(role, content, **extra):
+    return {"role": role, "content": content, **extra}
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request):
+    return request.param
+
+
+def test_round_trip(tmp_path, backend):
+    store = session_store.open_store(str(tmp_path), backend)
+    history = [_msg("user", "你好"), _msg("assistant", "嗨", usage={"prompt": 3})]
+    store.save_history("s", history)
+    store.append_history("s", [_msg("user", "再见")])
+    store.save_summary("s", "摘要")
+    store.archive_messages("s", [_msg("user", f"旧 {i}") for i in range(5)])
+    store.close()
+
+    reopened = session_store.open_store(str(tmp_path), backend)
+    assert reopened.load_history("s") == history + [_msg("user", "再见")]
+    assert reopened.load_summary("s") == "摘要"
+    assert reopened.archive_count("s") == 5
+    assert [m["content"] for m in reopened.load_archive("s", 1, 2)] == ["旧 1", "旧 2"]
+    reopened.clear("s")
+    assert reopened.load_history("s") == [] and not reopened.has_session("s")
+    reopened.close()
+
+
+def test_version_changes_on_every_write(tmp_path, backend):
+    store = session_store.open_store(str(tmp_path), backend)
+    seen = {store.version("s")}
+    store.save_history("s", [_msg("user", "1")])
+    seen.add(store.version("s"))
+    store.append_history("s", [_msg("assistant", "2")])
+    seen.add(store.version("s"))
+    store.save_summary("s", "摘要")
+    seen.add(store.version("s"))
+    assert len(seen) == 4
+    store.close()
+
+
+def test_validating_caches_see_other_workers_writes(tmp_path, backend):
+    # 两个带缓存的存储共用一份数据，模拟两个 worker
+    a = session_store.open_store(str(tmp_path), backend, validate=True)
+    b = session_store.open_store(str(tmp_path), backend, validate=True)
+    a.save_history("s", [_msg("user", "1")])
+    assert b.load_history("s") == [_msg("user", "1")]
+    a.append_history("s", [_msg("assistant", "2")])
+    assert b.load_history("s") == [_msg("user", "1"), _msg("assistant", "2")]
+    assert b.stale >= 1
+    # b 在缓存过期的情况下追加，不能丢掉 a 写的内容
+    a.append_history("s", [_msg("user", "3")])
+    b.append_history("s", [_msg("assistant", "4")])
+    expected = [m["content"] for m in a.load_history("s")]
+    assert expected == ["1", "2", "3", "4"]
+    assert [m["content"] for m in b.load_history("s")] == expected
+    a.save_summary("s", "新摘要")
+    assert b.load_summary("s") == "新摘要"
+    a.close()
+    b.close()
+
+
+def test_cache_hits_without_validation(tmp_path):
+    store = session_store.open_store(str(tmp_path), "sqlite")
+    store.save_history("s", [_msg("user", "1")])
+    store.load_history("s")
+    store.load_history("s")
+    assert store.hits >= 1
+    store.close()
+
+
+def test_import_skips_or_replaces_existing_sessions(tmp_path, backend):
+    store = session_store.open_store(str(tmp_path), backend)
+    store.save_history("old", [_msg("user", "原来的")])
+    items = [("session", "old", [_msg("user", "导入的")], "摘要"), ("session", "new", [_msg("user", "新")], "")]
+    assert store.import_sessions(items) == ["old"]
+    assert store.load_history("old") == [_msg("user", "原来的")]
+    assert store.load_history("new") == [_msg("user", "新")]
+    assert store.import_sessions(items, replace=True) == []
+    assert store.load_history("old") == [_msg("user", "导入的")]
+    assert store.load_summary("old") == "摘要"
+    store.close()
@@ -0,0 +1,140 @@
+# 杏铃酱 xingling-chat 流式输出测试
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+import asyncio
+import json
+
+import sse
+
+
+async def _events(items, delay=0.0):
+    for item in items:
+        if delay:
+            await asyncio.sleep(delay)
+        yield item
+
+
+def _frames(events, **options):
+    async def main():
+        stats = sse.StreamStats()
+        frames = [frame async for frame in sse.event_stream(events, stats=stats, **options)]
+        return frames, stats
+
+    return asyncio.run(main())
+
+
+def _data(frames):
+    return [json.loads(line[len("data: "):]) for frame in frames for line in frame.splitlines()
+            if line.startswith("data: ")]
+
+
+def test_format_event_matches_json():
+    for frame_type, content in [("content", '引号"和\\反斜杠\n'), ("reasoning", "想"), ("usage", {"prompt": 1})]:
+        frame = sse.format_event(frame_type, content, 7)
+        assert frame.startswith("id: 7\n") and frame.endswith("\n\n")
+        assert _data([frame]) == [{"type": frame_type, "content": content}]
+    # 中日韩文字原样输出
+    assert "杏铃" in sse.format_event("content", "杏铃")
+
+
+def test_text_fragments_are_coalesced_in_order():
+    items = [("content", c) for c in "你好世界"] + [("reasoning", "想"), ("content", "!"), ("usage", {"prompt": 1})]
+    frames, stats = _frames(_events(items), window_ms=1000, max_bytes=10_000, heartbeat=0)
+    assert _data(frames) == [
+        {"type": "content", "content": "你好世界"},
+        {"type": "reasoning", "content": "想"},
+        {"type": "content", "content": "!"},
+        {"type": "usage", "content": {"prompt": 1}},
+    ]
+    ids = [int(frame.split("\n", 1)[0][len("id: "):]) for frame in frames]
+    assert ids == [1, 2, 3, 4]
+    snapshot = stats.snapshot()
+    assert snapshot["events"] == len(items) and snapshot["frames"] == 4
+
+
+def test_max_bytes_flushes_early():
+    frames, _ = _frames(_events([("content", "abcd")] * 4), window_ms=1000, max_bytes=24, heartbeat=0)
+    assert [d["content"] for d in _data(frames)] == ["abcdabcd", "abcdabcd"]
+
+
+def test_window_flushes_slow_streams():
+    frames, _ = _frames(_events([("content", "a"), ("content", "b")], delay=0.05), window_ms=10, heartbeat=0)
+    assert [d["content"] for d in _data(frames)] == ["a", "b"]
+
+
+def test_heartbeat_while_idle():
+    frames, stats = _frames(_events([("content", "a")], delay=0.08), window_ms=0, heartbeat=0.02)
+    assert sse.HEARTBEAT_FRAME in frames
+    assert stats.snapshot()["heartbeats"] >= 1
+
+
+def test_upstream_exception_becomes_error_frame():
+    async def failing():
+        yield ("content", "a")
+        raise RuntimeError("坏了")
+
+    frames, _ = _frames(failing(), window_ms=0, heartbeat=0)
+    assert _data(frames) == [{"type": "content", "content": "a"}, {"type": "error", "content": "坏了"}]
+
+
+def test_disconnect_cancels_upstream_and_lets_it_clean_up():
+    closed = []
+
+    async def upstream():
+        try:
+            yield ("content", "a")
+            await asyncio.sleep(10)
+        finally:
+            await asyncio.sleep(0.02)  # 收尾：关闭上游、保存部分回复
+            closed.append(True)
+
+    async def main():
+        stream = sse.event_stream(upstream(), window_ms=0, heartbeat=0, stats=sse.StreamStats())
+        await stream.__anext__()
+        await stream.aclose()  # 客户端断开
+
+    asyncio.run(main())
+    assert closed == [True]
+
+
+def test_cancellation_is_not_swallowed():
+    closed = []
+
+    async def upstream():
+        try:
+            yield ("content", "a")
+            await asyncio.sleep(10)
+        finally:
+            await asyncio.sleep(0.05)
+            closed.append(True)
+
+    async def consume():
+        async for _ in sse.event_stream(upstream(), window_ms=0, heartbeat=0, stats=sse.StreamStats()):
+            pass
+
+    async def main():
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        else:
+            raise AssertionError("取消被吞掉了")
+        await asyncio.sleep(0.1)
+
+    asyncio.run(main())
+    assert closed == [True]
+
+
+def test_cancel_savings_are_counted_in_tokens():
+    stats = sse.StreamStats()
+    stats.record_completion(100)
+    stats.record_completion(200)
+    assert stats.record_cancel(40) == 110
+    assert stats.record_cancel(500) == 0
+    snapshot = stats.snapshot()
+    assert snapshot["cancelled_replies"] == 2
+    assert snapshot["cancelled_tokens_generated"] == 540
+    assert snapshot["upstream_tokens_saved"] == 110
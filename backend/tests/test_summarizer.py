@@ -0,0 +1,72 @@
+# 杏铃酱 xingling-chat 摘要生成测试
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+import asyncio
+
+import summarizer
+
+
+def test_failed_rollover_backs_off_by_time_and_messages():
+    async def main():
+        worker = summarizer.SummaryWorker(workers=1, retry_base=0.05, retry_max=1, retry_messages=10)
+        calls = []
+
+        async def failing():
+            calls.append(1)
+            raise RuntimeError("上游 500")
+
+        worker.submit("s", failing, size=30)
+        await worker.join()
+        assert len(calls) == 1 and worker.stats()["backing_off"] == 1
+        # 退避期间，新增消息不够时每轮对话的提交都跳过
+        for size in range(31, 40):
+            worker.submit("s", failing, size=size)
+        await worker.join()
+        assert len(calls) == 1 and worker.backed_off == 9
+        # 新增够 retry_messages 条消息时提前重试，连续失败后退避时间翻倍
+        worker.submit("s", failing, size=40)
+        await worker.join()
+        assert len(calls) == 2 and worker._backoff["s"].failures == 2
+        # 退避时间到了也会重试；成功后清掉退避记录
+        await asyncio.sleep(0.11)
+
+        async def ok():
+            calls.append(1)
+
+        worker.submit("s", ok, size=41)
+        await worker.join()
+        assert len(calls) == 3 and worker.stats()["backing_off"] == 0
+        await worker.stop()
+
+    asyncio.run(main())
+
+
+def test_same_session_is_single_flight():
+    async def main():
+        worker = summarizer.SummaryWorker(workers=2)
+        running = []
+        peak = []
+
+        async def job():
+            running.append(1)
+            peak.append(len(running))
+            await asyncio.sleep(0.02)
+            running.pop()
+
+        worker.submit("s", job)
+        await asyncio.sleep(0.005)
+        for _ in range(4):
+            worker.submit("s", job)
+        await worker.join()
+        assert max(peak) == 1
+        # 执行期间的多次提交合并成结束后的一次
+        assert worker.completed == 2
+        await worker.stop()
+
+    asyncio.run(main())
+
+
+def test_split_for_rollover_keeps_recent_messages():
+    history = [{"role": "user", "content": str(i)} for i in range(30)]
+    assert summarizer.split_for_rollover(history[:29], trigger=30, keep_recent=10) == 0
+    assert summarizer.split_for_rollover(history, trigger=30, keep_recent=10) == 20
@@ -0,0 +1,53 @@
+# 杏铃酱 xingling-chat 上游容错测试
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+import pytest
+
+import upstream
+
+
+@pytest.fixture(autouse=True)
+def fresh_breakers(monkeypatch):
+    monkeypatch.setattr(upstream, "_breakers", upstream.OrderedDict())
+    monkeypatch.setattr(upstream, "_breakers_evicted", 0)
+
+
+def test_breaker_opens_and_probes_once():
+    breaker = upstream.CircuitBreaker(failures=2, cooldown=0)
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == "open"
+    # 冷却结束：只放一个探测请求
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.success()
+    assert breaker.state == "closed" and breaker.allow()
+
+
+def test_breakers_are_bounded(monkeypatch):
+    monkeypatch.setattr(upstream, "BREAKER_MAX", 3)
+    for i in range(20):
+        upstream.breaker(upstream.Endpoint(f"key-{i}", "http://u/v1", "m"))
+    assert len(upstream._breakers) == 3
+    assert upstream.stats()["breakers_evicted"] == 17
+
+
+def test_open_breakers_are_not_evicted(monkeypatch):
+    monkeypatch.setattr(upstream, "BREAKER_MAX", 2)
+    tripped = upstream.breaker(upstream.Endpoint("bad", "http://u/v1", "m"))
+    for _ in range(upstream.BREAKER_FAILURES):
+        tripped.failure()
+    assert tripped.state == "open"
+    for i in range(5):
+        upstream.breaker(upstream.Endpoint(f"key-{i}", "http://u/v1", "m"))
+    assert upstream.breaker(upstream.Endpoint("bad", "http://u/v1", "m")) is tripped
+
+
+def test_stats_keep_keys_apart_without_leaking_them():
+    upstream.breaker(upstream.Endpoint("key-a", "http://u/v1", "m")).failure()
+    upstream.breaker(upstream.Endpoint("key-b", "http://u/v1", "m"))
+    breakers = upstream.stats()["breakers"]
+    assert len(breakers) == 2
+    assert sorted(b["failures"] for b in breakers.values()) == [0, 1]
+    assert all("key-" not in label and label.startswith("http://u/v1#") for label in breakers)
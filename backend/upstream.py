@@ -0,0 +1,513 @@
+# 杏铃酱 xingling-chat 上游容错
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+模型接口的重试、故障转移、对冲和熔断。
+
+每次请求按顺序尝试一组兼容 OpenAI 的上游：请求里的 (base_url, api_key, model) 排第一，
+后面是 XINGLING_UPSTREAM_FALLBACKS 配置的备用上游，例如
+[{"base_url": "http://localhost:11434/v1", "api_key": "ollama", "model": "qwen2.5:7b"}]
+（不写 model 时沿用请求的模型）。
+
+- 重试：连接失败、超时、408/409/429、5xx 和准入排队超时算可重试，换下一个上游再试；
+  所有上游都试过一遍后再回到同一个上游时先按指数退避（全抖动）等待，总共最多 UPSTREAM_ATTEMPTS 次。
+  400/401/404 这类错误说明请求本身有问题，直接抛出
+- 对冲（只用于流式）：UPSTREAM_HEDGE_DELAY 秒内第一个 token 还没到，就再向下一个上游
+  （只有一个上游时是同一个）发起一次请求，用先开始出字的那个，另一个马上关闭。
+  非流式回复的耗时主要取决于回复长度，按总耗时对冲只会让长回复花两份钱，所以不对冲
+- 熔断：每个上游连续失败 BREAKER_FAILURES 次后熔断 BREAKER_COOLDOWN 秒，期间直接跳过；
+  冷却结束后只放一个探测请求，成功才恢复。所有上游都在熔断时抛出 CircuitOpen（接口返回 503）
+  熔断器按 (base_url, api_key) 懒创建，键来自请求方，所以和 admission 的 Limiter 一样做 LRU：
+  没在熔断也没在探测的熔断器空闲超过 BREAKER_IDLE_TTL 秒或总数超过 BREAKER_MAX 时回收
+- 流式回复只在开始出字之前重试，出字之后断开按原来的方式处理
+
+异步路径的每次尝试都经过准入控制（admission）；同步路径（库调用）有重试、故障转移和熔断，没有对冲。
+openai 客户端自带的重试已关闭（见 client_pool），避免和这里的重试叠加。
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import AsyncExitStack
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import httpx
+
+import admission
+import client_pool
+import metrics
+
+# ---------- 容错配置（从环境变量读取）----------
+UPSTREAM_FALLBACKS: List[Dict] = json.loads(os.getenv("XINGLING_UPSTREAM_FALLBACKS", "") or "[]")
+UPSTREAM_ATTEMPTS = int(os.getenv("XINGLING_UPSTREAM_ATTEMPTS", "3"))
+UPSTREAM_RETRY_BASE = float(os.getenv("XINGLING_UPSTREAM_RETRY_BASE", "0.5"))
+UPSTREAM_RETRY_MAX = float(os.getenv("XINGLING_UPSTREAM_RETRY_MAX", "8"))
+UPSTREAM_HEDGE_DELAY = float(os.getenv("XINGLING_UPSTREAM_HEDGE_DELAY", "4"))  # 0 表示不对冲
+BREAKER_FAILURES = int(os.getenv("XINGLING_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("XINGLING_BREAKER_COOLDOWN", "30"))
+BREAKER_MAX = int(os.getenv("XINGLING_BREAKER_MAX", "256"))
+BREAKER_IDLE_TTL = float(os.getenv("XINGLING_BREAKER_IDLE_TTL", "600"))
+
+RETRYABLE_STATUS = (408, 409, 429)
+# 没有配置密钥的上游（本机的 Ollama / vLLM 等一般不校验）用这个占位，openai 客户端要求密钥非空
+NO_API_KEY = "none"
+
+
+class Endpoint:
+    __slots__ = ("api_key", "base_url", "model")
+
+    def __init__(self, api_key: str, base_url: str, model: str):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.model = model
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return (self.base_url, self.api_key)
+
+
+def endpoints(api_key: str, base_url: str, model: str, fallbacks: Optional[List[Dict]] = None) -> List[Endpoint]:
+    """指定的上游排第一，后面是备用上游（默认 UPSTREAM_FALLBACKS，去掉重复的）"""
+    result = [Endpoint(api_key, base_url, model)]
+    for item in (UPSTREAM_FALLBACKS if fallbacks is None else fallbacks):
+        endpoint = Endpoint(item.get("api_key") or NO_API_KEY, item["base_url"], item.get("model") or model)
+        if all(e.key != endpoint.key for e in result):
+            result.append(endpoint)
+    return result
+
+
+class CircuitOpen(admission.Overloaded):
+    def __init__(self, retry_after: float):
+        self.retry_after = max(int(retry_after + 0.999), 1)
+        Exception.__init__(self, f"上游暂时不可用（熔断中），请 {self.retry_after} 秒后重试")
+
+
+def retryable(exc: BaseException) -> bool:
+    """换个上游或稍后再试可能成功的错误"""
+    if isinstance(exc, (admission.Overloaded, asyncio.TimeoutError, httpx.TransportError)):
+        return True
+    status = getattr(exc, "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS or status >= 500
+    # openai 的 APIConnectionError / APITimeoutError 没有状态码；出错时 openai 一定已经导入
+    import openai
+    return isinstance(exc, openai.APIConnectionError)
+
+
+def _backoff(retry: int) -> float:
+    return random.uniform(0, min(UPSTREAM_RETRY_MAX, UPSTREAM_RETRY_BASE * (2 ** retry)))
+
+
+class CircuitBreaker:
+    """closed → 连续失败 → open → 冷却结束 → half_open（只放一个探测请求）→ 成功 closed / 失败 open"""
+
+    def __init__(self, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN):
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.trips = 0
+        self.last_used = time.monotonic()
+        self._lock = threading.Lock()  # 同步路径可能在多个线程里调用
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.cooldown:
+                    return False
+                self.state = "half_open"
+                self.probing = False
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def retry_after(self) -> float:
+        return max(self.opened_at + self.cooldown - time.monotonic(), 0.0)
+
+    def success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self.probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.threshold):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.trips += 1
+
+    def abandon(self):
+        """探测请求没有得出结论（被取消、排不上队、请求本身有问题），让下一个请求继续探测"""
+        with self._lock:
+            self.probing = False
+
+    @property
+    def idle(self) -> bool:
+        """没有在熔断（或冷却已过）也没有探测请求，回收后重新创建不丢失保护"""
+        if self.probing:
+            return False
+        return self.state == "closed" or self.retry_after() == 0
+
+    def stats(self) -> Dict:
+        return {"state": self.state, "failures": self.failures, "trips": self.trips}
+
+
+_breakers: "OrderedDict[Tuple[str, str], CircuitBreaker]" = OrderedDict()
+_breakers_lock = threading.Lock()
+_breakers_evicted = 0
+_stats = {"attempts": 0, "retries": 0, "failovers": 0, "hedges": 0, "hedge_wins": 0}
+
+
+def breaker(endpoint: Endpoint) -> CircuitBreaker:
+    with _breakers_lock:
+        found = _breakers.get(endpoint.key)
+        if found is None:
+            found = _breakers[endpoint.key] = CircuitBreaker()
+            _evict_breakers(endpoint.key)
+        else:
+            _breakers.move_to_end(endpoint.key)
+        found.last_used = time.monotonic()
+        return found
+
+
+def _evict_breakers(keep: Tuple[str, str]):
+    # 持有 _breakers_lock 时调用，只在创建新熔断器时整理
+    global _breakers_evicted
+    now = time.monotonic()
+    excess = len(_breakers) - BREAKER_MAX
+    for key, found in list(_breakers.items()):  # 从最久没用的开始
+        if key == keep or not found.idle:
+            continue
+        if excess > 0 or now - found.last_used > BREAKER_IDLE_TTL:
+            del _breakers[key]
+            _breakers_evicted += 1
+            excess -= 1
+
+
+def _label(key: Tuple[str, str]) -> str:
+    """/status 里熔断器的名称：base_url 加 API 密钥的短哈希（和 admission 的 Limiter 名称一致）"""
+    base_url, api_key = key
+    return f"{base_url}#{hashlib.sha1((api_key or '').encode('utf-8')).hexdigest()[:6]}"
+
+
+def _circuit_open(candidates: List[Endpoint]) -> CircuitOpen:
+    return CircuitOpen(min(breaker(e).retry_after() for e in candidates))
+
+
+class _Plan:
+    """按顺序轮流挑选没有熔断的上游；排队超时的上游本次请求不再重试（再排一次也一样）"""
+
+    def __init__(self, candidates: List[Endpoint]):
+        self.candidates = candidates
+        self.index = 0
+        self.tried: Set[Tuple[str, str]] = set()
+        self.overloaded: Set[Tuple[str, str]] = set()
+
+    def next(self) -> Optional[Endpoint]:
+        for _ in range(len(self.candidates)):
+            endpoint = self.candidates[self.index % len(self.candidates)]
+            self.index += 1
+            if endpoint.key not in self.overloaded and breaker(endpoint).allow():
+                return endpoint
+        return None
+
+
+def _started(chunk) -> bool:
+    """流式 chunk 里是否已经有内容（正文或思考过程）"""
+    if not chunk.choices:
+        return False
+    delta = chunk.choices[0].delta
+    return bool(getattr(delta, "content", None) or getattr(delta, "reasoning_content", None))
+
+
+def _settle(endpoint: Endpoint, error: Optional[BaseException]):
+    """按一次尝试的结果更新熔断器和指标"""
+    _stats["attempts"] += 1
+    if error is None:
+        breaker(endpoint).success()
+        outcome = "ok"
+    elif isinstance(error, asyncio.CancelledError):
+        breaker(endpoint).abandon()
+        outcome = "cancelled"
+    elif isinstance(error, admission.Overloaded):
+        breaker(endpoint).abandon()
+        outcome = "overloaded"
+    elif retryable(error):
+        breaker(endpoint).failure()
+        outcome = "error"
+    else:
+        breaker(endpoint).abandon()
+        outcome = "rejected"
+    metrics.UPSTREAM_ATTEMPTS.labels(upstream=endpoint.base_url, outcome=outcome).inc()
+
+
+def _final_error(errors: List[BaseException], candidates: List[Endpoint]) -> BaseException:
+    """全部尝试失败：有真正的上游错误时抛最后一个，只有排队超时就抛排队超时，一次都没能发出就是熔断"""
+    if not errors:
+        return _circuit_open(candidates)
+    real = [e for e in errors if not isinstance(e, admission.Overloaded)]
+    return real[-1] if real else errors[0]
+
+
+def check(candidates: List[Endpoint]):
+    """接口层的快速判断，不占名额：所有上游都排不过来或都在熔断时抛出 Overloaded / CircuitOpen"""
+    overloaded: Optional[admission.Overloaded] = None
+    for endpoint in candidates:
+        if breaker(endpoint).state == "open" and breaker(endpoint).retry_after() > 0:
+            continue
+        try:
+            admission.controller.check("llm", endpoint.base_url, endpoint.api_key)
+            return
+        except admission.Overloaded as e:
+            overloaded = overloaded or e
+    raise overloaded or _circuit_open(candidates)
+
+
+# ---------- 异步（接口层）----------
+
+class Attempt:
+    """
+    成功开始的一次请求。非流式看 response；流式直接 async for 拿 chunk（开头已读到的部分会先回放）。
+    close() 关闭上游连接并归还准入名额，可以重复调用
+    """
+
+    def __init__(self, endpoint: Endpoint):
+        self.endpoint = endpoint
+        self.response = None
+        self.grant = admission.Grant(0)
+        self.head: List = []
+        self._iterator = None
+        self._stack = AsyncExitStack()
+
+    async def __aiter__(self):
+        for chunk in self.head:
+            yield chunk
+        if self._iterator is not None:
+            async for chunk in self._iterator:
+                yield chunk
+
+    async def close(self):
+        await self._stack.aclose()
+
+    async def __aenter__(self) -> "Attempt":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+async def _aopen(endpoint: Endpoint, params: Dict, stream: bool, session_id: Optional[str],
+                 priority: int, cost: int) -> Attempt:
+    attempt = Attempt(endpoint)
+    try:
+        attempt.grant = await attempt._stack.enter_async_context(admission.controller.slot(
+            "llm", endpoint.base_url, endpoint.api_key, session_id, priority, cost))
+        client = client_pool.registry.get_async(endpoint.api_key, endpoint.base_url)
+        response = await client.chat.completions.create(model=endpoint.model, stream=stream, **params)
+        if stream:
+            attempt._stack.push_async_callback(response.close)
+            attempt._iterator = response.__aiter__()
+            async for chunk in attempt._iterator:
+                attempt.head.append(chunk)
+                if _started(chunk):
+                    break
+        else:
+            attempt.response = response
+    except BaseException as e:
+        _settle(endpoint, e)
+        await attempt.close()
+        raise
+    _settle(endpoint, None)
+    return attempt
+
+
+def _discard(task: asyncio.Task):
+    """对冲落败或不再需要的尝试：还没完成的取消（取消时自己收尾），已经开始的关闭"""
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled() and task.exception() is None:
+        asyncio.get_running_loop().create_task(task.result().close())
+
+
+async def aopen(candidates: List[Endpoint], params: Dict, stream: bool = False, session_id: Optional[str] = None,
+                priority: int = admission.INTERACTIVE, cost: int = 0) -> Attempt:
+    """
+    按顺序尝试各上游，返回第一个成功开始的 Attempt（用 async with 或 close() 收尾）。
+    params 是 chat.completions.create 除 model / stream 以外的参数
+    """
+    plan = _Plan(candidates)
+    first = plan.next()
+    if first is None:
+        raise _circuit_open(candidates)
+    loop = asyncio.get_running_loop()
+    pending: Dict[asyncio.Task, Endpoint] = {}
+    hedges: Set[asyncio.Task] = set()
+    errors: List[BaseException] = []
+    retries = 0
+
+    def launch(endpoint: Endpoint) -> asyncio.Task:
+        plan.tried.add(endpoint.key)
+        task = loop.create_task(_aopen(endpoint, params, stream, session_id, priority, cost))
+        pending[task] = endpoint
+        return task
+
+    def hedge_deadline() -> Optional[float]:
+        return time.monotonic() + UPSTREAM_HEDGE_DELAY if stream and UPSTREAM_HEDGE_DELAY > 0 else None
+
+    launch(first)
+    launched = 1
+    hedge_at = hedge_deadline()
+    try:
+        while pending:
+            timeout = None
+            if hedge_at is not None and launched < UPSTREAM_ATTEMPTS:
+                timeout = max(hedge_at - time.monotonic(), 0.0)
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # 迟迟没有开始出字：再发一个请求，谁先开始用谁
+                hedge_at = None
+                endpoint = plan.next()
+                if endpoint is not None:
+                    _stats["hedges"] += 1
+                    metrics.UPSTREAM_HEDGES.inc()
+                    hedges.add(launch(endpoint))
+                    launched += 1
+                continue
+
+            winner: Optional[Attempt] = None
+            fatal: Optional[BaseException] = None
+            for task in done:
+                endpoint = pending.pop(task)
+                error = task.exception()
+                if error is None:
+                    if winner is None:
+                        winner = task.result()
+                        if task in hedges:
+                            _stats["hedge_wins"] += 1
+                    else:
+                        await task.result().close()
+                else:
+                    errors.append(error)
+                    if isinstance(error, admission.Overloaded):
+                        plan.overloaded.add(endpoint.key)
+                    elif not retryable(error):
+                        fatal = error
+            if winner is not None:
+                return winner
+            if fatal is not None:
+                raise fatal
+            if pending or launched >= UPSTREAM_ATTEMPTS:
+                continue
+            endpoint = plan.next()
+            if endpoint is None:
+                break
+            if endpoint.key in plan.tried:
+                # 所有上游都试过了，退避一下再重试
+                await asyncio.sleep(_backoff(retries))
+                retries += 1
+                _stats["retries"] += 1
+            else:
+                _stats["failovers"] += 1
+            launch(endpoint)
+            launched += 1
+            hedge_at = hedge_deadline()
+    finally:
+        for task in pending:
+            _discard(task)
+    raise _final_error(errors, candidates)
+
+
+# ---------- 同步（库调用）----------
+
+class SyncAttempt:
+    """同步版本的 Attempt：非流式看 response，流式直接 for 迭代 chunk"""
+
+    def __init__(self, endpoint: Endpoint):
+        self.endpoint = endpoint
+        self.response = None
+        self.head: List = []
+        self._stream = None
+        self._iterator: Optional[Iterator] = None
+
+    def __iter__(self):
+        yield from self.head
+        if self._iterator is not None:
+            yield from self._iterator
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+    def __enter__(self) -> "SyncAttempt":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _open(endpoint: Endpoint, params: Dict, stream: bool) -> SyncAttempt:
+    attempt = SyncAttempt(endpoint)
+    try:
+        client = client_pool.registry.get_sync(endpoint.api_key, endpoint.base_url)
+        response = client.chat.completions.create(model=endpoint.model, stream=stream, **params)
+        if stream:
+            attempt._stream = response
+            attempt._iterator = iter(response)
+            for chunk in attempt._iterator:
+                attempt.head.append(chunk)
+                if _started(chunk):
+                    break
+        else:
+            attempt.response = response
+    except BaseException as e:
+        _settle(endpoint, e)
+        attempt.close()
+        raise
+    _settle(endpoint, None)
+    return attempt
+
+
+def open_sync(candidates: List[Endpoint], params: Dict, stream: bool = False) -> SyncAttempt:
+    """aopen 的同步版本：依次重试和故障转移，不对冲、不经过准入控制"""
+    plan = _Plan(candidates)
+    errors: List[BaseException] = []
+    retries = 0
+    for _ in range(UPSTREAM_ATTEMPTS):
+        endpoint = plan.next()
+        if endpoint is None:
+            break
+        if endpoint.key in plan.tried:
+            time.sleep(_backoff(retries))
+            retries += 1
+            _stats["retries"] += 1
+        elif errors:
+            _stats["failovers"] += 1
+        plan.tried.add(endpoint.key)
+        try:
+            return _open(endpoint, params, stream)
+        except Exception as e:
+            errors.append(e)
+            if not retryable(e):
+                raise
+    raise _final_error(errors, candidates)
+
+
+def stats() -> Dict:
+    with _breakers_lock:
+        breakers = {_label(key): b.stats() for key, b in _breakers.items()}
+        evicted = _breakers_evicted
+    return {**_stats, "fallbacks": [item["base_url"] for item in UPSTREAM_FALLBACKS], "breakers": breakers,
+            "breakers_evicted": evicted}
@@ -0,0 +1,285 @@
+# 杏铃酱 xingling-chat 用量账本
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+按会话和 API 密钥记录每次调用模型的 token 用量（输入 / 输出 / 思考 / 命中缓存），用来核算上游花费。
+
+- 对话（流式和非流式）、长期摘要、文档分段分析的每次调用都记账，用量取接口返回的 usage
+- 先在内存里按 (日期, 会话, 密钥, 模型, 任务) 聚合，后台线程每 LEDGER_FLUSH_INTERVAL 秒
+  （或攒够 LEDGER_FLUSH_ROWS 行时）批量写入 usage.db；每个组合每天只有一行，账本不随调用次数增长
+- 密钥只保存 SHA-256 的前 12 位（key_id）
+- 预算（可选）：会话或密钥当天的 token 数（输入 + 输出）达到 SESSION_DAILY_TOKENS / KEY_DAILY_TOKENS 后，
+  新的对话按 BUDGET_ACTION 处理：reject 拒绝（接口返回 429），downgrade 改用 model_routing 的 downgrade 路由
+  （没有配置时仍然拒绝）。后台摘要只记账，不受预算限制
+- 多 worker 部署时各 worker 分别聚合、写同一个数据库；预算按本 worker 看到的用量核算，可能略微超出
+
+日期按服务器本地时区。
+"""
+import atexit
+import hashlib
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from session_index import SqliteConnections
+
+# ---------- 账本配置（从环境变量读取）----------
+LEDGER_FLUSH_INTERVAL = float(os.getenv("XINGLING_LEDGER_FLUSH_INTERVAL", "5"))
+LEDGER_FLUSH_ROWS = int(os.getenv("XINGLING_LEDGER_FLUSH_ROWS", "500"))
+SESSION_DAILY_TOKENS = int(os.getenv("XINGLING_SESSION_DAILY_TOKENS", "0"))  # 0 表示不限
+KEY_DAILY_TOKENS = int(os.getenv("XINGLING_KEY_DAILY_TOKENS", "0"))
+BUDGET_ACTION = os.getenv("XINGLING_BUDGET_ACTION", "reject")  # reject / downgrade
+
+LEDGER_FILENAME = "usage.db"
+ROLLUP_MAX_ROWS = 5000
+
+# 汇总接口的分组名 -> 列名
+GROUP_COLUMNS = {"day": "day", "session": "session_id", "key": "key_id", "model": "model", "task": "task"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage_ledger (
+    day TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    key_id TEXT NOT NULL,
+    model TEXT NOT NULL,
+    task TEXT NOT NULL,
+    calls INTEGER NOT NULL,
+    prompt INTEGER NOT NULL,
+    completion INTEGER NOT NULL,
+    reasoning INTEGER NOT NULL,
+    cached INTEGER NOT NULL,
+    PRIMARY KEY (day, session_id, key_id, model, task)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS usage_ledger_session ON usage_ledger (session_id, day);
+CREATE INDEX IF NOT EXISTS usage_ledger_key ON usage_ledger (key_id, day);
+"""
+UPSERT = (
+    "INSERT INTO usage_ledger VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT (day, session_id, key_id, model, task) DO UPDATE SET "
+    "calls = calls + excluded.calls, prompt = prompt + excluded.prompt, "
+    "completion = completion + excluded.completion, reasoning = reasoning + excluded.reasoning, "
+    "cached = cached + excluded.cached"
+)
+DAILY_TOKENS = {
+    "session": "SELECT COALESCE(SUM(prompt + completion), 0) FROM usage_ledger WHERE session_id = ? AND day = ?",
+    "key": "SELECT COALESCE(SUM(prompt + completion), 0) FROM usage_ledger WHERE key_id = ? AND day = ?",
+}
+
+RowKey = Tuple[str, str, str, str, str]  # (day, session_id, key_id, model, task)
+
+
+def key_id(api_key: Optional[str]) -> str:
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:12]
+
+
+def today() -> str:
+    return time.strftime("%Y-%m-%d")
+
+
+def _seconds_to_midnight() -> float:
+    now = time.localtime()
+    return 86400 - (now.tm_hour * 3600 + now.tm_min * 60 + now.tm_sec)
+
+
+class BudgetExceeded(Exception):
+    def __init__(self, scope: str, used: int, limit: int):
+        self.retry_after = max(int(_seconds_to_midnight()), 1)
+        super().__init__(f"{scope}今天的 token 用量 {used} 已达到预算 {limit}，明天再来吧")
+
+
+class UsageLedger:
+    def __init__(self, db_path: str, flush_interval: float = LEDGER_FLUSH_INTERVAL,
+                 flush_rows: int = LEDGER_FLUSH_ROWS):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self._connections: Optional[SqliteConnections] = None
+        self._init_lock = threading.Lock()
+        self._lock = threading.Lock()        # 保护内存里的聚合
+        self._flush_lock = threading.Lock()  # 写库和读当天总量互斥，避免重复或漏算正在写入的一批
+        self._pending: Dict[RowKey, List[int]] = {}
+        self._daily: Dict[Tuple[str, str], int] = {}  # (session/key, id) -> 当天 token 数，按需从库里加载
+        self._daily_day = ""
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self.recorded = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.flush_errors = 0
+
+    def _conn(self):
+        if self._connections is None:
+            with self._init_lock:
+                if self._connections is None:
+                    os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+                    connections = SqliteConnections(self.db_path)
+                    connections.get().executescript(SCHEMA)
+                    self._connections = connections
+        return self._connections.get()
+
+    # ---------- 记账 ----------
+
+    def record(self, session_id: Optional[str], api_key: Optional[str], model: str, task: str, usage: Dict):
+        """记一次调用；usage 是 context_builder.usage_from_response 的结果"""
+        day = today()
+        kid = key_id(api_key)
+        tokens = usage["prompt"] + usage["completion"]
+        with self._lock:
+            row = self._pending.setdefault((day, session_id or "", kid, model, task), [0, 0, 0, 0, 0])
+            row[0] += 1
+            row[1] += usage["prompt"]
+            row[2] += usage["completion"]
+            row[3] += usage["reasoning"]
+            row[4] += usage["cached"]
+            if self._daily_day == day:
+                for scope in (("session", session_id or ""), ("key", kid)):
+                    if scope in self._daily:
+                        self._daily[scope] += tokens
+            self.recorded += 1
+            full = len(self._pending) >= self.flush_rows
+        self._start()
+        if full:
+            self._wake.set()
+
+    def _start(self):
+        if self._thread is None and not self._closed:
+            with self._lock:
+                if self._thread is not None:
+                    return
+                self._thread = threading.Thread(target=self._run, name="usage-ledger", daemon=True)
+                self._thread.start()
+            # 库调用（没有 FastAPI 的退出钩子）时进程退出前也要写入
+            atexit.register(self.flush)
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        """把内存里的聚合写入数据库，返回写入的行数；失败时放回内存，下次再写"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            rows = [key + tuple(values) for key, values in pending.items()]
+            conn = None
+            try:
+                conn = self._conn()
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany(UPSERT, rows)
+                conn.execute("COMMIT")
+            except Exception as e:
+                if conn is not None and conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                print(f"写入用量账本失败: {e}")
+                with self._lock:
+                    self.flush_errors += 1
+                    for key, values in pending.items():
+                        row = self._pending.setdefault(key, [0, 0, 0, 0, 0])
+                        for i, value in enumerate(values):
+                            row[i] += value
+                return 0
+            self.flushes += 1
+            self.rows_written += len(rows)
+            return len(rows)
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        self.flush()
+        if self._connections is not None:
+            self._connections.close()
+            self._connections = None
+
+    # ---------- 预算 ----------
+
+    def used_today(self, scope: str, ident: str) -> int:
+        """会话（scope="session"）或密钥（scope="key"，ident 为 key_id）当天的 token 数"""
+        day = today()
+        with self._lock:
+            if self._daily_day != day:
+                self._daily = {}
+                self._daily_day = day
+            if (scope, ident) in self._daily:
+                return self._daily[(scope, ident)]
+        with self._flush_lock:
+            stored = self._conn().execute(DAILY_TOKENS[scope], (ident, day)).fetchone()[0]
+            index = 1 if scope == "session" else 2
+            with self._lock:
+                pending = sum(v[1] + v[2] for k, v in self._pending.items() if k[0] == day and k[index] == ident)
+                self._daily[(scope, ident)] = stored + pending
+                return stored + pending
+
+    def over_budget(self, session_id: str, api_key: Optional[str]) -> Optional[BudgetExceeded]:
+        """超出预算时返回 BudgetExceeded，由调用方决定拒绝还是降级"""
+        checks = (("session", session_id, SESSION_DAILY_TOKENS, f"会话 {session_id} "),
+                  ("key", key_id(api_key), KEY_DAILY_TOKENS, "这个 API 密钥"))
+        for scope, ident, limit, label in checks:
+            if limit > 0:
+                used = self.used_today(scope, ident)
+                if used >= limit:
+                    return BudgetExceeded(label, used, limit)
+        return None
+
+    # ---------- 查询 ----------
+
+    def rollup(self, group_by: Sequence[str] = ("day", "model"), since: Optional[str] = None,
+               until: Optional[str] = None, session_id: Optional[str] = None, key: Optional[str] = None,
+               limit: int = 1000) -> List[Dict]:
+        """
+        按 group_by（day / session / key / model / task 的任意组合，空表示总计）汇总用量。
+        since / until 为 YYYY-MM-DD（含）；key 为 key_id。先把内存里的用量写入再查
+        """
+        unknown = [g for g in group_by if g not in GROUP_COLUMNS]
+        if unknown:
+            raise ValueError(f"不支持的分组: {', '.join(unknown)}（可用 {' / '.join(GROUP_COLUMNS)}）")
+        for value in (since, until):
+            if value is not None:
+                time.strptime(value, "%Y-%m-%d")  # 格式不对时抛出 ValueError
+        self.flush()
+        columns = [GROUP_COLUMNS[g] for g in dict.fromkeys(group_by)]
+        where, args = [], []
+        for clause, value in (("day >= ?", since), ("day <= ?", until), ("session_id = ?", session_id),
+                              ("key_id = ?", key)):
+            if value is not None:
+                where.append(clause)
+                args.append(value)
+        order = (["day DESC"] if "day" in columns else []) + ["total DESC"]
+        sql = (
+            f"SELECT {''.join(c + ', ' for c in columns)}SUM(calls), SUM(prompt), SUM(completion), "
+            f"SUM(reasoning), SUM(cached), SUM(prompt + completion) AS total FROM usage_ledger"
+            + (f" WHERE {' AND '.join(where)}" if where else "")
+            + (f" GROUP BY {', '.join(columns)}" if columns else "")
+            + f" ORDER BY {', '.join(order)} LIMIT ?"
+        )
+        args.append(max(1, min(limit, ROLLUP_MAX_ROWS)))
+        rows = []
+        for row in self._conn().execute(sql, args):
+            if row[len(columns)] is None:
+                continue  # 账本为空时 SUM 全是 NULL
+            item = dict(zip(columns, row))
+            calls, prompt, completion, reasoning, cached, total = row[len(columns):]
+            item.update(calls=calls, prompt_tokens=prompt, completion_tokens=completion,
+                        reasoning_tokens=reasoning, cached_tokens=cached, total_tokens=total)
+            rows.append(item)
+        return rows
+
+    def stats(self) -> Dict:
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "pending_rows": pending,
+            "recorded": self.recorded,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "flush_errors": self.flush_errors,
+            "budgets": {"session_daily_tokens": SESSION_DAILY_TOKENS, "key_daily_tokens": KEY_DAILY_TOKENS,
+                        "action": BUDGET_ACTION},
+        }
@@ -0,0 +1,407 @@
+# 杏铃酱 xingling-chat 联网搜索
+# Copyright (c) 2026 zhyuuka
+# 开源协议：MIT License，使用需保留原作者署名，商用需获得授权
+"""
+联网搜索层（Tavily / Google Serper）。
+
+- 每个服务商一个连接池：同步用 requests.Session，异步用 httpx.AsyncClient，复用 TLS 连接
+- 结果缓存：按 (服务商, 密钥哈希, 规范化后的查询, 结果数) 做 TTL + 容量上限的 LRU 缓存，
+  用户换个标点、大小写或空格重复提问时直接命中；只缓存成功的结果。键里带密钥哈希，
+  没有有效密钥（或换了密钥）的请求不会拿到别人的密钥搜来的结果
+- 同一密钥的同一查询并发到达时只发一次请求（single-flight）
+- 统计命中/未命中/错误次数和各服务商的请求耗时
+- 限时对冲搜索（ahedged）：先问主服务商，一小段时间没结果再同时问另一家，取先到的好结果；
+  到截止时间还没有结果就放弃，对话不再等待搜索（没等到的请求在后台跑完，结果进缓存）
+- 注入 prompt 前在本地对结果切段、去重、按用户消息排序并控制总长度（search_passages）
+- 发往服务商的请求经过准入控制（admission，按 服务商 + 密钥 限制并发）；排不上队时本次搜索按失败处理
+
+服务商地址可用 XINGLING_TAVILY_URL / XINGLING_SERPER_URL 覆盖，便于对接本地的模拟服务
+（见 bench/mock_upstream.py）。
+"""
+import asyncio
+import hashlib
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+import httpx
+
+if TYPE_CHECKING:
+    import requests
+
+import admission
+import metrics
+import search_passages
+
+# ---------- 搜索配置（从环境变量读取）----------
+SEARCH_TIMEOUT = float(os.getenv("XINGLING_SEARCH_TIMEOUT", "10"))
+SEARCH_CACHE_TTL = float(os.getenv("XINGLING_SEARCH_CACHE_TTL", "600"))
+SEARCH_CACHE_SIZE = int(os.getenv("XINGLING_SEARCH_CACHE_SIZE", "512"))
+SEARCH_POOL_SIZE = int(os.getenv("XINGLING_SEARCH_POOL_SIZE", "16"))
+# 限时搜索：超过 SEARCH_DEADLINE 秒就不再等待；主服务商 SEARCH_HEDGE_DELAY 秒内没有结果时
+# 同时向另一家服务商发起请求（需要提供另一家的 API 密钥）
+SEARCH_DEADLINE = float(os.getenv("XINGLING_SEARCH_DEADLINE", "3"))
+SEARCH_HEDGE_DELAY = float(os.getenv("XINGLING_SEARCH_HEDGE_DELAY", "0.8"))
+
+PROVIDER_URLS = {
+    "tavily": os.getenv("XINGLING_TAVILY_URL", "https://api.tavily.com/search"),
+    "google_serper": os.getenv("XINGLING_SERPER_URL", "https://google.serper.dev/search"),
+}
+HEDGE_PROVIDER = {"tavily": "google_serper", "google_serper": "tavily"}
+
+
+class SearchOutcome:
+    """一次搜索的结果。items 为 [{"title", "content", "url"}]；失败时 error 为提示文本"""
+    __slots__ = ("provider", "items", "error", "cached", "elapsed")
+
+    def __init__(self, provider: str, items: Optional[List[Dict]] = None, error: Optional[str] = None,
+                 cached: bool = False, elapsed: float = 0.0):
+        self.provider = provider
+        self.items = items or []
+        self.error = error
+        self.cached = cached
+        self.elapsed = elapsed
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def format_outcome(outcome: SearchOutcome, query: Optional[str] = None) -> str:
+    """
+    转成注入 prompt 的文本。传入 query（用户消息）时按相关程度节选片段并控制总长度（见 search_passages），
+    否则与原来的 search_web 返回值一致（全文拼接）
+    """
+    if outcome.error is not None:
+        return outcome.error
+    if not outcome.items:
+        return "（未搜索到相关信息）"
+    if query is not None and search_passages.SEARCH_RERANK:
+        selected = search_passages.select(outcome.items, query)
+        if selected:
+            return search_passages.format_selected(selected)
+    formatted = "\n\n".join([f"{item['title']}: {item['content']}" for item in outcome.items])
+    return f"以下是联网搜索到的信息：\n{formatted}"
+
+
+def normalize_query(query: str) -> str:
+    text = unicodedata.normalize("NFKC", query).lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip("?？!！。.~～ ")
+
+
+def build_request(provider: str, query: str, api_key: str, result_count: int) -> Optional[Tuple[str, Dict, Dict]]:
+    """返回 (url, payload, headers)，不支持的服务商返回 None"""
+    if provider == "tavily":
+        payload = {
+            "api_key": api_key,
+            "query": query,
+            "search_depth": "basic",
+            "max_results": result_count,
+            "include_answer": False,
+            "include_raw_content": False
+        }
+        return PROVIDER_URLS["tavily"], payload, {}
+    elif provider == "google_serper":
+        headers = {"X-API-KEY": api_key, "Content-Type": "application/json"}
+        payload = {"q": query, "num": result_count}
+        return PROVIDER_URLS["google_serper"], payload, headers
+    return None
+
+
+def parse_response(provider: str, data: Dict) -> List[Dict]:
+    if provider == "tavily":
+        return [
+            {"title": r.get("title", "无标题"), "content": r.get("content", ""), "url": r.get("url", "")}
+            for r in data.get("results", [])
+        ]
+    return [
+        {"title": item.get("title", "无标题"), "content": item.get("snippet", ""), "url": item.get("link", "")}
+        for item in data.get("organic", [])
+    ]
+
+
+class TTLCache:
+    """带过期时间和容量上限的 LRU 缓存（线程安全）"""
+
+    def __init__(self, max_size: int = SEARCH_CACHE_SIZE, ttl: float = SEARCH_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[tuple, Tuple[float, object]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key: tuple, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SearchMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors: Dict[str, int] = {}
+        self.requests: Dict[str, int] = {}
+        self.latency_total: Dict[str, float] = {}
+
+    def record_request(self, provider: str, elapsed: float, ok: bool):
+        metrics.SEARCH_SECONDS.labels(provider=provider, outcome="ok" if ok else "error").observe(elapsed)
+        with self._lock:
+            self.requests[provider] = self.requests.get(provider, 0) + 1
+            self.latency_total[provider] = self.latency_total.get(provider, 0.0) + elapsed
+            if not ok:
+                self.errors[provider] = self.errors.get(provider, 0) + 1
+
+    def count(self, field: str):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "requests": dict(self.requests),
+                "errors": dict(self.errors),
+                "avg_latency_seconds": {
+                    p: round(self.latency_total[p] / n, 4) for p, n in self.requests.items() if n
+                },
+            }
+
+
+class WebSearch:
+    def __init__(self, cache: Optional[TTLCache] = None):
+        self.cache = cache or TTLCache()
+        self.metrics = SearchMetrics()
+        self._sessions: Dict[str, "requests.Session"] = {}
+        self._sessions_lock = threading.Lock()
+        self._async_clients: Dict[str, httpx.AsyncClient] = {}
+        self._async_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._inflight: Dict[tuple, "asyncio.Future[SearchOutcome]"] = {}
+        self._abandoned: set = set()
+        self.deadline_states: Dict[str, int] = {}
+
+    # ---------- 连接池 ----------
+    def _session(self, provider: str) -> "requests.Session":
+        with self._sessions_lock:
+            session = self._sessions.get(provider)
+            if session is None:
+                # requests 只有同步的库调用才用到，第一次用时再导入
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=SEARCH_POOL_SIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._sessions[provider] = session
+            return session
+
+    def _async_client(self, provider: str) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._async_loop is not loop:
+            # 换了事件循环（库调用里多次 asyncio.run），旧客户端不能再用
+            self._async_clients = {}
+            self._inflight = {}
+            self._async_loop = loop
+        client = self._async_clients.get(provider)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                timeout=SEARCH_TIMEOUT,
+                limits=httpx.Limits(max_connections=SEARCH_POOL_SIZE, max_keepalive_connections=SEARCH_POOL_SIZE),
+            )
+            self._async_clients[provider] = client
+        return client
+
+    async def aclose(self):
+        for client in self._async_clients.values():
+            await client.aclose()
+        self._async_clients = {}
+        with self._sessions_lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+    # ---------- 搜索 ----------
+    @staticmethod
+    def cache_key(provider: str, query: str, result_count: int, api_key: str) -> tuple:
+        # 只放密钥的哈希，缓存里不留明文密钥
+        digest = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+        return (provider, digest, normalize_query(query), result_count)
+
+    def _lookup(self, key: tuple) -> Optional[SearchOutcome]:
+        cached = self.cache.get(key)
+        if cached is None:
+            self.metrics.count("misses")
+            return None
+        self.metrics.count("hits")
+        return SearchOutcome(key[0], list(cached), cached=True)
+
+    def _finish(self, key: tuple, provider: str, status_code: int, data: Optional[Dict], elapsed: float) -> SearchOutcome:
+        if status_code != 200:
+            outcome = SearchOutcome(provider, error=f"（搜索失败：HTTP {status_code}）", elapsed=elapsed)
+        else:
+            outcome = SearchOutcome(provider, parse_response(provider, data), elapsed=elapsed)
+            self.cache.put(key, tuple(outcome.items))
+        self.metrics.record_request(provider, elapsed, outcome.ok)
+        return outcome
+
+    def search(self, query: str, provider: str, api_key: str, result_count: int = 3) -> SearchOutcome:
+        """同步搜索（库调用使用）"""
+        if not api_key:
+            return SearchOutcome(provider, error="（未提供搜索 API 密钥）")
+        request = build_request(provider, query, api_key, result_count)
+        if request is None:
+            return SearchOutcome(provider, error="（不支持的搜索服务商）")
+        key = self.cache_key(provider, query, result_count, api_key)
+        cached = self._lookup(key)
+        if cached is not None:
+            return cached
+        url, payload, headers = request
+        start = time.perf_counter()
+        try:
+            resp = self._session(provider).post(url, json=payload, headers=headers, timeout=SEARCH_TIMEOUT)
+            data = resp.json() if resp.status_code == 200 else None
+            return self._finish(key, provider, resp.status_code, data, time.perf_counter() - start)
+        except Exception as e:
+            self.metrics.record_request(provider, time.perf_counter() - start, False)
+            return SearchOutcome(provider, error=f"（搜索出错：{str(e)}）")
+
+    async def asearch(self, query: str, provider: str, api_key: str, result_count: int = 3,
+                      session_id: Optional[str] = None) -> SearchOutcome:
+        """异步搜索；相同查询并发到达时共享同一个请求。session_id 用于准入控制的公平排队"""
+        if not api_key:
+            return SearchOutcome(provider, error="（未提供搜索 API 密钥）")
+        request = build_request(provider, query, api_key, result_count)
+        if request is None:
+            return SearchOutcome(provider, error="（不支持的搜索服务商）")
+        key = self.cache_key(provider, query, result_count, api_key)
+        cached = self._lookup(key)
+        if cached is not None:
+            return cached
+        client = self._async_client(provider)
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.metrics.count("coalesced")
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        url, payload, headers = request
+        start = time.perf_counter()
+        outcome = SearchOutcome(provider, error="（搜索出错：请求被取消）")
+        try:
+            async with admission.controller.slot("search", provider, api_key, session_id):
+                resp = await client.post(url, json=payload, headers=headers)
+            data = resp.json() if resp.status_code == 200 else None
+            outcome = self._finish(key, provider, resp.status_code, data, time.perf_counter() - start)
+        except admission.Overloaded as e:
+            outcome = SearchOutcome(provider, error=f"（搜索跳过：{e}）")
+        except Exception as e:
+            self.metrics.record_request(provider, time.perf_counter() - start, False)
+            outcome = SearchOutcome(provider, error=f"（搜索出错：{str(e)}）")
+        finally:
+            # 发起者被取消时也要唤醒等待同一请求的其他调用方
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+            if not future.done():
+                future.set_result(outcome)
+        return outcome
+
+    async def ahedged(self, query: str, provider: str, api_key: str, result_count: int = 3,
+                      deadline: float = SEARCH_DEADLINE, hedge_delay: float = SEARCH_HEDGE_DELAY,
+                      hedge_api_key: Optional[str] = None,
+                      session_id: Optional[str] = None) -> Tuple[Optional[SearchOutcome], Dict]:
+        """
+        限时对冲搜索，返回 (结果, 状态)。状态 state 取值：
+        ok（拿到了有内容的结果）/ failed（截止前全部返回但都失败或为空）/
+        partial（到截止时间只收到失败或空结果，其余请求放弃）/ skipped（到截止时间什么都没收到）
+        """
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        end = start + deadline
+        hedge_provider = HEDGE_PROVIDER.get(provider) if hedge_api_key else None
+        hedge_at = start + hedge_delay if hedge_provider else None
+        tasks = {loop.create_task(self.asearch(query, provider, api_key, result_count, session_id)): provider}
+        best: Optional[SearchOutcome] = None
+        fallback: Optional[SearchOutcome] = None
+
+        while tasks or hedge_at is not None:
+            if not tasks or (hedge_at is not None and time.perf_counter() >= hedge_at):
+                # 到了对冲时间，或主服务商已经失败：向另一家发起请求
+                tasks[loop.create_task(self.asearch(query, hedge_provider, hedge_api_key, result_count, session_id))] = hedge_provider
+                hedge_at = None
+            now = time.perf_counter()
+            if now >= end:
+                break
+            wake = end if hedge_at is None else min(end, hedge_at)
+            done, _ = await asyncio.wait(tasks, timeout=wake - now, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                tasks.pop(task)
+                outcome = task.result()
+                if outcome.ok and outcome.items:
+                    best = outcome
+                elif fallback is None or (outcome.ok and not fallback.ok):
+                    fallback = outcome
+            if best is not None:
+                break
+
+        for task in tasks:
+            # 没等到的请求继续在后台完成（结果会进入缓存），这里只保留引用
+            self._abandoned.add(task)
+            task.add_done_callback(self._abandoned.discard)
+
+        if best is not None:
+            state, outcome = "ok", best
+        elif not tasks:
+            state, outcome = "failed", fallback
+        else:
+            state, outcome = ("partial", fallback) if fallback is not None else ("skipped", None)
+        self.deadline_states[state] = self.deadline_states.get(state, 0) + 1
+        status = {
+            "stage": "search",
+            "state": state,
+            "provider": outcome.provider if outcome is not None else provider,
+            "hedged": hedge_provider is not None and hedge_at is None,
+            "elapsed_ms": int((time.perf_counter() - start) * 1000),
+            "deadline_ms": int(deadline * 1000),
+        }
+        return outcome, status
+
+    def stats(self) -> Dict:
+        stats = self.metrics.snapshot()
+        stats["cache_size"] = len(self.cache)
+        stats["deadline_states"] = dict(self.deadline_states)
+        return stats
+
+
+web_search = WebSearch()